@@ -0,0 +1,233 @@
+"""
+Admin of receipts fit for tables of millions of rows.
+
+List pages do not load receipt reports, count rows by the planner estimate once there are many of them
+and page newest first by id keysets rather than offsets, so that deep pages cost as much as the first one.
+Search looks receipts up by exact atol uuid, internal uuid or short code and by email or phone prefix,
+each served by an index (migration 0014). Actions send receipts through the pipeline in batches;
+cancellation issues refunds only once the number of receipts to refund has been typed in on a confirmation page.
+"""
+import json
+from uuid import UUID
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import Q
+from django.template.response import TemplateResponse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from django.utils.translation import gettext_lazy as _
+
+from atol.dispatch import send_report_polls
+from atol.models import Receipt, ReceiptStatus
+
+CURSOR_VAR = 'before'
+ACTION_BATCH_SIZE = 1000
+CANCEL_CONFIRMATION_VAR = 'confirm_count'
+
+
+def get_exact_count_limit():
+    """Lists estimated to have fewer rows than that are counted exactly"""
+    return getattr(settings, 'RECEIPTS_ATOL_ADMIN_EXACT_COUNT_LIMIT', 10000)
+
+
+def get_cancel_limit():
+    """Most receipts refunded by a single cancel action"""
+    return getattr(settings, 'RECEIPTS_ATOL_ADMIN_CANCEL_LIMIT', 1000)
+
+
+def estimate_count(queryset):
+    """Return the number of rows of the queryset estimated by the planner"""
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator counting large lists by the planner estimate rather than COUNT(*)"""
+    estimated = False
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate < get_exact_count_limit():
+            return self.object_list.count()
+        self.estimated = True
+        return estimate
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Change list paging receipts listed newest first by id: the next page holds the receipts
+    with ids below the last one shown. Lists sorted by a column are paged by offsets.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        try:
+            self.cursor = int(request.GET.get(CURSOR_VAR, ''))
+        except ValueError:
+            self.cursor = None
+        self.next_cursor = None
+        self.next_page_url = self.first_page_url = None
+        super(KeysetChangeList, self).__init__(request, *args, **kwargs)
+
+    @property
+    def keyset(self):
+        return ORDER_VAR not in self.params and not self.show_all
+
+    def get_filters_params(self, params=None):
+        params = super(KeysetChangeList, self).get_filters_params(params)
+        params.pop(CURSOR_VAR, None)
+        return params
+
+    def get_queryset(self, *args, **kwargs):
+        return super(KeysetChangeList, self).get_queryset(*args, **kwargs).defer('content')
+
+    def get_results(self, request):
+        if not self.keyset:
+            return super(KeysetChangeList, self).get_results(request)
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        queryset = self.queryset if self.cursor is None else self.queryset.filter(pk__lt=self.cursor)
+        result_list = list(queryset[:self.list_per_page + 1])
+        if len(result_list) > self.list_per_page:
+            result_list = result_list[:self.list_per_page]
+            self.next_cursor = result_list[-1].pk
+            self.next_page_url = self.get_query_string({CURSOR_VAR: self.next_cursor}, [PAGE_VAR])
+        if self.cursor is not None:
+            self.first_page_url = self.get_query_string(remove=[CURSOR_VAR, PAGE_VAR])
+
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = bool(self.next_page_url or self.first_page_url)
+        self.paginator = paginator
+
+
+def iter_id_batches(queryset):
+    """Yield ids of the queryset in lists of ACTION_BATCH_SIZE, paging by id rather than loading all of them"""
+    last_pk = None
+    while True:
+        batch = queryset.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        ids = list(batch.values_list('pk', flat=True)[:ACTION_BATCH_SIZE])
+        if not ids:
+            return
+        yield ids
+        last_pk = ids[-1]
+
+
+def in_batches(queryset):
+    """Split the queryset into querysets of ACTION_BATCH_SIZE receipts"""
+    for ids in iter_id_batches(queryset):
+        yield Receipt.objects.filter(pk__in=ids)
+
+
+@admin.register(Receipt)
+class ReceiptAdmin(admin.ModelAdmin):
+    list_display = ['id', 'status', 'operation', 'user_email', 'user_phone', 'purchase_price', 'created_at',
+                    'failure_reason', 'error_code', 'attempts', 'polls']
+    list_filter = ['status', 'operation', 'failure_reason']
+    ordering = ['-id']
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+    search_fields = ['uuid', 'internal_uuid', 'short_code', 'user_email', 'user_phone']
+    search_help_text = _('Идентификатор чека, внутренний идентификатор, код ссылки, начало email или телефона')
+    readonly_fields = ['internal_uuid', 'short_code', 'uuid', 'status', 'operation', 'original_receipt',
+                       'consolidated_into', 'group_code', 'created_at', 'initiated_at', 'retried_at', 'received_at',
+                       'failed_at', 'failure_reason', 'error_code', 'attempts', 'polls', 'formatted_content']
+    actions = ['replay_receipts', 'repoll_receipts', 'cancel_receipts']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        # receipts are referenced by refunds and counted by the receipt counters
+        return False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        """Exact identifiers and email/phone prefixes only, each of them served by an index"""
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+
+        lookup = Q(uuid=term) | Q(short_code=term) | Q(user_email__istartswith=term) | Q(user_phone__istartswith=term)
+        try:
+            lookup |= Q(internal_uuid=UUID(term))
+        except ValueError:
+            pass
+        return queryset.filter(lookup), False
+
+    def formatted_content(self, obj):
+        content = obj.get_content()
+        if content is None:
+            return '-'
+        return format_html('<pre>{}</pre>', json.dumps(content, indent=2, ensure_ascii=False, sort_keys=True))
+    formatted_content.short_description = _('Содержимое чека')
+
+    def replay_receipts(self, request, queryset):
+        replayed = 0
+        for batch in in_batches(queryset.failed()):
+            replayed += len(batch.bulk_replay())
+        self.message_user(request, _('Повторно отправлено чеков: %s') % replayed)
+    replay_receipts.short_description = _('Повторить регистрацию ошибочных чеков')
+
+    def repoll_receipts(self, request, queryset):
+        polled = 0
+        pending = queryset.filter(status__in=[ReceiptStatus.initiated, ReceiptStatus.retried], uuid__isnull=False)
+        for ids in iter_id_batches(pending):
+            transaction.on_commit(lambda ids=ids: send_report_polls(ids))
+            polled += len(ids)
+        self.message_user(request, _('Запрошено отчетов: %s') % polled)
+    repoll_receipts.short_description = _('Запросить отчеты инициированных чеков')
+
+    def cancel_receipts(self, request, queryset):
+        """Refund the selected received receipts once their number is confirmed, no more than the limit at once"""
+        count = queryset.cancellable().count()
+        limit = get_cancel_limit()
+        if not count:
+            self.message_user(request, _('Среди выбранных нет полученных чеков без возврата'), messages.WARNING)
+            return None
+        if count > limit:
+            self.message_user(request, _('Выбрано чеков к отмене: %(count)s, за раз можно отменить не больше %(limit)s')
+                              % {'count': count, 'limit': limit}, messages.ERROR)
+            return None
+
+        confirmation = request.POST.get(CANCEL_CONFIRMATION_VAR)
+        if request.POST.get('post') and confirmation == str(count):
+            refunds = 0
+            for batch in in_batches(queryset.cancellable()):
+                refunds += len(batch.bulk_cancel())
+            self.message_user(request, _('Создано чеков возврата: %s') % refunds)
+            return None
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_('Отмена чеков возвратом'),
+            opts=self.model._meta,
+            count=count,
+            mismatch=confirmation is not None,
+            selected=request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            select_across=request.POST.get('select_across', '0'),
+            action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+            confirmation_var=CANCEL_CONFIRMATION_VAR,
+            media=self.media,
+        )
+        request.current_app = self.admin_site.name
+        return TemplateResponse(request, 'admin/atol/receipt/cancel_confirmation.html', context)
+    cancel_receipts.short_description = _('Отменить полученные чеки возвратом')
@@ -0,0 +1,107 @@
+"""
+Admission control of receipt intake.
+
+The backlog of receipts in flight (created, initiated and retried ones, as counted by the receipt counters)
+is compared against ``RECEIPTS_ATOL_ADMISSION_HIGH_WATERMARK``. Once it is reached, receipts being dispatched
+are saved in the held status instead, so that neither the broker nor the ETA queues of the workers grow
+without bound while atol is slow. Intake stays closed until the backlog falls to
+``RECEIPTS_ATOL_ADMISSION_LOW_WATERMARK``, while the ``atol_release_held_receipts`` task releases held receipts,
+oldest first, into the room the pipeline has made under the high watermark since its previous run.
+"""
+import logging
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from atol.counters import get_status_counts
+
+logger = logging.getLogger(__name__)
+
+BACKLOG_STATUSES = ['created', 'initiated', 'retried']
+BACKLOG_CACHE_KEY = 'atol_admission:backlog'
+CLOSED_CACHE_KEY = 'atol_admission:closed'
+
+
+def get_watermarks():
+    """
+    :return: (high, low) watermarks, high is None if admission control is off
+    """
+    high = getattr(settings, 'RECEIPTS_ATOL_ADMISSION_HIGH_WATERMARK', None)
+    if high is None:
+        return None, None
+    low = getattr(settings, 'RECEIPTS_ATOL_ADMISSION_LOW_WATERMARK', None)
+    return high, high // 2 if low is None else low
+
+
+def get_backlog(fresh=False):
+    """Return the number of receipts in flight, cached for RECEIPTS_ATOL_ADMISSION_CACHE_TIMEOUT seconds"""
+    backlog = None if fresh else cache.get(BACKLOG_CACHE_KEY)
+    if backlog is None:
+        counts = get_status_counts()
+        backlog = sum(counts.get(status, 0) for status in BACKLOG_STATUSES)
+        cache.set(BACKLOG_CACHE_KEY, backlog, getattr(settings, 'RECEIPTS_ATOL_ADMISSION_CACHE_TIMEOUT', 5))
+    return backlog
+
+
+def admit(count=1, using=None):
+    """
+    Tell how many of the receipts may be dispatched to atol right away, the rest are to be held: intake closes
+    at the high watermark and opens again at the low one, no more receipts are admitted than there is room for
+    under the high watermark. Admitted receipts are added to the cached backlog once the transaction commits.
+
+    :param count: number of receipts about to be dispatched
+    :param using: database alias of the transaction the receipts are dispatched in
+    :return: number of admitted receipts, all of them if admission control is off
+    """
+    high, low = get_watermarks()
+    if high is None:
+        return count
+
+    backlog = get_backlog()
+    closed = cache.get(CLOSED_CACHE_KEY, False)
+    if not closed and backlog >= high:
+        logger.warning('receipt backlog of %s reached the high watermark %s, holding receipts', backlog, high)
+        cache.set(CLOSED_CACHE_KEY, True, timeout=None)
+        closed = True
+    elif closed and backlog <= low:
+        logger.info('receipt backlog of %s fell to the low watermark %s, dispatching receipts', backlog, low)
+        cache.set(CLOSED_CACHE_KEY, False, timeout=None)
+        closed = False
+
+    if closed:
+        return 0
+    admitted = min(count, high - backlog)
+    # receipts of a rolled back transaction are not in flight
+    transaction.on_commit(lambda: add_to_backlog(admitted), using=using)
+    return admitted
+
+
+def add_to_backlog(count):
+    try:
+        cache.incr(BACKLOG_CACHE_KEY, count)
+    except ValueError:  # expired meanwhile
+        pass
+
+
+def release_held_receipts():
+    """
+    Release the oldest held receipts into the room under the high watermark, all of them if admission
+    control is off, no more than RECEIPTS_ATOL_ADMISSION_RELEASE_LIMIT at once
+
+    :return: list of released receipts
+    """
+    Receipt = apps.get_model('atol', 'Receipt')
+    high, _ = get_watermarks()
+    limit = getattr(settings, 'RECEIPTS_ATOL_ADMISSION_RELEASE_LIMIT', None) or 1000
+    if high is not None:
+        limit = min(limit, high - get_backlog(fresh=True))
+    if limit <= 0:
+        return []
+
+    ids = list(Receipt.objects.held().order_by('created_at').values_list('id', flat=True)[:limit])
+    released = Receipt.objects.filter(id__in=ids).bulk_release() if ids else []
+    if released and high is not None:
+        add_to_backlog(len(released))
+    return released
@@ -0,0 +1,115 @@
+"""
+Views for ASGI deployments built on the async ORM and cache API (Django >= 4.1).
+
+Kept apart from atol.views, so that projects on older Django and Python versions could import the sync views.
+"""
+import logging
+
+import django
+from django.core.exceptions import ImproperlyConfigured
+
+if django.VERSION < (4, 1):
+    raise ImproperlyConfigured('atol.async_views requires Django >= 4.1')
+
+from asgiref.sync import sync_to_async  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.http import Http404, HttpResponseNotFound, HttpResponseRedirect  # noqa: E402
+from django.utils.encoding import force_bytes  # noqa: E402
+from django.utils.translation import gettext_lazy as _  # noqa: E402
+from django.views.generic import View  # noqa: E402
+
+from atol.exceptions import MissingReceipt  # noqa: E402
+from atol.links import (MISSING, get_link_receipts, get_ofd_url, get_signed_token_ofd_url,  # noqa: E402
+                        is_signed_token, is_stale, link_cache, pick_link_receipt)
+from atol.models import Receipt, ReceiptStatus  # noqa: E402
+from atol.routing import get_read_database, get_write_database  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+async def aget_link_receipt(short_uuid):
+    """Async atol.links.get_link_receipt"""
+    using = await sync_to_async(get_read_database)(Receipt)
+    primary = get_write_database(Receipt)
+    receipts = []
+    async for receipt in get_link_receipts(short_uuid, using):
+        receipts.append(receipt)
+    receipt = pick_link_receipt(receipts, short_uuid)
+    if is_stale(receipt, using, primary):
+        receipts = []
+        async for receipt in get_link_receipts(short_uuid, primary):
+            receipts.append(receipt)
+        receipt = pick_link_receipt(receipts, short_uuid)
+    return receipt
+
+
+async def aget_cached_ofd_url(short_uuid):
+    """Async link_cache.get"""
+    if not link_cache.timeout:
+        return None
+
+    key = link_cache.get_key(short_uuid)
+    ofd_url = link_cache.local.get(key)
+    if ofd_url is None:
+        ofd_url = await cache.aget(key)
+        if ofd_url is not None:
+            timeout = link_cache.missing_timeout if ofd_url == MISSING else link_cache.timeout
+            link_cache.local.set(key, ofd_url, timeout)
+    return ofd_url
+
+
+async def aset_cached_ofd_url(short_uuid, ofd_url, timeout=None):
+    """Async link_cache.set"""
+    timeout = link_cache.timeout if timeout is None else timeout
+    if not link_cache.timeout or not timeout:
+        return
+    key = link_cache.get_key(short_uuid)
+    link_cache.local.set(key, ofd_url, timeout)
+    await cache.aset(key, ofd_url, timeout)
+
+
+class AsyncReceiptView(View):
+    """
+    ReceiptView for ASGI deployments built on the async ORM and cache API (Django >= 4.1)
+    """
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            ofd_url = await self.get_redirect_url(*args, **kwargs)
+        except MissingReceipt:
+            return HttpResponseNotFound(content=force_bytes(_('Чек не найден')))
+        except (KeyError, TypeError, ValueError) as exc:
+            logger.error('invalid receipt format: %s', exc, exc_info=True)
+            return HttpResponseNotFound(content=force_bytes(_('Чек не найден')))  # do not face 500 to user
+        return HttpResponseRedirect(ofd_url)
+
+    async def get_redirect_url(self, *args, **kwargs):
+        short_uuid = kwargs['short_uuid']
+
+        if is_signed_token(short_uuid):
+            return get_signed_token_ofd_url(short_uuid)
+
+        ofd_url = await aget_cached_ofd_url(short_uuid)
+        if ofd_url == MISSING:
+            raise MissingReceipt()
+        if ofd_url is not None:
+            return ofd_url
+
+        try:
+            ofd_url = await self.resolve_ofd_url(short_uuid)
+        except (MissingReceipt, Http404):
+            await aset_cached_ofd_url(short_uuid, MISSING, link_cache.missing_timeout)
+            raise
+
+        await aset_cached_ofd_url(short_uuid, ofd_url)
+        return ofd_url
+
+    async def resolve_ofd_url(self, short_uuid):
+        receipt = await aget_link_receipt(short_uuid)
+        if receipt is None:
+            raise Http404('No receipt matches the given query.')
+
+        if receipt.fn_number is None and receipt.status == ReceiptStatus.received:
+            # receipts yet to be backfilled load their content, which must not be done in the event loop
+            return await sync_to_async(get_ofd_url)(receipt)
+        return get_ofd_url(receipt)
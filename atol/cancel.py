@@ -0,0 +1,110 @@
+"""
+Bulk cancellation of received receipts.
+
+Refund receipts (sell_refund) are persisted first, then registered in atol by a bounded thread pool
+under a rate limit, which only makes http requests, while the outcomes are applied by the calling thread
+with bulk transitions. Registered refunds have their reports polled by the pipeline tasks, like sells.
+"""
+import logging
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+from django.db.models import F
+
+from atol.core import NewReceipt
+from atol.exceptions import AtolException, AtolPrepRequestException, AtolUnrecoverableError
+from atol.models import FailureReason, Receipt, ReceiptOperation, ReceiptStatus
+from atol.tasks import atol_create_receipt, atol_receive_receipt_report
+
+logger = logging.getLogger(__name__)
+
+
+def get_pending_refunds(originals):
+    """Return refunds of the receipts which have not been sent to atol yet, retried ones are left to the tasks"""
+    return (Receipt.objects
+            .filter(operation=ReceiptOperation.sell_refund, original_receipt__in=originals,
+                    status=ReceiptStatus.created, attempts=0)
+            .select_related('original_receipt').defer('original_receipt__content')
+            .order_by('id'))
+
+
+def build_params(refunds):
+    """
+    Build sell_refund params of the refunds out of the fiscal attributes of their original receipts
+
+    :return: list of (refund, params or exception) pairs
+    """
+    results = []
+    for refund in refunds:
+        try:
+            results.append((refund, refund.get_params()))
+        except (KeyError, TypeError, ValueError) as exc:
+            logger.warning('unable to build refund params of receipt %s due to %s',
+                           refund.original_receipt_id, exc, exc_info=True)
+            results.append((refund, AtolPrepRequestException(str(exc))))
+    return results
+
+
+def post_refunds(atol, refund_params, workers, limiter):
+    """
+    Register the refunds in atol concurrently
+
+    :param atol: AtolAPI instance
+    :param refund_params: list of (refund, params) pairs
+    :param limiter: RateLimiter shared by the workers
+    :return: list of (refund, NewReceipt or AtolException) pairs in the given order
+    """
+    def post(item):
+        refund, params = item
+        limiter.wait()
+        try:
+            return refund, atol.sell_refund(**params)
+        except AtolException as exc:
+            return refund, exc
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(post, refund_params))
+
+
+def apply_refunds(results):
+    """
+    Apply the outcomes of refund registrations with bulk transitions: registered refunds are initiated
+    and their reports are polled, malformed and rejected ones are failed with the reason and error code,
+    the rest are left to atol_create_receipt retries.
+
+    :param results: list of (refund, NewReceipt or exception) pairs
+    :return: Counter of outcomes
+    """
+    stats = Counter()
+    uuids, failed, retried = {}, defaultdict(list), []
+    for refund, result in results:
+        if isinstance(result, NewReceipt):
+            uuids[refund.id] = result.uuid
+        elif isinstance(result, AtolPrepRequestException):
+            failed[(FailureReason.invalid, None)].append(refund.id)
+        elif isinstance(result, AtolUnrecoverableError):
+            failed[(FailureReason.rejected, result.error_code)].append(refund.id)
+        else:
+            retried.append(refund.id)
+
+    posted = [refund.id for refund, result in results if not isinstance(result, AtolPrepRequestException)]
+    Receipt.objects.filter(id__in=posted).update(attempts=F('attempts') + 1)
+
+    pending = Receipt.objects.filter(status=ReceiptStatus.created)
+    with transaction.atomic():
+        initiated = pending.bulk_initiate(uuids) if uuids else []
+        for refund in initiated:
+            transaction.on_commit(
+                lambda refund_id=refund.id: atol_receive_receipt_report.apply_async(args=(refund_id,), countdown=60)
+            )
+    stats['initiated'] += len(initiated)
+
+    for (reason, error_code), ids in failed.items():
+        declared = pending.filter(id__in=ids).bulk_declare_failed(reason=reason, error_code=error_code)
+        stats['failed'] += len(declared)
+
+    for refund_id in retried:
+        atol_create_receipt.apply_async(args=(refund_id,), countdown=60)
+    stats['retried'] += len(retried)
+    return stats
@@ -0,0 +1,78 @@
+"""
+Consolidation of purchases into multi-item receipts.
+
+With ``RECEIPTS_ATOL_CONSOLIDATION_WINDOW`` seconds set, receipts are dispatched to atol once the window
+has passed, and a receipt about to be registered takes in the pending purchases of the same customer
+created within the window after it. The merged purchases wait in the consolidated status pointing to
+the registered receipt and are received along with it, so that each of them keeps its own link.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+
+from atol.counters import count_transitions
+from atol.models import Receipt, ReceiptOperation, ReceiptStatus, invalidate_statuses
+from atol.routing import get_write_database
+
+logger = logging.getLogger(__name__)
+
+
+def get_consolidation_window():
+    return getattr(settings, 'RECEIPTS_ATOL_CONSOLIDATION_WINDOW', None)
+
+
+def get_max_items():
+    # atol accepts up to 100 items per receipt
+    return min(getattr(settings, 'RECEIPTS_ATOL_CONSOLIDATION_MAX_ITEMS', None) or 10, 100)
+
+
+def consolidate_receipt(receipt):
+    """
+    Merge pending purchases of the customer created within the window after the receipt into it.
+    Purchases being registered by concurrent tasks are skipped rather than waited for.
+
+    :return: list of merged receipts, the receipt status is refreshed in case it has been merged itself
+    """
+    window = get_consolidation_window()
+    if not window or receipt.operation != ReceiptOperation.sell or receipt.status != ReceiptStatus.created:
+        return []
+    if not (receipt.user_email or receipt.user_phone):
+        return []
+
+    using = get_write_database(Receipt)
+    with transaction.atomic(using=using):
+        locked = (Receipt.objects.using(using).select_for_update()
+                  .filter(pk=receipt.pk).values('status', 'consolidated_into_id', 'attempts').first())
+        if not locked or locked['status'] != ReceiptStatus.created:
+            receipt.status = locked['status'] if locked else receipt.status
+            return []
+        # atol may have accepted the purchases sent by an earlier attempt already
+        if locked['consolidated_into_id'] or locked['attempts']:
+            return []
+
+        members = list(Receipt.objects.using(using)
+                       .select_for_update(skip_locked=True)
+                       .filter(status=ReceiptStatus.created, operation=ReceiptOperation.sell,
+                               user_email=receipt.user_email, user_phone=receipt.user_phone,
+                               created_at__gte=receipt.created_at,
+                               created_at__lte=receipt.created_at + timedelta(seconds=window),
+                               purchase_price__isnull=False, consolidated_into__isnull=True, attempts=0)
+                       .exclude(pk=receipt.pk)
+                       .order_by('created_at', 'id')[:get_max_items() - 1])
+        if not members:
+            return []
+
+        transitions = [(member, member.status) for member in members]
+        for member in members:
+            member.status = ReceiptStatus.consolidated
+        (Receipt.objects.using(using).filter(pk__in=[member.pk for member in members])
+         .update(status=ReceiptStatus.consolidated, consolidated_into=receipt.pk))
+        Receipt.objects.using(using).filter(pk=receipt.pk).update(consolidated_into=receipt.pk)
+        receipt.consolidated_into_id = receipt.pk
+        count_transitions(transitions, using=using)
+        invalidate_statuses(members, using=using)
+
+    logger.info('consolidated %s receipts into receipt %s', len(members), receipt.id)
+    return members
@@ -1,6 +1,8 @@
+import json as jsonlib
 import logging
 import requests
 from collections import namedtuple
+from decimal import Decimal
 from dateutil.parser import parse as parse_date
 
 from django.conf import settings
@@ -9,6 +11,10 @@ from django.utils.translation import gettext_lazy as _
 from model_utils import Choices
 
 from atol import exceptions
+from atol.health import record_token_obtained, track_request
+from atol.hedging import get_hedger
+from atol.instrumentation import phase, record_call, record_size
+from atol.validation import validate_registration_data
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +71,7 @@ class AtolAPI(object):
             auth_token = self._obtain_new_token()
             # cache the key forever without a ttl
             cache.set(cache_key, auth_token)
+            record_token_obtained()
         else:
             logger.debug('successfully obtained auth token "%s" for login "%s" from cache',
                          auth_token, settings.RECEIPTS_ATOL_LOGIN)
@@ -84,24 +91,27 @@ class AtolAPI(object):
         The final url will assume the following form:
             https://online.atol.ru/possystem/v3/MyCompany_MyShop/sell?tokenid=d8c7021934fg4f2384ebf6b72624bbbf
         """
-        auth_token = self._get_auth_token()
+        with record_call('atol_request', method=method, endpoint=endpoint), track_request():
+            with phase('token'):
+                auth_token = self._get_auth_token()
 
-        headers = {
-            'Token': auth_token
-        }
+            headers = {
+                'Token': auth_token
+            }
 
-        # signed requests contain group codes in front of the endpoint name
-        endpoint = '{group_code}/{endpoint}'.format(group_code=settings.RECEIPTS_ATOL_GROUP_CODE,
-                                                    endpoint=endpoint)
+            # signed requests contain group codes in front of the endpoint name
+            endpoint = '{group_code}/{endpoint}'.format(group_code=settings.RECEIPTS_ATOL_GROUP_CODE,
+                                                        endpoint=endpoint)
 
-        try:
-            return self._request(method, endpoint, headers=headers, json=json)
-        except exceptions.AtolAuthTokenException:
-            # token must have expired, try new one
-            logger.info('trying new token for request "%s" to endpoint %s with headers=%s json=%s',
-                        method, endpoint, headers, json)
-            headers.update({'Token': self._get_auth_token(force_renew=True)})
-            return self._request(method, endpoint, headers=headers, json=json)
+            try:
+                return self._request(method, endpoint, headers=headers, json=json)
+            except exceptions.AtolAuthTokenException:
+                # token must have expired, try new one
+                logger.info('trying new token for request "%s" to endpoint %s with headers=%s json=%s',
+                            method, endpoint, headers, json)
+                with phase('token'):
+                    headers.update({'Token': self._get_auth_token(force_renew=True)})
+                return self._request(method, endpoint, headers=headers, json=json)
 
     def _request(self, method, endpoint, params=None, headers=None, json=None):
         params = params or {}
@@ -113,9 +123,15 @@ class AtolAPI(object):
 
         logger.info('about to %s %s with headers=%s, params=%s json=%s', method, url, headers, params, json)
 
+        # encoded here rather than by requests to time it and measure the payload
+        with phase('encode'):
+            data = jsonlib.dumps(json).encode('utf-8') if json is not None else None
+        record_size('request_bytes', len(data) if data is not None else 0)
+
         try:
-            response = requests.request(method, url, params=params, json=json,
-                                        headers=headers, timeout=self.request_timeout)
+            with phase('http'):
+                response = requests.request(method, url, params=params, data=data,
+                                            headers=headers, timeout=self.request_timeout)
         except Exception as exc:
             logger.warning('failed to request %s %s with headers=%s, params=%s json=%s due to %s',
                            method, url, headers, params, json, exc,
@@ -136,8 +152,10 @@ class AtolAPI(object):
                         method, url, headers, params, json, extra={'data': {'content': response.content}})
             raise exceptions.AtolAuthTokenException()
 
+        record_size('response_bytes', len(response.content))
         try:
-            response_data = response.json()
+            with phase('decode'):
+                response_data = response.json()
         except Exception as exc:
             logger.warning('unable to parse json response due to %s', exc, exc_info=True,
                            extra={'data': {'content': response.content}})
@@ -161,6 +179,13 @@ class AtolAPI(object):
             client['phone'] = phone
         return client
 
+    @staticmethod
+    def _format_amount(amount):
+        # convert decimals and strings to float, because atol does not accept those types
+        if not isinstance(amount, int):
+            amount = float(amount)
+        return amount
+
     def get_registration_data(self, params):
         """
         :param timestamp: Payment datetime
@@ -168,6 +193,8 @@ class AtolAPI(object):
                                  uuid4 should do fine.
         :param purchase_name: Human readable name of the purchased product
         :param purchase_price: The amount in roubles the user was billed with
+        :param items: Optional list of dicts with name and price of each purchase of a consolidated receipt,
+                      overrides purchase_name and purchase_price
         :param user_email: User supplied email
         :param user_phone: User supplied phone (may or may not start with +7)
         """
@@ -176,10 +203,12 @@ class AtolAPI(object):
         # receipt must contain either of the two
         if not (user_email or user_phone):
             raise exceptions.AtolPrepRequestException()
-        purchase_price = params['purchase_price']
-        # convert decimals and strings to float, because atol does not accept those types
-        if not isinstance(purchase_price, int):
-            purchase_price = float(purchase_price)
+        purchases = params.get('items') or [{'name': params['purchase_name'], 'price': params['purchase_price']}]
+        if len(purchases) == 1:
+            purchase_price = self._format_amount(purchases[0]['price'])
+        else:
+            # sum up exact amounts not to introduce float rounding errors into the total
+            purchase_price = self._format_amount(sum(Decimal(str(purchase['price'])) for purchase in purchases))
         timestamp = params['timestamp']
         if isinstance(timestamp, str):
             timestamp = parse_date(timestamp)
@@ -199,16 +228,17 @@ class AtolAPI(object):
                     'payment_address': settings.RECEIPTS_ATOL_PAYMENT_ADDRESS,
                 },
                 'items': [{
-                    'name': params['purchase_name'],
-                    'price': purchase_price,
+                    # nameless purchases are named as in Receipt.get_params
+                    'name': purchase['name'] or 'Оплата подписки',
+                    'price': self._format_amount(purchase['price']),
                     'quantity': 1,
-                    'sum': purchase_price,
+                    'sum': self._format_amount(purchase['price']),
                     'payment_method': settings.RECEIPTS_ATOL_PAYMENT_METHOD,
                     'payment_object': settings.RECEIPTS_ATOL_PAYMENT_OBJECT,
                     'vat': {
                         'type': settings.RECEIPTS_ATOL_TAX_NAME,
                     },
-                }],
+                } for purchase in purchases],
                 'payments': [{
                     'sum': purchase_price,
                     'type': payment_type,
@@ -226,18 +256,25 @@ class AtolAPI(object):
         return request_data
 
     def _register_new_receipt(self, method_name, request_data):
+        try:
+            validate_registration_data(request_data)
+        except exceptions.AtolValidationError as exc:
+            logger.warning('%s request with json %s is invalid: %s', method_name, request_data, exc,
+                           extra={'data': {'json': request_data}})
+            raise
+
         try:
             response_data = self.request('post', method_name, json=request_data)
         except exceptions.AtolClientRequestException as exc:
             logger.info('%s request with json %s failed with code %s',
                         method_name, request_data, exc.error_data['code'])
             if exc.error_data['code'] in (self.ErrorCode.VALIDATION_ERROR, self.ErrorCode.BAD_REQUEST):
-                raise exceptions.AtolRecoverableError()
+                raise exceptions.AtolRecoverableError(error_code=exc.error_data['code'])
             if exc.error_data['code'] == self.ErrorCode.ALREADY_EXISTS:
                 logger.info('%s request with json %s already accepted; uuid: %s',
                             method_name, request_data, exc.response_data['uuid'])
                 return NewReceipt(uuid=exc.response_data['uuid'], data=exc.response_data)
-            raise exceptions.AtolUnrecoverableError()
+            raise exceptions.AtolUnrecoverableError(error_code=exc.error_data['code'])
         except Exception as exc:
             logger.warning('%s request with json %s failed due to %s', method_name, request_data, exc, exc_info=True)
             raise exceptions.AtolRecoverableError()
@@ -264,23 +301,30 @@ class AtolAPI(object):
         """
         The receipt may not yet be processed by the time of the request,
         the calling code should try this method again later.
+        Slow requests are hedged if RECEIPTS_ATOL_HEDGE_REPORTS is set, see atol.hedging.
 
         :param receipt_uuid: Receipt identifier previously returned by atol
         """
+        endpoint = 'report/{uuid}'.format(uuid=receipt_uuid)
+        hedger = get_hedger()
         try:
-            response_data = self.request('get', 'report/{uuid}'.format(uuid=receipt_uuid))
+            if hedger:
+                response_data = hedger.call(self.request, 'get', endpoint)
+            else:
+                response_data = self.request('get', endpoint)
         # check for recoverable errors
         except exceptions.AtolClientRequestException as exc:
             logger.info('report request for receipt %s failed with code %s', receipt_uuid, exc.error_data['code'])
             if exc.error_data['code'] in (self.ErrorCode.STATE_CHECK_NOT_FOUND, self.ErrorCode.BAD_REQUEST):
-                raise exceptions.AtolRecoverableError()
+                raise exceptions.AtolRecoverableError(error_code=exc.error_data['code'])
             if exc.error_data['code'] == self.ErrorCode.PROCESSING_FAILED:
                 logger.info('report request for receipt %s was not processed: %s; '
                             'Must repeat the request with a new unique value <external_id>',
                             receipt_uuid, exc.response_data.get('text'))
-                raise exceptions.AtolReceiptNotProcessed(exc.response_data.get('text'))
+                raise exceptions.AtolReceiptNotProcessed(exc.response_data.get('text'),
+                                                         error_code=exc.error_data['code'])
             # the rest of the errors are not recoverable
-            raise exceptions.AtolUnrecoverableError()
+            raise exceptions.AtolUnrecoverableError(error_code=exc.error_data['code'])
         except Exception as exc:
             logger.info('report request for receipt %s failed due to %s', receipt_uuid, exc)
             raise exceptions.AtolRecoverableError()
@@ -0,0 +1,151 @@
+"""
+Per day and status receipt counters kept up to date by receipt transitions.
+
+Transitions add their deltas to the counters in the same transaction, so that backlogs and dashboards
+are served by a tiny summary table instead of COUNT(*) over the receipt table. Each day and status
+has several counter rows (shards) picked at random, so that concurrent transitions do not queue up
+on a single row lock; reads sum the shards up.
+"""
+import datetime
+import logging
+import random
+from collections import Counter, OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from atol.utils import start_of_day
+
+logger = logging.getLogger(__name__)
+
+COUNTER_TABLE = 'atol_receiptcounter'
+
+
+def get_shards():
+    return getattr(settings, 'RECEIPTS_ATOL_COUNTER_SHARDS', None) or 8
+
+
+def get_receipt_day(receipt):
+    created_at = receipt.created_at or timezone.now()
+    if settings.USE_TZ and timezone.is_aware(created_at):
+        created_at = timezone.localtime(created_at)
+    return created_at.date()
+
+
+def count_transitions(transitions, using=None):
+    """
+    Add receipt transitions to the counters
+
+    :param transitions: iterable of (receipt, previous status) pairs, previous status is None for new receipts
+    :param using: database alias the transitions have been written to
+    """
+    deltas = Counter()
+    for receipt, previous_status in transitions:
+        if previous_status == receipt.status:
+            continue
+        day = get_receipt_day(receipt)
+        deltas[(day, receipt.status)] += 1
+        if previous_status is not None:
+            deltas[(day, previous_status)] -= 1
+    add_deltas(deltas, using=using)
+
+
+def add_deltas(deltas, using=None):
+    """
+    :param deltas: mapping of (day, status) to the number of receipts to add
+    """
+    # rows are locked in the same order by everyone not to deadlock
+    rows = sorted((key, delta) for key, delta in deltas.items() if delta)
+    if not rows:
+        return
+
+    shard = random.randrange(get_shards())
+    params = []
+    for (day, status), delta in rows:
+        params += [day, status, shard, delta]
+    sql = (
+        'INSERT INTO {table} (day, status, shard, count) VALUES {values} '
+        'ON CONFLICT (day, status, shard) DO UPDATE SET count = {table}.count + EXCLUDED.count'
+    ).format(table=COUNTER_TABLE, values=', '.join(['(%s, %s, %s, %s)'] * len(rows)))
+
+    using = using or router.db_for_write(apps.get_model('atol', 'ReceiptCounter'))
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def _filter_days(queryset, day_from, day_to):
+    if day_from:
+        queryset = queryset.filter(day__gte=day_from)
+    if day_to:
+        queryset = queryset.filter(day__lte=day_to)
+    return queryset
+
+
+def get_status_counts(day_from=None, day_to=None):
+    """
+    Return the number of receipts per status created within the days (inclusive), all time by default
+    """
+    counters = _filter_days(apps.get_model('atol', 'ReceiptCounter').objects.all(), day_from, day_to)
+    rows = counters.order_by().values('status').annotate(total=Sum('count')).values_list('status', 'total')
+    return {status: total for status, total in rows if total}
+
+
+def get_daily_counts(day_from=None, day_to=None):
+    """
+    Return OrderedDict of day to the number of receipts per status created on that day
+    """
+    counters = _filter_days(apps.get_model('atol', 'ReceiptCounter').objects.all(), day_from, day_to)
+    rows = (counters.order_by('day').values('day', 'status').annotate(total=Sum('count'))
+            .values_list('day', 'status', 'total'))
+
+    daily = OrderedDict()
+    for day, status, total in rows:
+        if total:
+            daily.setdefault(day, {})[status] = total
+    return daily
+
+
+def reconcile_counters(day_from=None, day_to=None):
+    """
+    Fix the drift of counters of the days (inclusive) against the actual number of receipts.
+
+    Both are read within a single repeatable read snapshot and the difference is added as a delta,
+    so that transitions made meanwhile are neither lost nor counted twice. Must not be called
+    inside a transaction.
+
+    :return: dict of (day, status) to the fixed drift
+    """
+    Receipt = apps.get_model('atol', 'Receipt')
+    ReceiptCounter = apps.get_model('atol', 'ReceiptCounter')
+    using = router.db_for_write(ReceiptCounter)
+
+    receipts = Receipt.objects.using(using).order_by()
+    if day_from:
+        receipts = receipts.filter(created_at__gte=start_of_day(day_from))
+    if day_to:
+        receipts = receipts.filter(created_at__lt=start_of_day(day_to + datetime.timedelta(days=1)))
+
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        actual = Counter({
+            (day, status): count for day, status, count in
+            receipts.annotate(day=TruncDate('created_at')).values('day', 'status')
+                    .annotate(count=Count('id')).values_list('day', 'status', 'count')
+        })
+        counted = Counter({
+            (day, status): total for day, status, total in
+            _filter_days(ReceiptCounter.objects.using(using), day_from, day_to).order_by()
+            .values('day', 'status').annotate(total=Sum('count')).values_list('day', 'status', 'total')
+        })
+
+    drift = {key: actual[key] - counted[key] for key in set(actual) | set(counted) if actual[key] != counted[key]}
+    if drift:
+        logger.warning('receipt counters drifted by %s receipts in %s day/status pairs',
+                       sum(abs(delta) for delta in drift.values()), len(drift))
+        add_deltas(drift, using=using)
+    return drift
@@ -0,0 +1,123 @@
+"""
+Batched dispatch of receipts to the atol_create_receipt pipeline.
+
+Receipts scheduled within one transaction are collected into batches per savepoint,
+which are sent to the broker together in chunks on commit
+instead of a callback (and a broker round trip) per receipt.
+"""
+import itertools
+import logging
+import threading
+import weakref
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def get_chunk_size():
+    return getattr(settings, 'RECEIPTS_ATOL_DISPATCH_CHUNK_SIZE', None) or 100
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class ReceiptBatch(object):
+    """
+    Receipts scheduled within a savepoint (or outside any), sent by an on_commit hook.
+
+    The hook is the only strong reference to its batch, so the batch is gone along with the hook once the
+    transaction is rolled back, or the savepoint the batch was created in is. The first batch of a committed
+    transaction to run sends the receipts of all the batches left alive.
+    """
+    creation_counter = itertools.count()
+
+    def __init__(self, using, savepoint_ids):
+        self.using = using
+        self.savepoint_ids = savepoint_ids
+        self.order = next(self.creation_counter)
+        self.receipt_ids = []
+
+    def __call__(self):
+        batches = _get_batches()
+        pending = sorted((batch for key, batch in list(batches.items()) if key[0] == self.using),
+                         key=lambda batch: batch.order)
+        receipt_ids = []
+        for batch in pending:
+            batches.pop((batch.using, batch.savepoint_ids), None)
+            receipt_ids.extend(batch.receipt_ids)
+        send_receipts(receipt_ids)
+
+
+def send_receipts(receipt_ids):
+    """
+    Publish receipt ids in chunks to atol_create_receipts using a single broker connection
+    """
+    from atol.tasks import atol_create_receipts
+
+    receipt_ids = list(receipt_ids)
+    if not receipt_ids:
+        return
+
+    chunk_size = get_chunk_size()
+    # let the purchases made within the consolidation window in, see atol.consolidation
+    countdown = getattr(settings, 'RECEIPTS_ATOL_CONSOLIDATION_WINDOW', None) or None
+    logger.info('dispatching %s receipts in chunks of %s', len(receipt_ids), chunk_size)
+
+    with atol_create_receipts.app.producer_or_acquire() as producer:
+        for chunk in chunked(receipt_ids, chunk_size):
+            atol_create_receipts.apply_async(args=(chunk,), producer=producer, countdown=countdown)
+
+
+def send_report_polls(receipt_ids):
+    """
+    Publish atol_receive_receipt_report for each of the receipts using a single broker connection
+    """
+    from atol.tasks import atol_receive_receipt_report
+
+    receipt_ids = list(receipt_ids)
+    logger.info('polling reports of %s receipts', len(receipt_ids))
+    with atol_receive_receipt_report.app.producer_or_acquire() as producer:
+        for receipt_id in receipt_ids:
+            atol_receive_receipt_report.apply_async(args=(receipt_id,), producer=producer)
+
+
+def _get_batches():
+    batches = getattr(_local, 'batches', None)
+    if batches is None:
+        batches = _local.batches = weakref.WeakValueDictionary()
+    return batches
+
+
+def _get_pending_batch(connection, using):
+    batches = _get_batches()
+    # blocks entered with savepoint=False have no savepoint of their own to be rolled back to
+    savepoint_ids = tuple(sid for sid in connection.savepoint_ids if sid is not None)
+    batch = batches.get((using, savepoint_ids))
+    if batch is None:
+        batch = batches[(using, savepoint_ids)] = ReceiptBatch(using, savepoint_ids)
+        transaction.on_commit(batch, using=using)
+    return batch
+
+
+def schedule_receipts(receipt_ids, using=None):
+    """
+    Enqueue receipt registration in atol once the current transaction commits.
+    Outside a transaction the receipts are sent right away.
+
+    :param receipt_ids: Iterable of Receipt primary keys
+    :param using: Database alias the receipts were saved to
+    """
+    using = using or DEFAULT_DB_ALIAS
+    connection = transaction.get_connection(using)
+
+    if not connection.in_atomic_block:
+        send_receipts(receipt_ids)
+        return
+
+    _get_pending_batch(connection, using).receipt_ids.extend(receipt_ids)
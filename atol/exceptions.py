@@ -7,7 +7,13 @@ class MissingReceipt(Exception):
 
 
 class AtolException(Exception):
-    pass
+    """
+    :param error_code: code of the atol error the exception is caused by, if any
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.error_code = kwargs.pop('error_code', None)
+        super(AtolException, self).__init__(*args, **kwargs)
 
 
 class AtolPrepRequestException(AtolException):
@@ -15,6 +21,15 @@ class AtolPrepRequestException(AtolException):
     pass
 
 
+class AtolValidationError(AtolPrepRequestException):
+    """Raised client side when the request data does not conform to the atol schema"""
+
+    def __init__(self, path, message):
+        self.path = path
+        self.message = message
+        super(AtolValidationError, self).__init__('{}: {}'.format(path or '<root>', message))
+
+
 class AtolRequestException(AtolException):
     """Raised when atol request fails in the middle, or the endpoint returns unexpected response"""
     pass
@@ -0,0 +1,98 @@
+"""
+Streaming export of receipts with their fiscal attributes for accounting.
+
+Rows are read with a server-side cursor selecting only the exported columns,
+and written out one by one, so that exports of any size run in constant memory.
+"""
+import csv
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    from django.db.models.fields.json import KeyTextTransform, KeyTransform
+except ImportError:  # Django < 3.1
+    from django.contrib.postgres.fields.jsonb import KeyTextTransform, KeyTransform
+
+from atol.models import FISCAL_FIELDS, Receipt
+from atol.utils import start_of_day
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+EXPORT_FIELDS = ['id', 'internal_uuid', 'uuid', 'status', 'operation', 'original_receipt_id', 'created_at',
+                 'received_at', 'user_email', 'user_phone', 'purchase_price', 'purchase_name'] + FISCAL_FIELDS
+
+# attributes which are read from the report with JSON paths rather than loading it whole
+EXPORT_CONTENT_FIELDS = ['ecr_registration_number', 'fns_site']
+
+# leading characters which make spreadsheets evaluate a cell as a formula
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+ITERATOR_CHUNK_SIZE = 2000
+
+
+def get_export_queryset(date_from=None, date_to=None, statuses=None):
+    """
+    Return the rows to export as dicts
+
+    :param date_from: first day of receipts creation to export
+    :param date_to: last day of receipts creation to export, inclusive
+    :param statuses: list of receipt statuses to export, all by default
+    """
+    receipts = Receipt.objects.order_by('id')
+    if date_from:
+        receipts = receipts.filter(created_at__gte=start_of_day(date_from))
+    if date_to:
+        receipts = receipts.filter(created_at__lt=start_of_day(date_to + datetime.timedelta(days=1)))
+    if statuses:
+        receipts = receipts.filter(status__in=statuses)
+
+    payload = KeyTransform('payload', 'content')
+    receipts = receipts.annotate(**{field: KeyTextTransform(field, payload) for field in EXPORT_CONTENT_FIELDS})
+    return receipts.values(*(EXPORT_FIELDS + EXPORT_CONTENT_FIELDS))
+
+
+class _Echo(object):
+    """File-like object returning what is written to it, to let csv.writer produce lines one by one"""
+
+    def write(self, value):
+        return value
+
+
+def iter_export(queryset, export_format):
+    """
+    Yield export lines of the queryset rows, reading them with a server-side cursor
+    """
+    try:
+        rows = queryset.iterator(chunk_size=ITERATOR_CHUNK_SIZE)
+    except TypeError:  # Django < 2.0
+        rows = queryset.iterator()
+    fields = EXPORT_FIELDS + EXPORT_CONTENT_FIELDS
+
+    if export_format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow([_format_csv_value(row[field]) for field in fields])
+    elif export_format == 'jsonl':
+        for row in rows:
+            yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+    else:
+        raise ValueError('unknown export format {}'.format(export_format))
+
+
+def _format_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        # user provided values such as emails are escaped to be shown as text when the export is opened
+        return "'" + value
+    return value
@@ -0,0 +1,178 @@
+"""
+Health of the receipt pipeline served to orchestrator probes.
+
+Atol requests add their outcome and duration to per minute counters in the django cache, and the auth token
+records when it was obtained, so that probes are answered out of a handful of cache reads. Backlogs come
+from the receipt counters and the oldest pending receipt of each status is looked up by the partial indexes,
+both computed at most once per ``RECEIPTS_ATOL_HEALTH_CACHE_TIMEOUT`` seconds; the receipt table
+is never scanned.
+"""
+import logging
+import time
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from atol.counters import get_status_counts
+from atol.exceptions import AtolClientRequestException
+from atol.routing import get_read_database
+
+logger = logging.getLogger(__name__)
+
+REQUESTS_CACHE_KEY = 'atol_health:{minute}:{stat}'
+REQUEST_STATS = ('requests', 'errors', 'rejected', 'latency_ms')
+TOKEN_CACHE_KEY = 'atol_health:token_obtained_at:{login}'
+PIPELINE_CACHE_KEY = 'atol_health:pipeline'
+# pending statuses along with the column of the partial index the oldest receipt is found by
+PENDING_STATUSES = [
+    ('created', 'created_at'),
+    ('initiated', 'initiated_at'),
+    ('retried', 'retried_at'),
+    ('held', 'created_at'),
+]
+# requests needed within the window to judge the error rate
+MIN_REQUESTS = 10
+
+
+def get_window():
+    """Minutes the atol request stats are reported for"""
+    return getattr(settings, 'RECEIPTS_ATOL_HEALTH_WINDOW', None) or 5
+
+
+def _current_minute():
+    return int(time.time() // 60)
+
+
+def _incr(key, delta):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # the first request of the minute, the counter outlives the window
+        if not cache.add(key, delta, timeout=(get_window() + 1) * 60):
+            cache.incr(key, delta)
+
+
+def record_request(seconds, outcome=None):
+    """
+    Add an atol request to the counters of the current minute
+
+    :param outcome: None for a successful request, 'errors' for failed ones, 'rejected' for atol errors
+    """
+    minute = _current_minute()
+    try:
+        _incr(REQUESTS_CACHE_KEY.format(minute=minute, stat='requests'), 1)
+        _incr(REQUESTS_CACHE_KEY.format(minute=minute, stat='latency_ms'), int(seconds * 1000))
+        if outcome:
+            _incr(REQUESTS_CACHE_KEY.format(minute=minute, stat=outcome), 1)
+    except Exception as exc:  # health stats must never break the request
+        logger.warning('unable to record atol request stats due to %s', exc)
+
+
+@contextmanager
+def track_request():
+    """Record the duration and outcome of the atol request made within the block"""
+    started = time.monotonic()
+    outcome = 'errors'
+    try:
+        yield
+        outcome = None
+    except AtolClientRequestException:
+        outcome = 'rejected'
+        raise
+    finally:
+        record_request(time.monotonic() - started, outcome)
+
+
+def record_token_obtained():
+    cache.set(TOKEN_CACHE_KEY.format(login=settings.RECEIPTS_ATOL_LOGIN), time.time(), timeout=None)
+
+
+def get_token_age():
+    """Return seconds since the cached auth token has been obtained, None if unknown"""
+    obtained_at = cache.get(TOKEN_CACHE_KEY.format(login=settings.RECEIPTS_ATOL_LOGIN))
+    return None if obtained_at is None else round(time.time() - obtained_at, 1)
+
+
+def get_request_stats():
+    """Return the number of atol requests, failures, rejections, error rate and mean latency of the window"""
+    window = get_window()
+    last_minute = _current_minute()
+    keys = {(minute, stat): REQUESTS_CACHE_KEY.format(minute=minute, stat=stat)
+            for minute in range(last_minute - window + 1, last_minute + 1) for stat in REQUEST_STATS}
+    values = cache.get_many(keys.values())
+    totals = {stat: sum(values.get(keys[(minute, name)], 0) for (minute, name) in keys if name == stat)
+              for stat in REQUEST_STATS}
+
+    requests = totals['requests']
+    return {
+        'window': window * 60,
+        'requests': requests,
+        'errors': totals['errors'],
+        'rejected': totals['rejected'],
+        'error_rate': round(totals['errors'] / requests, 4) if requests else None,
+        'latency': round(totals['latency_ms'] / 1000.0 / requests, 3) if requests else None,
+    }
+
+
+def _compute_pipeline():
+    Receipt = apps.get_model('atol', 'Receipt')
+    receipts = Receipt.objects.using(get_read_database(Receipt))
+    counts = get_status_counts()
+    pipeline = {}
+    for status, column in PENDING_STATUSES:
+        oldest = (receipts.filter(status=status, **{column + '__isnull': False})
+                  .order_by(column).values_list(column, flat=True).first())
+        pipeline[status] = {'count': counts.get(status, 0), 'oldest': oldest}
+    return pipeline
+
+
+def get_pipeline():
+    """
+    Return the backlog size and the age in seconds of the oldest receipt of each pending status
+    """
+    pipeline = cache.get(PIPELINE_CACHE_KEY)
+    if pipeline is None:
+        pipeline = _compute_pipeline()
+        cache.set(PIPELINE_CACHE_KEY, pipeline, getattr(settings, 'RECEIPTS_ATOL_HEALTH_CACHE_TIMEOUT', 30))
+
+    now = timezone.now()
+    return {
+        status: {'count': backlog['count'],
+                 'oldest_age': round((now - backlog['oldest']).total_seconds(), 1) if backlog['oldest'] else None}
+        for status, backlog in pipeline.items()
+    }
+
+
+def get_problems(requests, pipeline):
+    problems = []
+    max_error_rate = getattr(settings, 'RECEIPTS_ATOL_HEALTH_MAX_ERROR_RATE', 0.5)
+    enough_requests = requests['requests'] >= MIN_REQUESTS
+    if max_error_rate is not None and enough_requests and requests['error_rate'] > max_error_rate:
+        problems.append('atol error rate {:.0%}'.format(requests['error_rate']))
+
+    max_age = getattr(settings, 'RECEIPTS_ATOL_HEALTH_MAX_BACKLOG_AGE', None)
+    if max_age is not None:
+        for status, backlog in pipeline.items():
+            if backlog['oldest_age'] is not None and backlog['oldest_age'] > max_age:
+                problems.append('{} receipts wait for {:.0f} seconds'.format(status, backlog['oldest_age']))
+    return problems
+
+
+def get_health():
+    """
+    :return: dict of the overall status (ok or degraded), the problems found, the auth token age,
+             the atol request stats and the pipeline backlogs
+    """
+    requests = get_request_stats()
+    pipeline = get_pipeline()
+    problems = get_problems(requests, pipeline)
+    return {
+        'status': 'degraded' if problems else 'ok',
+        'problems': problems,
+        'token_age': get_token_age(),
+        'atol': requests,
+        'pipeline': pipeline,
+    }
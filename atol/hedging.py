@@ -0,0 +1,180 @@
+"""
+Hedged requests cutting the tail latency of idempotent atol calls (reports).
+
+A request which has not answered within a percentile of the recent latency is sent once more
+on another connection and the first answer wins. Hedges are capped to a share of the requests
+by a token bucket, so that a slow atol does not get twice the load. Counts of requests, hedges
+and hedges that won are kept in the django cache to be seen across processes.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.cache import cache
+
+from atol.exceptions import AtolRequestException
+from atol.instrumentation import current_record, recording
+
+logger = logging.getLogger(__name__)
+
+# recent latencies a percentile is computed over, and how many of them are needed to start hedging
+LATENCY_WINDOW = 500
+MIN_SAMPLES = 50
+# hedges which may be fired in a row once the budget has been saved up
+HEDGE_BURST = 10
+# requests counted in process before being added to the cache
+STATS_FLUSH_EVERY = 100
+STATS_CACHE_KEY = 'atol_hedging:{}'
+STATS = ('requests', 'hedged', 'hedge_won', 'budget_exhausted')
+
+
+class LatencyWindow(object):
+    """Thread safe window of the recent latencies"""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, percentile, min_samples=MIN_SAMPLES):
+        """Return the nearest rank percentile of the window, None if there are not enough samples"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies or len(latencies) < min_samples:
+            return None
+        rank = max(int(round(percentile / 100.0 * len(latencies))) - 1, 0)
+        return latencies[min(rank, len(latencies) - 1)]
+
+
+class HedgeBudget(object):
+    """Token bucket letting at most `max_rate` hedges per request through"""
+
+    def __init__(self, max_rate, burst=HEDGE_BURST):
+        self.max_rate = max_rate
+        self.burst = burst
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.max_rate, self.burst)
+
+    def spend(self):
+        with self._lock:
+            # tolerate float rounding of the earned fractions
+            if self._tokens < 1 - 1e-9:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class HedgeStats(object):
+    """Process counters flushed to the django cache in batches"""
+
+    def __init__(self):
+        self._pending = dict.fromkeys(STATS, 0)
+        self._lock = threading.Lock()
+
+    def incr(self, name, flush=False):
+        with self._lock:
+            self._pending[name] += 1
+            if not flush and self._pending['requests'] < STATS_FLUSH_EVERY:
+                return
+            pending, self._pending = self._pending, dict.fromkeys(STATS, 0)
+
+        for stat, delta in pending.items():
+            if delta:
+                key = STATS_CACHE_KEY.format(stat)
+                cache.add(key, 0, timeout=None)
+                try:
+                    cache.incr(key, delta)
+                except ValueError:  # evicted meanwhile
+                    cache.set(key, delta, timeout=None)
+
+
+def get_hedging_stats():
+    """Return the numbers of requests, hedges fired, hedges that won and hedges denied by the budget"""
+    values = cache.get_many([STATS_CACHE_KEY.format(stat) for stat in STATS])
+    return {stat: values.get(STATS_CACHE_KEY.format(stat), 0) for stat in STATS}
+
+
+class Hedger(object):
+    """
+    :param percentile: percentile of the recent latency to wait for an answer before hedging
+    :param max_rate: share of requests allowed to be hedged
+    """
+
+    def __init__(self, percentile, max_rate, workers=16):
+        self.percentile = percentile
+        self.latencies = LatencyWindow()
+        self.budget = HedgeBudget(max_rate)
+        self.stats = HedgeStats()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _submit(self, func, args):
+        # requests are timed as phases of the call of the submitting thread, see atol.instrumentation
+        record = current_record()
+
+        def timed():
+            started = time.monotonic()
+            try:
+                with recording(record):
+                    return func(*args)
+            finally:
+                self.latencies.add(time.monotonic() - started)
+        return self._executor.submit(timed)
+
+    def call(self, func, *args):
+        """
+        Call the function, calling it once more if it takes longer than usual; the first answer wins.
+        Transport failures of one call do not count as an answer while the other is in flight.
+        """
+        self.budget.earn()
+        self.stats.incr('requests')
+
+        primary = self._submit(func, args)
+        threshold = self.latencies.percentile(self.percentile)
+        if threshold is None or wait([primary], timeout=threshold).done:
+            return primary.result()
+
+        if not self.budget.spend():
+            self.stats.incr('budget_exhausted', flush=True)
+            return primary.result()
+
+        logger.info('hedging request %s%s not answered within %.3f seconds', func.__name__, args, threshold)
+        self.stats.incr('hedged', flush=True)
+        hedge = self._submit(func, args)
+        pending = [primary, hedge]
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            answers = [future for future in (primary, hedge)
+                       if future.done() and not isinstance(future.exception(), AtolRequestException)]
+            if answers or not pending:
+                winner = answers[0] if answers else hedge
+                break
+
+        if winner is hedge:
+            self.stats.incr('hedge_won', flush=True)
+        return winner.result()
+
+
+_hedgers = {}
+_lock = threading.Lock()
+
+
+def get_hedger():
+    """Return the hedger of the process configured by the settings, None if hedging is off"""
+    if not getattr(settings, 'RECEIPTS_ATOL_HEDGE_REPORTS', False):
+        return None
+    config = (getattr(settings, 'RECEIPTS_ATOL_HEDGE_PERCENTILE', 95),
+              getattr(settings, 'RECEIPTS_ATOL_HEDGE_MAX_RATE', 0.05))
+    with _lock:
+        if config not in _hedgers:
+            _hedgers[config] = Hedger(*config)
+        return _hedgers[config]
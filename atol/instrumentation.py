@@ -0,0 +1,230 @@
+"""
+Slow call recorder and sampled task profiling.
+
+Atol requests and task bodies are split into phases (token lookup, JSON encoding, the http call,
+database reads and saves, signal receivers) timed by ``phase``. Calls taking longer than
+``RECEIPTS_ATOL_SLOW_CALL_THRESHOLD`` seconds are recorded with their phase timings and payload sizes
+into a ring buffer of ``RECEIPTS_ATOL_SLOW_CALLS`` slots kept in the django cache, so that calls
+recorded by every worker could be dumped by the ``atol_slow_calls`` command.
+
+Setting the ``ATOL_PROFILE_TASKS`` environment variable to a share of task executions (e.g. 0.01)
+profiles them by sampling the stack of the task thread every ``ATOL_PROFILE_INTERVAL`` milliseconds (5);
+profiled executions are recorded along with their most frequent stacks whatever time they take.
+"""
+import functools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+SLOT_CACHE_KEY = 'atol_slow_calls:{}'
+INDEX_CACHE_KEY = 'atol_slow_calls:index'
+# stacks kept per profiled call
+PROFILE_TOP_STACKS = 20
+PROFILE_STACK_DEPTH = 30
+
+_local = threading.local()
+
+
+def get_threshold():
+    return getattr(settings, 'RECEIPTS_ATOL_SLOW_CALL_THRESHOLD', None)
+
+
+def get_buffer_size():
+    return getattr(settings, 'RECEIPTS_ATOL_SLOW_CALLS', None) or 200
+
+
+class CallRecord(object):
+
+    def __init__(self, name, details):
+        self.name = name
+        self.details = details
+        self.phases = OrderedDict()
+        self.sizes = OrderedDict()
+        self.profile = None
+        self.started_at = timezone.now()
+        self._started = time.monotonic()
+        # phases may be added by the threads working on the call, see recording
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self):
+        return time.monotonic() - self._started
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def add_size(self, name, size):
+        with self._lock:
+            self.sizes[name] = self.sizes.get(name, 0) + size
+
+    def as_dict(self, duration):
+        return {
+            'name': self.name,
+            'details': self.details,
+            'started_at': self.started_at.isoformat(),
+            'duration': round(duration, 6),
+            'phases': OrderedDict((name, round(seconds, 6)) for name, seconds in self.phases.items()),
+            'sizes': self.sizes,
+            'profile': self.profile,
+        }
+
+
+def _current():
+    return getattr(_local, 'record', None)
+
+
+def current_record():
+    """Return the call recorded by the thread, to be passed to the threads working on it"""
+    return _current()
+
+
+@contextmanager
+def recording(record):
+    """Time the block as a part of the call recorded by another thread"""
+    previous = _current()
+    _local.record = record
+    try:
+        yield
+    finally:
+        _local.record = previous
+
+
+@contextmanager
+def record_call(name, profile=False, **details):
+    """
+    Time the call and record it if slow; nested calls are timed as phases of the outermost one.
+
+    :param profile: whether the call may be profiled (task executions)
+    :param details: short identifiers of the call to be recorded (receipt id and such)
+    """
+    if _current() is not None:
+        with phase(name):
+            yield
+        return
+
+    profiler = TaskProfiler.maybe_start() if profile else None
+    record = _local.record = CallRecord(name, details)
+    try:
+        yield
+    finally:
+        _local.record = None
+        duration = record.duration
+        if profiler:
+            record.profile = profiler.stop()
+        threshold = get_threshold()
+        if profiler or (threshold is not None and duration >= threshold):
+            store_call(record.as_dict(duration))
+
+
+def recorded(name, details=None):
+    """
+    Decorate a task function to record its executions by record_call, profiled if sampled.
+
+    :param details: function of the task arguments returning the details of the call
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with record_call(name, profile=True, **(details(*args, **kwargs) if details else {})):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent within the block to the phase of the current call, if any"""
+    record = _current()
+    if record is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record.add_phase(name, time.monotonic() - started)
+
+
+def record_size(name, size):
+    """Add a payload size in bytes to the current call, if any"""
+    record = _current()
+    if record is not None and size is not None:
+        record.add_size(name, size)
+
+
+def store_call(call):
+    """Put the call into the next slot of the ring buffer"""
+    try:
+        cache.add(INDEX_CACHE_KEY, 0, timeout=None)
+        index = cache.incr(INDEX_CACHE_KEY)
+        cache.set(SLOT_CACHE_KEY.format(index % get_buffer_size()), call, timeout=None)
+    except Exception as exc:  # instrumentation must never break the call
+        logger.warning('unable to record slow call %s due to %s', call['name'], exc)
+
+
+def get_slow_calls():
+    """Return the calls of the ring buffer, oldest first"""
+    keys = [SLOT_CACHE_KEY.format(slot) for slot in range(get_buffer_size())]
+    return sorted(cache.get_many(keys).values(), key=lambda call: call['started_at'])
+
+
+def clear_slow_calls():
+    cache.delete_many([SLOT_CACHE_KEY.format(slot) for slot in range(get_buffer_size())] + [INDEX_CACHE_KEY])
+
+
+class TaskProfiler(object):
+    """
+    Sampling profiler collecting the stacks of a thread from a background thread
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='atol-profiler', daemon=True)
+
+    @classmethod
+    def maybe_start(cls):
+        """Start profiling the current thread if the execution is sampled by ATOL_PROFILE_TASKS"""
+        try:
+            rate = float(os.environ.get('ATOL_PROFILE_TASKS') or 0)
+            interval = float(os.environ.get('ATOL_PROFILE_INTERVAL') or 5) / 1000
+        except ValueError:
+            return None
+        if rate <= 0 or random.random() >= rate:
+            return None
+        profiler = cls(interval)
+        profiler._sampler.start()
+        return profiler
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < PROFILE_STACK_DEPTH:
+                code = frame.f_code
+                stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """
+        :return: list of [collapsed stack, number of samples] of the most frequent stacks
+        """
+        self._stopped.set()
+        self._sampler.join()
+        return [[stack, samples] for stack, samples in self.stacks.most_common(PROFILE_TOP_STACKS)]
@@ -0,0 +1,79 @@
+"""
+Receipt pipeline latency report: percentiles of the time it takes to initiate receipts in atol
+and to receive their reports, along with the number of atol calls made per receipt.
+
+Everything is aggregated by the database in a single GROUP BY query.
+"""
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import Aggregate, Avg, Count, FloatField, Func
+from django.db.models.functions import TruncDate
+
+from atol.models import Receipt
+from atol.utils import start_of_day
+
+PERCENTILES = (50, 90, 99)
+
+LatencyRow = namedtuple('LatencyRow', ['day', 'group_code', 'receipts', 'initiation', 'reception',
+                                       'attempts', 'polls'])
+
+
+class Seconds(Func):
+    """Seconds between two timestamps"""
+    template = 'EXTRACT(EPOCH FROM (%(expressions)s))'
+    arg_joiner = ' - '
+    output_field = FloatField()
+
+
+class Percentiles(Aggregate):
+    """Continuous percentiles of the expression as an array"""
+    function = 'percentile_cont'
+    template = '%(function)s(%(fractions)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+    def __init__(self, expression, percentiles, **extra):
+        fractions = 'ARRAY[{}]::float8[]'.format(', '.join(repr(p / 100.0) for p in percentiles))
+        super(Percentiles, self).__init__(expression, fractions=fractions,
+                                          output_field=ArrayField(FloatField()), **extra)
+
+
+def _percentiles(values, percentiles):
+    return OrderedDict(zip(percentiles, values or [None] * len(percentiles)))
+
+
+def get_latency_report(day_from=None, day_to=None, percentiles=PERCENTILES):
+    """
+    Return the latency of receipts created within the days (inclusive) per creation day and group code
+
+    :return: list of LatencyRow, where initiation (created -> initiated) and reception (initiated -> received)
+        are OrderedDicts of percentile to seconds, attempts and polls are the average numbers of atol calls
+    """
+    receipts = Receipt.objects.order_by()
+    if day_from:
+        receipts = receipts.filter(created_at__gte=start_of_day(day_from))
+    if day_to:
+        receipts = receipts.filter(created_at__lt=start_of_day(day_to + timedelta(days=1)))
+
+    rows = (receipts
+            .annotate(day=TruncDate('created_at'))
+            .values('day', 'group_code')
+            .annotate(receipts=Count('id'),
+                      initiation=Percentiles(Seconds('initiated_at', 'created_at'), percentiles),
+                      reception=Percentiles(Seconds('received_at', 'initiated_at'), percentiles),
+                      attempts=Avg('attempts'),
+                      polls=Avg('polls'))
+            .order_by('day', 'group_code'))
+
+    return [
+        LatencyRow(
+            day=row['day'],
+            group_code=row['group_code'],
+            receipts=row['receipts'],
+            initiation=_percentiles(row['initiation'], percentiles),
+            reception=_percentiles(row['reception'], percentiles),
+            attempts=row['attempts'],
+            polls=row['polls'],
+        )
+        for row in rows
+    ]
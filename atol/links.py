@@ -0,0 +1,351 @@
+"""
+Resolution of short receipt links to OFD provider urls.
+
+Besides the short uuid links, received receipts have signed links, which carry the fiscal attributes
+of the receipt in a compact signed token, so that they could be resolved without a database lookup.
+
+Resolved urls of received receipts never change, so they are cached by short uuid
+in a bounded in-process LRU in front of the django cache. The cache is filled as soon as
+a receipt is received. Unknown and not yet received receipts are cached for a short while
+as missing, so that link scans and early clicks would not reach the database.
+"""
+import calendar
+import datetime
+import logging
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from decimal import Decimal
+
+import shortuuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from atol.exceptions import MissingReceipt
+from atol.models import FISCAL_FIELDS, Receipt, ReceiptStatus
+from atol.routing import get_read_database, get_write_database
+from atol.utils import format_receipt_total, parse_receipt_datetime
+
+logger = logging.getLogger(__name__)
+
+# cached in place of the url of a missing receipt
+MISSING = ''
+
+SIGNED_LINK_VERSION = 1
+# version, fn_number, fiscal_document_number, fiscal_document_attribute, fiscal_receipt_number,
+# total in kopecks, receipt local datetime as a timestamp
+SIGNED_LINK_FORMAT = struct.Struct('>BQIIIII')
+SIGNATURE_SIZE = 8
+BASE62_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+# shortuuid links are never longer than that
+SHORT_UUID_LENGTH = 22
+
+
+def format_ofd_url(receipt_dt, total, fn_number, fiscal_document_number,
+                   fiscal_document_attribute, fiscal_receipt_number):
+    return settings.RECEIPTS_OFD_URL_TEMPLATE.format(
+        t='{:%Y%m%dT%H%M%S}'.format(receipt_dt),
+        s=total,
+        fn=fn_number,
+        fd=fiscal_document_number,
+        fp=fiscal_document_attribute,
+        n=fiscal_receipt_number,
+    )
+
+
+def get_content_ofd_url(receipt):
+    content = receipt.get_content()
+    if not content:
+        logger.warning('access receipt before backend processed receipt, suspicious')
+        raise MissingReceipt()
+
+    payload = content['payload']
+    receipt_dt = parse_receipt_datetime(payload['receipt_datetime'])
+
+    return format_ofd_url(
+        receipt_dt=receipt_dt,
+        total=payload['total'],
+        fn_number=payload['fn_number'],
+        fiscal_document_number=payload['fiscal_document_number'],
+        fiscal_document_attribute=payload['fiscal_document_attribute'],
+        fiscal_receipt_number=payload['fiscal_receipt_number'],
+    )
+
+
+def get_ofd_url(receipt):
+    """
+    Return the OFD provider url of the receipt
+
+    :raises MissingReceipt: if the receipt has not been received yet
+    """
+    if receipt.fn_number is None:
+        if receipt.status != ReceiptStatus.received:
+            logger.warning('access receipt before backend processed receipt, suspicious')
+            raise MissingReceipt()
+        # receipts received before the fiscal fields were introduced and not yet backfilled
+        return get_content_ofd_url(receipt)
+
+    receipt_dt = receipt.receipt_datetime
+    if timezone.is_aware(receipt_dt):
+        receipt_dt = timezone.localtime(receipt_dt)
+
+    return format_ofd_url(
+        receipt_dt=receipt_dt,
+        total=format_receipt_total(receipt.total),
+        fn_number=receipt.fn_number,
+        fiscal_document_number=receipt.fiscal_document_number,
+        fiscal_document_attribute=receipt.fiscal_document_attribute,
+        fiscal_receipt_number=receipt.fiscal_receipt_number,
+    )
+
+
+def decode_short_uuid(short_uuid):
+    for legacy in (False, True):
+        try:
+            return shortuuid.decode(short_uuid, legacy=legacy)
+        except ValueError:
+            pass
+    return None
+
+
+def get_link_receipts(short_uuid, using=None, fields=None):
+    """
+    Return the queryset of receipts the short uuid link may point to
+
+    :param fields: fields to load on top of those needed to resolve the link
+    """
+    # legacy links (shortuuid < 1.0) carry the very same code reversed
+    lookup = Q(short_code__in=[short_uuid, short_uuid[::-1]])
+    if not getattr(settings, 'RECEIPTS_ATOL_SHORT_CODES_BACKFILLED', False):
+        # receipts which short codes are yet to be backfilled
+        internal_uuid = decode_short_uuid(short_uuid)
+        if internal_uuid:
+            lookup |= Q(short_code__isnull=True, internal_uuid=internal_uuid)
+
+    fields = ['id', 'status', 'short_code', 'archived_at'] + FISCAL_FIELDS + list(fields or [])
+    return Receipt.objects.using(using).only(*fields).filter(lookup)[:3]
+
+
+def pick_link_receipt(receipts, short_uuid):
+    """
+    Pick the receipt of the link out of get_link_receipts results, preferring the actual code to the legacy one
+    """
+    receipts = sorted(receipts, key=lambda receipt: receipt.short_code != short_uuid)
+    return receipts[0] if receipts else None
+
+
+def is_stale(receipt, using, primary):
+    # replica may not have caught up with the receipt or its report yet
+    return using != primary and (receipt is None or receipt.status != ReceiptStatus.received)
+
+
+def get_link_receipt(short_uuid, fields=None):
+    """
+    Return the receipt of the short uuid link (or None) read from the replica,
+    falling back to the primary unless the replica has it received
+    """
+    using, primary = get_read_database(Receipt), get_write_database(Receipt)
+    receipt = pick_link_receipt(get_link_receipts(short_uuid, using, fields), short_uuid)
+    if is_stale(receipt, using, primary):
+        receipt = pick_link_receipt(get_link_receipts(short_uuid, primary, fields), short_uuid)
+    return receipt
+
+
+def _base62_encode(data):
+    number = int.from_bytes(data, 'big')
+    chars = []
+    while number:
+        number, index = divmod(number, 62)
+        chars.append(BASE62_ALPHABET[index])
+    return ''.join(reversed(chars))
+
+
+def _base62_decode(token, size):
+    number = 0
+    for char in token:
+        number = number * 62 + BASE62_ALPHABET.index(char)
+    return number.to_bytes(size, 'big')
+
+
+def _sign(data):
+    secret = getattr(settings, 'RECEIPTS_SIGNED_LINK_SECRET', None) or settings.SECRET_KEY
+    return salted_hmac('atol.links.signed_link', data, secret=secret).digest()[:SIGNATURE_SIZE]
+
+
+def make_signed_token(receipt):
+    """
+    Pack fiscal attributes of the received receipt into a signed token
+
+    :return: the token or None if the receipt does not have fiscal attributes (yet)
+    """
+    if receipt.fn_number is None:
+        return None
+
+    receipt_dt = receipt.receipt_datetime
+    if timezone.is_aware(receipt_dt):
+        receipt_dt = timezone.localtime(receipt_dt)
+
+    try:
+        data = SIGNED_LINK_FORMAT.pack(
+            SIGNED_LINK_VERSION,
+            int(receipt.fn_number),
+            receipt.fiscal_document_number,
+            receipt.fiscal_document_attribute,
+            receipt.fiscal_receipt_number,
+            int(receipt.total * 100),
+            calendar.timegm(receipt_dt.timetuple()),
+        )
+    except (struct.error, ValueError) as exc:
+        logger.warning('unable to make signed link for receipt %s due to %s', receipt.id, exc)
+        return None
+
+    return _base62_encode(data + _sign(data))
+
+
+def is_signed_token(token):
+    return len(token) > SHORT_UUID_LENGTH
+
+
+def get_signed_token_ofd_url(token):
+    """
+    Verify the token and return the OFD provider url of the receipt packed into it
+
+    :raises MissingReceipt: if the token is malformed or its signature does not match
+    """
+    size = SIGNED_LINK_FORMAT.size + SIGNATURE_SIZE
+    try:
+        signed = _base62_decode(token, size)
+    except (ValueError, OverflowError):
+        raise MissingReceipt()
+
+    data, signature = signed[:-SIGNATURE_SIZE], signed[-SIGNATURE_SIZE:]
+    if not constant_time_compare(signature, _sign(data)):
+        logger.warning('signed link %s has invalid signature', token)
+        raise MissingReceipt()
+
+    version, fn_number, fd, fp, n, total, timestamp = SIGNED_LINK_FORMAT.unpack(data)
+    if version != SIGNED_LINK_VERSION:
+        raise MissingReceipt()
+
+    return format_ofd_url(
+        receipt_dt=datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=timestamp),
+        total=format_receipt_total(Decimal(total) / 100),
+        # fn numbers are 16 digits long
+        fn_number='{:016d}'.format(fn_number),
+        fiscal_document_number=fd,
+        fiscal_document_attribute=fp,
+        fiscal_receipt_number=n,
+    )
+
+
+class LRUCache(object):
+    """Thread safe bounded mapping with expiring entries"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LinkCache(object):
+
+    def __init__(self):
+        self.local = LRUCache(maxsize=getattr(settings, 'RECEIPTS_OFD_URL_LRU_SIZE', None) or 10000)
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'RECEIPTS_OFD_URL_CACHE_TIMEOUT', 7 * 24 * 3600)
+
+    @property
+    def missing_timeout(self):
+        return getattr(settings, 'RECEIPTS_OFD_URL_MISSING_CACHE_TIMEOUT', 10)
+
+    def get_key(self, short_uuid):
+        # urls are cached per template to let ofd be changed at any point
+        template_hash = zlib.crc32(settings.RECEIPTS_OFD_URL_TEMPLATE.encode('utf-8'))
+        return 'atol_ofd_url:{:x}:{}'.format(template_hash, short_uuid)
+
+    def get(self, short_uuid):
+        """
+        :return: the url, MISSING for missing receipts, or None when nothing is cached
+        """
+        if not self.timeout:
+            return None
+
+        key = self.get_key(short_uuid)
+        ofd_url = self.local.get(key)
+        if ofd_url is None:
+            ofd_url = cache.get(key)
+            if ofd_url is not None:
+                self.local.set(key, ofd_url, self.missing_timeout if ofd_url == MISSING else self.timeout)
+        return ofd_url
+
+    def set(self, short_uuid, ofd_url):
+        if not self.timeout:
+            return
+        key = self.get_key(short_uuid)
+        self.local.set(key, ofd_url, self.timeout)
+        cache.set(key, ofd_url, self.timeout)
+
+    def set_missing(self, short_uuid):
+        if not self.timeout or not self.missing_timeout:
+            return
+        key = self.get_key(short_uuid)
+        self.local.set(key, MISSING, self.missing_timeout)
+        cache.set(key, MISSING, self.missing_timeout)
+
+
+link_cache = LinkCache()
+
+
+def cache_ofd_urls(receipts, using=None):
+    """
+    Cache urls of the received receipts once the current transaction commits,
+    so that links of receipts which transitions are rolled back would not be cached
+
+    :param using: Database alias of the transaction to wait for
+    """
+    receipts = list(receipts)
+    if receipts and link_cache.timeout:
+        transaction.on_commit(lambda: _cache_ofd_urls(receipts), using=using)
+
+
+def _cache_ofd_urls(receipts):
+    for receipt in receipts:
+        try:
+            link_cache.set(shortuuid.encode(receipt.internal_uuid), get_ofd_url(receipt))
+        except (MissingReceipt, KeyError, TypeError, ValueError) as exc:
+            logger.warning('unable to cache ofd url of receipt %s due to %s', receipt.id, exc)
@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from atol.models import Receipt
+
+
+class Command(BaseCommand):
+    help = ('Move reports of terminal receipts older than the given number of days into the compressed archive. '
+            'Interrupted runs are resumed where they stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365, help='Archive receipts created that many days ago')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of receipts archived at once')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        before = timezone.now() - timedelta(days=options['days'])
+        receipts = Receipt.objects.archivable(before).order_by('id')
+
+        last_id = 0
+        archived = 0
+        while True:
+            chunk_ids = list(receipts.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+            if not chunk_ids:
+                break
+            archived += len(Receipt.objects.filter(id__in=chunk_ids).bulk_archive())
+
+            last_id = chunk_ids[-1]
+            self.stdout.write('archived {} receipts up to id {}'.format(archived, last_id))
+
+        self.stdout.write('done: {} receipts archived'.format(archived))
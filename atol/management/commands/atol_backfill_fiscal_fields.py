@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from atol.models import FISCAL_FIELDS, Receipt, ReceiptStatus
+
+
+class Command(BaseCommand):
+    help = 'Copy fiscal attributes of received receipts from their content into the dedicated columns'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of receipts updated at once')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        receipts = (Receipt.objects
+                    .filter(status=ReceiptStatus.received, fn_number__isnull=True)
+                    .only('id', 'content', *FISCAL_FIELDS)
+                    .order_by('id'))
+
+        last_id = 0
+        updated = skipped = 0
+        while True:
+            with transaction.atomic():
+                chunk = list(receipts.filter(id__gt=last_id)[:chunk_size])
+                if not chunk:
+                    break
+                for receipt in chunk:
+                    receipt.set_fiscal_data()
+                filled = [receipt for receipt in chunk if receipt.fn_number is not None]
+                Receipt.objects.bulk_update_fields(filled, FISCAL_FIELDS)
+
+            last_id = chunk[-1].id
+            updated += len(filled)
+            skipped += len(chunk) - len(filled)
+            self.stdout.write('backfilled {} receipts up to id {}'.format(updated, last_id))
+
+        self.stdout.write('done: {} receipts backfilled, {} receipts without fiscal data'.format(updated, skipped))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from atol.models import Receipt
+
+
+class Command(BaseCommand):
+    help = 'Fill in short codes of receipt links for receipts created before the short_code field was introduced'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of receipts updated at once')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        receipts = Receipt.objects.filter(short_code__isnull=True).only('id', 'internal_uuid').order_by('id')
+
+        last_id = 0
+        updated = 0
+        while True:
+            with transaction.atomic():
+                chunk = list(receipts.filter(id__gt=last_id)[:chunk_size])
+                if not chunk:
+                    break
+                for receipt in chunk:
+                    receipt.set_short_code()
+                Receipt.objects.bulk_update_fields(chunk, ['short_code'])
+
+            last_id = chunk[-1].id
+            updated += len(chunk)
+            self.stdout.write('backfilled {} receipts up to id {}'.format(updated, last_id))
+
+        self.stdout.write('done: {} receipts backfilled'.format(updated))
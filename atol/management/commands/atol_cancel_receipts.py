@@ -0,0 +1,71 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from atol.cancel import apply_refunds, build_params, get_pending_refunds, post_refunds
+from atol.core import AtolAPI
+from atol.management.commands.atol_export_receipts import date_argument
+from atol.models import Receipt, ReceiptOperation, ReceiptStatus
+from atol.reconcile import get_checkpoint, save_checkpoint
+from atol.throttling import RateLimiter
+from atol.utils import start_of_day
+
+
+class Command(BaseCommand):
+    help = ('Cancel received receipts created within the days with refund receipts (sell_refund): '
+            'refunds are stored, registered in atol concurrently under a rate limit and have their reports '
+            'polled like sells. Progress is checkpointed after each chunk, so an interrupted run resumes '
+            'where it stopped; receipts cancelled already are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='day_from', type=date_argument, required=True,
+                            help='First day, YYYY-MM-DD')
+        parser.add_argument('--to', dest='day_to', type=date_argument, required=True,
+                            help='Last day (inclusive), YYYY-MM-DD')
+        parser.add_argument('--ids-file', help='File with ids of the receipts to cancel, one per line, '
+                                               'all received receipts of the days by default')
+        parser.add_argument('--workers', type=int, default=8, help='Number of concurrent sell_refund requests')
+        parser.add_argument('--rate', type=float, default=10, help='Requests per second, 0 for unlimited')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of receipts cancelled at once')
+        parser.add_argument('--reset', action='store_true', help='Start over ignoring the stored checkpoint')
+
+    def handle(self, *args, **options):
+        day_from, day_to = options['day_from'], options['day_to']
+        receipts = (Receipt.objects
+                    .filter(created_at__gte=start_of_day(day_from),
+                            created_at__lt=start_of_day(day_to + timedelta(days=1)),
+                            operation=ReceiptOperation.sell, status=ReceiptStatus.received)
+                    .order_by('id'))
+        name = 'atol_cancel_receipts:{}:{}'.format(day_from, day_to)
+        if options['ids_file']:
+            with open(options['ids_file']) as ids_file:
+                receipts = receipts.filter(id__in=[int(line) for line in ids_file if line.strip()])
+            name += ':' + options['ids_file']
+
+        checkpoint = get_checkpoint(name, reset=options['reset'])
+        stats = Counter(checkpoint.stats or {})
+        if checkpoint.position:
+            self.stdout.write('resuming after receipt {}'.format(checkpoint.position))
+
+        atol = AtolAPI()
+        limiter = RateLimiter(options['rate'])
+        last_id = checkpoint.position
+        while True:
+            ids = list(receipts.filter(id__gt=last_id).values_list('id', flat=True)[:options['chunk_size']])
+            if not ids:
+                break
+
+            stats['cancelled'] += len(Receipt.objects.filter(id__in=ids).bulk_cancel(dispatch=False))
+            # refunds created by an interrupted run are registered as well
+            results = build_params(get_pending_refunds(ids))
+            malformed = [(refund, result) for refund, result in results if isinstance(result, Exception)]
+            valid = [(refund, result) for refund, result in results if not isinstance(result, Exception)]
+            stats.update(apply_refunds(malformed + post_refunds(atol, valid, options['workers'], limiter)))
+            last_id = ids[-1]
+            save_checkpoint(checkpoint, last_id, stats)
+            self.stdout.write('cancelled {} receipts up to id {}'.format(stats['cancelled'], last_id))
+
+        checkpoint.delete()
+        self.stdout.write('done: ' + ', '.join('{} {}'.format(count, outcome)
+                                               for outcome, count in sorted(stats.items())))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from atol.export import EXPORT_FORMATS, get_export_queryset, iter_export
+from atol.models import ReceiptStatus
+
+
+def date_argument(value):
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(value)
+    return date
+
+
+class Command(BaseCommand):
+    help = 'Stream receipts with their fiscal attributes as CSV or JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--from', dest='date_from', type=date_argument, help='First day, YYYY-MM-DD')
+        parser.add_argument('--to', dest='date_to', type=date_argument, help='Last day (inclusive), YYYY-MM-DD')
+        parser.add_argument('--status', dest='statuses', action='append', choices=[s for s, _ in ReceiptStatus],
+                            help='Receipt status to export, may be repeated; all statuses by default')
+        parser.add_argument('--output', help='File to write to, stdout by default')
+
+    def handle(self, *args, **options):
+        queryset = get_export_queryset(options['date_from'], options['date_to'], options['statuses'])
+        lines = iter_export(queryset, options['format'])
+
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        try:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        except OSError as exc:
+            raise CommandError('unable to write {}: {}'.format(options['output'], exc))
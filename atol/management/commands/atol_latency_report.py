@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from atol.hedging import get_hedging_stats
+from atol.latency import PERCENTILES, get_latency_report
+from atol.management.commands.atol_export_receipts import date_argument
+
+
+def format_seconds(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+class Command(BaseCommand):
+    help = 'Show percentiles of receipt initiation and reception latency per day and group code'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='day_from', type=date_argument, help='First day, YYYY-MM-DD')
+        parser.add_argument('--to', dest='day_to', type=date_argument, help='Last day (inclusive), YYYY-MM-DD')
+
+    def handle(self, *args, **options):
+        header = ['day', 'group_code', 'receipts']
+        for stage in ('initiation', 'reception'):
+            header += ['{}_p{}'.format(stage, percentile) for percentile in PERCENTILES]
+        header += ['attempts', 'polls']
+        self.stdout.write('\t'.join(header))
+
+        for row in get_latency_report(options['day_from'], options['day_to']):
+            values = [str(row.day), row.group_code or '-', str(row.receipts)]
+            values += [format_seconds(value) for value in row.initiation.values()]
+            values += [format_seconds(value) for value in row.reception.values()]
+            values += ['{:.2f}'.format(row.attempts), '{:.2f}'.format(row.polls)]
+            self.stdout.write('\t'.join(values))
+
+        if getattr(settings, 'RECEIPTS_ATOL_HEDGE_REPORTS', False):
+            stats = get_hedging_stats()
+            share = 100.0 * stats['hedged'] / stats['requests'] if stats['requests'] else 0
+            self.stdout.write('report hedging: {requests} requests, {hedged} hedged ({share:.1f}%), '
+                              '{hedge_won} won by the hedge, {budget_exhausted} denied by the rate cap'
+                              .format(share=share, **stats))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from atol.counters import get_daily_counts, get_status_counts, reconcile_counters
+from atol.management.commands.atol_export_receipts import date_argument
+from atol.models import ReceiptStatus
+
+
+class Command(BaseCommand):
+    help = 'Show the number of receipts per status from the counters, optionally reconciling them first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='day_from', type=date_argument, help='First day, YYYY-MM-DD')
+        parser.add_argument('--to', dest='day_to', type=date_argument, help='Last day (inclusive), YYYY-MM-DD')
+        parser.add_argument('--daily', action='store_true', help='Show the counts per day')
+        parser.add_argument('--reconcile', action='store_true',
+                            help='Fix the drift of counters against the actual number of receipts first')
+
+    def handle(self, *args, **options):
+        day_from, day_to = options['day_from'], options['day_to']
+
+        if options['reconcile']:
+            drift = reconcile_counters(day_from, day_to)
+            for (day, status), delta in sorted(drift.items()):
+                self.stdout.write('fixed {} {}: {:+d}'.format(day, status, delta))
+            self.stdout.write('reconciled: {} day/status pairs fixed'.format(len(drift)))
+
+        if options['daily']:
+            for day, counts in get_daily_counts(day_from, day_to).items():
+                self.stdout.write('{} {}'.format(day, self.format_counts(counts)))
+        else:
+            self.stdout.write(self.format_counts(get_status_counts(day_from, day_to)))
+
+    def format_counts(self, counts):
+        return ' '.join('{}={}'.format(status, counts.get(status, 0)) for status, _ in ReceiptStatus)
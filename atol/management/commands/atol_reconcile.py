@@ -0,0 +1,69 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from atol.core import AtolAPI
+from atol.management.commands.atol_export_receipts import date_argument
+from atol.models import Receipt, ReceiptStatus
+from atol.reconcile import PENDING_STATUSES, apply_reports, get_checkpoint, poll_reports, save_checkpoint
+from atol.throttling import RateLimiter
+from atol.utils import start_of_day
+
+
+class Command(BaseCommand):
+    help = ('Poll atol reports of receipts created within the days and apply them: '
+            'pending receipts are received, retried or failed, stale contents of received receipts are refreshed. '
+            'Progress is checkpointed after each chunk, so an interrupted run resumes where it stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='day_from', type=date_argument, required=True,
+                            help='First day, YYYY-MM-DD')
+        parser.add_argument('--to', dest='day_to', type=date_argument, required=True,
+                            help='Last day (inclusive), YYYY-MM-DD')
+        parser.add_argument('--include-received', action='store_true',
+                            help='Refresh contents of received receipts as well')
+        parser.add_argument('--workers', type=int, default=8, help='Number of concurrent report requests')
+        parser.add_argument('--rate', type=float, default=10, help='Report requests per second, 0 for unlimited')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of receipts polled at once')
+        parser.add_argument('--reset', action='store_true', help='Start over ignoring the stored checkpoint')
+
+    def handle(self, *args, **options):
+        day_from, day_to = options['day_from'], options['day_to']
+        statuses = list(PENDING_STATUSES)
+        fields = ['id', 'uuid', 'status', 'created_at']
+        if options['include_received']:
+            statuses.append(ReceiptStatus.received)
+            fields.append('content')
+
+        receipts = (Receipt.objects
+                    .filter(created_at__gte=start_of_day(day_from),
+                            created_at__lt=start_of_day(day_to + timedelta(days=1)),
+                            status__in=statuses, uuid__isnull=False, archived_at__isnull=True)
+                    .only(*fields)
+                    .order_by('id'))
+
+        checkpoint = get_checkpoint('atol_reconcile:{}:{}:{}'.format(day_from, day_to, ','.join(statuses)),
+                                    reset=options['reset'])
+        stats = Counter(checkpoint.stats or {})
+        if checkpoint.position:
+            self.stdout.write('resuming after receipt {}'.format(checkpoint.position))
+
+        atol = AtolAPI()
+        limiter = RateLimiter(options['rate'])
+        last_id = checkpoint.position
+        while True:
+            chunk = list(receipts.filter(id__gt=last_id)[:options['chunk_size']])
+            if not chunk:
+                break
+
+            results = poll_reports(atol, chunk, options['workers'], limiter)
+            stats.update(apply_reports(results))
+            stats['polled'] += len(chunk)
+            last_id = chunk[-1].id
+            save_checkpoint(checkpoint, last_id, stats)
+            self.stdout.write('polled {} receipts up to id {}'.format(stats['polled'], last_id))
+
+        checkpoint.delete()
+        self.stdout.write('done: ' + ', '.join('{} {}'.format(count, outcome)
+                                               for outcome, count in sorted(stats.items())))
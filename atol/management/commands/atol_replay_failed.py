@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+
+from atol.management.commands.atol_export_receipts import date_argument
+from atol.models import FailureReason
+from atol.replay import get_failed_receipts, get_failure_summary, replay_receipts
+from atol.throttling import RateLimiter
+
+
+class Command(BaseCommand):
+    help = ('List failed receipts by failure reason and atol error code, or replay them: '
+            'receipts already registered in atol are retried with a fresh internal_uuid, '
+            'the rest are registered again. Receipts are dispatched at a throttled rate.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='day_from', type=date_argument, help='First day of failure, YYYY-MM-DD')
+        parser.add_argument('--to', dest='day_to', type=date_argument,
+                            help='Last day of failure (inclusive), YYYY-MM-DD')
+        parser.add_argument('--reason', dest='reasons', action='append', choices=[r for r, _ in FailureReason],
+                            help='Failure reason to select, may be repeated')
+        parser.add_argument('--error-code', dest='error_codes', action='append', type=int,
+                            help='Atol error code to select, may be repeated')
+        parser.add_argument('--replay', action='store_true', help='Replay the selected receipts instead of listing')
+        parser.add_argument('--rate', type=float, default=5, help='Receipts dispatched per second, 0 for unlimited')
+        parser.add_argument('--chunk-size', type=int, default=100, help='Number of receipts replayed at once')
+
+    def handle(self, *args, **options):
+        receipts = get_failed_receipts(day_from=options['day_from'], day_to=options['day_to'],
+                                       reasons=options['reasons'], error_codes=options['error_codes'])
+        if not options['replay']:
+            self.list_failures(receipts)
+            return
+
+        replayed = 0
+        for chunk in replay_receipts(receipts, options['chunk_size'], RateLimiter(options['rate'])):
+            replayed += len(chunk)
+            self.stdout.write('replayed {} receipts up to id {}'.format(replayed, chunk[-1].id if chunk else '-'))
+        self.stdout.write('done: {} receipts replayed'.format(replayed))
+
+    def list_failures(self, receipts):
+        self.stdout.write('status\treason\terror_code\treceipts\tattempts\tlast_failed_at')
+        for row in get_failure_summary(receipts):
+            self.stdout.write('\t'.join([
+                row.status,
+                row.failure_reason or '-',
+                '-' if row.error_code is None else str(row.error_code),
+                str(row.receipts),
+                '{:.1f}'.format(row.attempts or 0),
+                row.last_failed_at.isoformat() if row.last_failed_at else '-',
+            ]))
@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from atol.instrumentation import clear_slow_calls, get_slow_calls
+
+
+def format_call(call):
+    details = ' '.join('{}={}'.format(name, value) for name, value in sorted(call['details'].items()))
+    lines = ['{started_at} {name} {duration:.3f}s'.format(**call) + (' ' + details if details else '')]
+    if call['phases']:
+        lines.append('  phases: ' + ', '.join('{} {:.3f}s'.format(name, seconds)
+                                              for name, seconds in call['phases'].items()))
+    if call['sizes']:
+        lines.append('  sizes: ' + ', '.join('{} {}B'.format(name, size) for name, size in call['sizes'].items()))
+    for stack, samples in call['profile'] or []:
+        lines.append('  {:>5} {}'.format(samples, stack))
+    return '\n'.join(lines)
+
+
+class Command(BaseCommand):
+    help = ('Dump the slow atol requests and task executions recorded by every worker '
+            '(RECEIPTS_ATOL_SLOW_CALL_THRESHOLD), along with the sampled profiles (ATOL_PROFILE_TASKS)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='Dump the calls as JSON lines')
+        parser.add_argument('--name', action='append', help='Only calls of the request or task, may be repeated')
+        parser.add_argument('--clear', action='store_true', help='Empty the buffer after dumping it')
+
+    def handle(self, *args, **options):
+        calls = get_slow_calls()
+        if options['name']:
+            calls = [call for call in calls if call['name'] in options['name']]
+
+        for call in calls:
+            self.stdout.write(json.dumps(call) if options['json'] else format_call(call))
+
+        if options['clear']:
+            clear_slow_calls()
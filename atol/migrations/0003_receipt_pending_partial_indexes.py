@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+PARTIAL_INDEXES = [
+    ('atol_receipt_created_partial_idx', 'created_at', 'created'),
+    ('atol_receipt_initiated_partial_idx', 'initiated_at', 'initiated'),
+    ('atol_receipt_retried_partial_idx', 'retried_at', 'retried'),
+]
+
+
+class Migration(migrations.Migration):
+    # indexes are built concurrently not to lock the table, which can not be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('atol', '0002_receipt_retried_at'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY {name} ON atol_receipt ({column}) WHERE status = '{status}'".format(
+                name=name, column=column, status=status),
+            'DROP INDEX CONCURRENTLY IF EXISTS {name}'.format(name=name),
+        )
+        for name, column, status in PARTIAL_INDEXES
+    ]
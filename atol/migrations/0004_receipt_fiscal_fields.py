@@ -0,0 +1,43 @@
+# Generated by Django 4.1.13 on 2026-10-19 00:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atol', '0003_receipt_pending_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='fiscal_document_attribute',
+            field=models.BigIntegerField(editable=False, null=True, verbose_name='Фискальный признак документа'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='fiscal_document_number',
+            field=models.BigIntegerField(editable=False, null=True, verbose_name='Номер фискального документа'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='fiscal_receipt_number',
+            field=models.BigIntegerField(editable=False, null=True, verbose_name='Номер чека за смену'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='fn_number',
+            field=models.CharField(editable=False, max_length=32, null=True, verbose_name='Номер ФН'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='receipt_datetime',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='Дата и время чека'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='total',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=12, null=True, verbose_name='Итоговая сумма чека'),
+        ),
+    ]
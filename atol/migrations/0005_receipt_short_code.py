@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the unique index is built concurrently not to lock the table, which can not be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('atol', '0004_receipt_fiscal_fields'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='receipt',
+                    name='short_code',
+                    field=models.CharField(editable=False, help_text='Закодированный shortuuid internal_uuid', max_length=22, null=True, unique=True, verbose_name='Короткий код ссылки на чек'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    'ALTER TABLE atol_receipt ADD COLUMN short_code varchar(22) NULL',
+                    'ALTER TABLE atol_receipt DROP COLUMN short_code',
+                ),
+                migrations.RunSQL(
+                    'CREATE UNIQUE INDEX CONCURRENTLY atol_receipt_short_code_key ON atol_receipt (short_code)',
+                    'DROP INDEX CONCURRENTLY IF EXISTS atol_receipt_short_code_key',
+                ),
+            ],
+        ),
+    ]
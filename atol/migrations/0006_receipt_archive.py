@@ -0,0 +1,30 @@
+# Generated by Django 4.1.13 on 2026-10-19 01:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atol', '0005_receipt_short_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptArchive',
+            fields=[
+                ('receipt', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='atol.receipt', verbose_name='Чек')),
+                ('content', models.BinaryField(verbose_name='Сжатое содержимое чека')),
+            ],
+            options={
+                'verbose_name': 'Архив чека Атола',
+                'verbose_name_plural': 'Архив чеков Атола',
+            },
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='archived_at',
+            field=models.DateTimeField(editable=False, help_text='Содержимое архивного чека хранится в ReceiptArchive', null=True, verbose_name='Дата архивации чека'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.1.13 on 2026-10-19 01:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the created_at index is built concurrently not to lock the table, which can not be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('atol', '0006_receipt_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День создания чеков')),
+                ('status', models.CharField(choices=[('created', 'Ожидает инициации в системе оператора'), ('initiated', 'Иницирован в системе оператора'), ('retried', 'Повторно иницирован в системе оператора'), ('received', 'Получен от оператора'), ('no_email_phone', 'Отсутствует email/phone'), ('failed', 'Ошибка')], max_length=16, verbose_name='Статус чеков')),
+                ('shard', models.PositiveSmallIntegerField(default=0, verbose_name='Шард счетчика')),
+                ('count', models.BigIntegerField(default=0, verbose_name='Количество чеков')),
+            ],
+            options={
+                'verbose_name': 'Счетчик чеков Атола',
+                'verbose_name_plural': 'Счетчики чеков Атола',
+                'unique_together': {('day', 'status', 'shard')},
+            },
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='receipt',
+                    index=models.Index(fields=['created_at'], name='atol_receipt_created_at_idx'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    'CREATE INDEX CONCURRENTLY atol_receipt_created_at_idx ON atol_receipt (created_at)',
+                    'DROP INDEX CONCURRENTLY IF EXISTS atol_receipt_created_at_idx',
+                ),
+            ],
+        ),
+    ]
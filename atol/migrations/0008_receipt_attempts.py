@@ -0,0 +1,33 @@
+# Generated by Django 4.1.13 on 2026-10-19 01:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('atol', '0007_receipt_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Попытки регистрации'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='group_code',
+            field=models.CharField(editable=False, help_text='Группа ККТ, в которой чек был инициирован', max_length=64, null=True, verbose_name='Группа ККТ'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='polls',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Запросы отчета'),
+        ),
+        # keep the database defaults for the rows inserted by application instances not yet aware of the columns
+        migrations.RunSQL(
+            'ALTER TABLE atol_receipt ALTER COLUMN attempts SET DEFAULT 0, ALTER COLUMN polls SET DEFAULT 0',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.13 on 2026-10-19 01:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the failed receipts index is built concurrently not to lock the table, which can not be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('atol', '0009_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='error_code',
+            field=models.IntegerField(editable=False, help_text='Код ошибки, которую вернул оператор', null=True, verbose_name='Код ошибки'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='failure_reason',
+            field=models.CharField(choices=[('no_email_phone', 'Отсутствует email/phone'), ('invalid', 'Данные чека не прошли проверку'), ('rejected', 'Регистрация чека отклонена оператором'), ('attempts_exhausted', 'Исчерпаны попытки регистрации'), ('report_rejected', 'Запрос отчета отклонен оператором'), ('report_attempts_exhausted', 'Исчерпаны попытки получения отчета')], editable=False, max_length=32, null=True, verbose_name='Причина ошибки'),
+        ),
+        # selection of failed receipts to replay by the date of failure
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY atol_receipt_failed_partial_idx ON atol_receipt (failed_at) "
+            "WHERE status IN ('no_email_phone', 'failed')",
+            'DROP INDEX CONCURRENTLY IF EXISTS atol_receipt_failed_partial_idx',
+        ),
+    ]
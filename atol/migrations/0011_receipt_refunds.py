@@ -0,0 +1,37 @@
+# Generated by Django 4.1.13 on 2026-10-19 01:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    # the refunds index is built concurrently not to lock the table, which can not be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('atol', '0010_receipt_failure_reason'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='operation',
+            field=models.CharField(choices=[('sell', 'Приход'), ('sell_refund', 'Возврат прихода')], default='sell', editable=False, max_length=16, verbose_name='Операция'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='original_receipt',
+            field=models.ForeignKey(db_index=False, editable=False, help_text='Чек прихода, который отменяется чеком возврата', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='refunds', to='atol.receipt', verbose_name='Исходный чек'),
+        ),
+            # keep the database default for the rows inserted by application instances not yet aware of the column
+        migrations.RunSQL(
+            "ALTER TABLE atol_receipt ALTER COLUMN operation SET DEFAULT 'sell'",
+            migrations.RunSQL.noop,
+        ),
+        # refunds of a receipt, only refund rows are indexed
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY atol_receipt_refunds_partial_idx ON atol_receipt (original_receipt_id) '
+            'WHERE original_receipt_id IS NOT NULL',
+            'DROP INDEX CONCURRENTLY IF EXISTS atol_receipt_refunds_partial_idx',
+        ),
+    ]
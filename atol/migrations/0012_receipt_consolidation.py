@@ -0,0 +1,38 @@
+# Generated by Django 4.1.13 on 2026-10-19 01:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    # the consolidated receipts index is built concurrently not to lock the table,
+    # which can not be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('atol', '0011_receipt_refunds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='consolidated_into',
+            field=models.ForeignKey(db_index=False, editable=False, help_text='Чек, зарегистрированный в системе оператора за несколько покупок, включая эту; ссылается на себя у первой покупки', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='atol.receipt', verbose_name='Объединенный чек'),
+        ),
+        migrations.AlterField(
+            model_name='receipt',
+            name='status',
+            field=models.CharField(choices=[('created', 'Ожидает инициации в системе оператора'), ('initiated', 'Иницирован в системе оператора'), ('retried', 'Повторно иницирован в системе оператора'), ('received', 'Получен от оператора'), ('no_email_phone', 'Отсутствует email/phone'), ('failed', 'Ошибка'), ('consolidated', 'Объединен с другим чеком')], default='created', max_length=16, verbose_name='Статус чека'),
+        ),
+        migrations.AlterField(
+            model_name='receiptcounter',
+            name='status',
+            field=models.CharField(choices=[('created', 'Ожидает инициации в системе оператора'), ('initiated', 'Иницирован в системе оператора'), ('retried', 'Повторно иницирован в системе оператора'), ('received', 'Получен от оператора'), ('no_email_phone', 'Отсутствует email/phone'), ('failed', 'Ошибка'), ('consolidated', 'Объединен с другим чеком')], max_length=16, verbose_name='Статус чеков'),
+        ),
+        # purchases of a consolidated receipt, only consolidated rows are indexed
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY atol_receipt_consolidated_partial_idx ON atol_receipt (consolidated_into_id) '
+            'WHERE consolidated_into_id IS NOT NULL',
+            'DROP INDEX CONCURRENTLY IF EXISTS atol_receipt_consolidated_partial_idx',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.1.13 on 2026-10-19 01:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the held receipts index is built concurrently not to lock the table,
+    # which can not be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('atol', '0012_receipt_consolidation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='receipt',
+            name='status',
+            field=models.CharField(choices=[('created', 'Ожидает инициации в системе оператора'), ('initiated', 'Иницирован в системе оператора'), ('retried', 'Повторно иницирован в системе оператора'), ('received', 'Получен от оператора'), ('no_email_phone', 'Отсутствует email/phone'), ('failed', 'Ошибка'), ('consolidated', 'Объединен с другим чеком'), ('held', 'Ожидает допуска к регистрации')], default='created', max_length=16, verbose_name='Статус чека'),
+        ),
+        migrations.AlterField(
+            model_name='receiptcounter',
+            name='status',
+            field=models.CharField(choices=[('created', 'Ожидает инициации в системе оператора'), ('initiated', 'Иницирован в системе оператора'), ('retried', 'Повторно иницирован в системе оператора'), ('received', 'Получен от оператора'), ('no_email_phone', 'Отсутствует email/phone'), ('failed', 'Ошибка'), ('consolidated', 'Объединен с другим чеком'), ('held', 'Ожидает допуска к регистрации')], max_length=16, verbose_name='Статус чеков'),
+        ),
+        # held receipts are released oldest first, only held rows are indexed
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY atol_receipt_held_partial_idx ON atol_receipt (created_at) "
+            "WHERE status = 'held'",
+            'DROP INDEX CONCURRENTLY IF EXISTS atol_receipt_held_partial_idx',
+        ),
+    ]
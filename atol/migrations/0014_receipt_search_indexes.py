@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# admin search: exact atol uuid, email and phone prefixes looked up case insensitively,
+# the expressions match the ones django builds for istartswith
+SEARCH_INDEXES = [
+    ('atol_receipt_uuid_idx', 'uuid'),
+    ('atol_receipt_user_email_upper_idx', 'UPPER(user_email::text) text_pattern_ops'),
+    ('atol_receipt_user_phone_upper_idx', 'UPPER(user_phone::text) text_pattern_ops'),
+]
+
+
+class Migration(migrations.Migration):
+    # indexes are built concurrently not to lock the table, which can not be done inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('atol', '0013_receipt_held'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY {name} ON atol_receipt ({expression})'.format(name=name, expression=expression),
+            'DROP INDEX CONCURRENTLY IF EXISTS {name}'.format(name=name),
+        )
+        for name, expression in SEARCH_INDEXES
+    ]
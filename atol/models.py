@@ -1,9 +1,12 @@
 import logging
-from uuid import uuid4
+from collections import namedtuple
+from uuid import UUID, uuid4
 
 import shortuuid
 from django.contrib.postgres.fields import JSONField
+from django.conf import settings
 from django.db import models, transaction
+from django.db.models import F
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
@@ -14,11 +17,24 @@ except ImportError:
     from django.core.urlresolvers import reverse
 from model_utils import Choices
 
-from atol.signals import receipt_failed, receipt_initiated, receipt_received
+from atol.admission import admit
+from atol.counters import count_transitions
+from atol.dispatch import get_chunk_size, schedule_receipts
+from atol.signals import (receipt_failed, receipt_initiated, receipt_received,
+                          receipts_failed, receipts_initiated, receipts_received, send_receipt_signal)
 from atol.exceptions import NoEmailAndPhoneError
+from atol.routing import get_write_database
+from atol.utils import compress_content, decompress_content, get_fiscal_data
 
 logger = logging.getLogger(__name__)
 
+CreatedReceipt = namedtuple('CreatedReceipt', ['id', 'ofd_link'])
+
+BULK_UPDATE_BATCH_SIZE = 1000
+
+FISCAL_FIELDS = ['fn_number', 'fiscal_document_number', 'fiscal_document_attribute',
+                 'fiscal_receipt_number', 'total', 'receipt_datetime']
+
 
 ReceiptStatus = Choices(
     ('created', _('Ожидает инициации в системе оператора')),
@@ -27,11 +43,323 @@ ReceiptStatus = Choices(
     ('received', _('Получен от оператора')),
     ('no_email_phone', _('Отсутствует email/phone')),
     ('failed', _('Ошибка')),
+    ('consolidated', _('Объединен с другим чеком')),
+    ('held', _('Ожидает допуска к регистрации')),
+)
+
+
+# receipts which are not going to change anymore
+TERMINAL_STATUSES = [ReceiptStatus.received, ReceiptStatus.no_email_phone, ReceiptStatus.failed]
+
+FAILED_STATUSES = [ReceiptStatus.no_email_phone, ReceiptStatus.failed]
+
+# receipts which may be registered in atol, and the ones which may get their report
+INITIABLE_STATUSES = [ReceiptStatus.created, ReceiptStatus.retried]
+RECEIVABLE_STATUSES = [ReceiptStatus.initiated, ReceiptStatus.retried]
+
+# values are the names of the AtolAPI methods registering the receipts
+ReceiptOperation = Choices(
+    ('sell', _('Приход')),
+    ('sell_refund', _('Возврат прихода')),
+)
+
+
+FailureReason = Choices(
+    ('no_email_phone', _('Отсутствует email/phone')),
+    ('invalid', _('Данные чека не прошли проверку')),
+    ('rejected', _('Регистрация чека отклонена оператором')),
+    ('attempts_exhausted', _('Исчерпаны попытки регистрации')),
+    ('report_rejected', _('Запрос отчета отклонен оператором')),
+    ('report_attempts_exhausted', _('Исчерпаны попытки получения отчета')),
 )
 
 
+def get_group_code():
+    return getattr(settings, 'RECEIPTS_ATOL_GROUP_CODE', None)
+
+
+class ReceiptQuerySet(models.QuerySet):
+
+    def bulk_create_receipts(self, receipts, batch_size=None, dispatch=True):
+        """
+        Insert receipts with as few queries as possible,
+        then register them in atol in chunks once the current transaction commits.
+
+        :param receipts: Unsaved Receipt instances or dicts of Receipt field values
+        :param batch_size: Number of rows per INSERT query
+        :param dispatch: Whether to register the receipts in atol, the caller is responsible for that otherwise;
+                         receipts are held instead while the intake is closed or beyond the room under
+                         the high watermark, see atol.admission
+        :return: list of CreatedReceipt(id, ofd_link) in the order of the given receipts
+        """
+        receipts = [receipt if isinstance(receipt, Receipt) else Receipt(**receipt)
+                    for receipt in receipts]
+        for receipt in receipts:
+            receipt.set_short_code()
+        with transaction.atomic(using=self.db):
+            pending = [receipt for receipt in receipts if receipt.status == ReceiptStatus.created]
+            if dispatch and pending:
+                # the receipts beyond the room under the high watermark are held
+                for receipt in pending[admit(len(pending), using=self.db):]:
+                    receipt.status = ReceiptStatus.held
+            created = self.bulk_create(receipts, batch_size=batch_size or get_chunk_size())
+            count_transitions([(receipt, None) for receipt in created], using=self.db)
+            if dispatch:
+                schedule_receipts([receipt.id for receipt in created if receipt.status != ReceiptStatus.held],
+                                  using=self.db)
+        logger.info('created %s receipts', len(created))
+        return [CreatedReceipt(id=receipt.id, ofd_link=receipt.ofd_link) for receipt in created]
+
+    def created_between(self, start, end):
+        """Receipts waiting to be initiated since the given period, served by a partial index"""
+        return self.filter(status=ReceiptStatus.created, created_at__range=(start, end)).order_by()
+
+    def initiated_between(self, start, end):
+        """Receipts waiting for the report since the given period, served by a partial index"""
+        return self.filter(status=ReceiptStatus.initiated, initiated_at__range=(start, end)).order_by()
+
+    def held(self):
+        """Receipts waiting for the intake to open, served by a partial index"""
+        return self.filter(status=ReceiptStatus.held)
+
+    def failed(self):
+        """Failed receipts, served by a partial index on the date of failure"""
+        return self.filter(status__in=FAILED_STATUSES)
+
+    def archivable(self, before):
+        """Terminal receipts created before the given date which reports are still stored inline"""
+        return self.filter(status__in=TERMINAL_STATUSES, created_at__lt=before, archived_at__isnull=True)
+
+    def cancellable(self):
+        """Received sells which have not been refunded yet, failed refunds are to be replayed instead"""
+        return self.filter(operation=ReceiptOperation.sell, status=ReceiptStatus.received, refunds__isnull=True)
+
+    def bulk_cancel(self, dispatch=True):
+        """
+        Create refund receipts (sell_refund) of the cancellable receipts of the queryset,
+        then register them in atol in chunks once the current transaction commits, like sells
+
+        :param dispatch: Whether to register the refunds in atol, the caller is responsible for that otherwise
+        :return: list of CreatedReceipt(id, ofd_link) of the refunds
+        """
+        originals = (self.cancellable().order_by('id')
+                     .only('id', 'purchase_price', 'purchase_name', 'total', 'consolidated_into_id'))
+        refunds = [
+            Receipt(operation=ReceiptOperation.sell_refund, original_receipt_id=original.id,
+                    purchase_price=original.refund_amount, purchase_name=original.purchase_name)
+            for original in originals
+        ]
+        return self.model._default_manager.using(self.db).bulk_create_receipts(refunds, dispatch=dispatch)
+
+    def bulk_archive(self):
+        """
+        Move reports of the receipts into ReceiptArchive compressed.
+        Receipt rows stay in place, so that links and foreign keys to them keep working.
+
+        :return: list of archived receipts
+        """
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            receipts = list(self.filter(archived_at__isnull=True).select_for_update())
+            archives = []
+            for receipt in receipts:
+                if receipt.status == ReceiptStatus.received and receipt.fn_number is None:
+                    # links of archived receipts are resolved by the fiscal columns only
+                    receipt.set_fiscal_data()
+                if receipt.content is not None:
+                    archives.append(ReceiptArchive(receipt=receipt, content=compress_content(receipt.content)))
+                receipt.content = None
+                receipt.archived_at = now
+            ReceiptArchive.objects.using(self.db).bulk_create(archives)
+            self.bulk_update_fields(receipts, ['content', 'archived_at'] + FISCAL_FIELDS)
+            logger.info('archived %s receipts', len(receipts))
+        return receipts
+
+    def bulk_retry(self):
+        """
+        Bulk version of the retried path of atol_receive_receipt_report: the receipts get a fresh internal_uuid
+        and are registered in atol again once the current transaction commits
+
+        :return: list of retried receipts
+        """
+        using = get_write_database(self.model)
+        queryset = self.using(using)
+        with transaction.atomic(using=using):
+            receipts = list(queryset.lock_rows())
+            # links carry the codes of the previous internal_uuids
+            invalidate_statuses(receipts, using=using)
+            transitions = []
+            for receipt in receipts:
+                transitions.append((receipt, receipt.status))
+                receipt.internal_uuid = uuid4()
+                receipt.set_short_code()
+                receipt.status = ReceiptStatus.retried
+            queryset.bulk_update_fields(receipts, ['internal_uuid', 'short_code', 'status'])
+            count_transitions(transitions, using=using)
+            schedule_receipts([receipt.id for receipt in receipts], using=using)
+            logger.info('retried %s receipts', len(receipts))
+        return receipts
+
+    def bulk_release(self):
+        """
+        Dispatch held receipts of the queryset once the current transaction commits,
+        receipts being released concurrently are skipped
+
+        :return: list of released receipts
+        """
+        with transaction.atomic(using=self.db):
+            receipts = list(self.filter(status=ReceiptStatus.held).select_for_update(skip_locked=True))
+            transitions = [(receipt, receipt.status) for receipt in receipts]
+            for receipt in receipts:
+                receipt.status = ReceiptStatus.created
+            self.filter(pk__in=[receipt.pk for receipt in receipts]).update(status=ReceiptStatus.created)
+            count_transitions(transitions, using=self.db)
+            invalidate_statuses(receipts, using=self.db)
+            schedule_receipts([receipt.id for receipt in receipts], using=self.db)
+            logger.info('released %s held receipts', len(receipts))
+        return receipts
+
+    def bulk_replay(self, dispatch=True):
+        """
+        Send failed receipts of the queryset through the pipeline again once the current transaction commits.
+        Receipts which have been registered in atol get a fresh internal_uuid and go the retried path,
+        since atol keeps the outcome of an external_id; the rest are registered again as they are.
+
+        :param dispatch: Whether to register the receipts in atol, the caller is responsible for that otherwise
+        :return: list of replayed receipts
+        """
+        with transaction.atomic(using=self.db):
+            receipts = list(self.filter(status__in=FAILED_STATUSES).select_for_update())
+            # links carry the codes of the previous internal_uuids
+            invalidate_statuses(receipts, using=self.db)
+            transitions = []
+            for receipt in receipts:
+                transitions.append((receipt, receipt.status))
+                if receipt.uuid:
+                    receipt.internal_uuid = uuid4()
+                    receipt.set_short_code()
+                    receipt.status = ReceiptStatus.retried
+                else:
+                    receipt.status = ReceiptStatus.created
+                receipt.failed_at = None
+                receipt.failure_reason = None
+                receipt.error_code = None
+            self.bulk_update_fields(receipts, ['internal_uuid', 'short_code', 'status', 'failed_at',
+                                               'failure_reason', 'error_code'])
+            count_transitions(transitions, using=self.db)
+            if dispatch:
+                schedule_receipts([receipt.id for receipt in receipts], using=self.db)
+            logger.info('replayed %s failed receipts', len(receipts))
+        return receipts
+
+    def lock_rows(self):
+        """Lock the rows of the queryset for update, without loading the reports stored inline"""
+        return self.select_for_update().defer('content')
+
+    def bulk_update_fields(self, receipts, fields):
+        """bulk_update compatible with Django < 2.2"""
+        if hasattr(self, 'bulk_update'):
+            self.bulk_update(receipts, fields, batch_size=BULK_UPDATE_BATCH_SIZE)
+        else:  # Django < 2.2
+            for receipt in receipts:
+                receipt.save(update_fields=fields)
+
+    def _send_signals(self, signal, batch_signal, receipts):
+        send_receipt_signal(batch_signal, receipts, using=self.db)
+        # keep the receivers of the per receipt signal informed
+        send_receipt_signal(signal, receipts, using=self.db)
+
+    def bulk_declare_failed(self, status=None, reason=None, error_code=None):
+        """
+        Bulk version of Receipt.declare_failed for all receipts of the queryset
+
+        :return: list of receipts declared failed
+        """
+        status = status or ReceiptStatus.failed
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            # reports are not needed to declare the receipts failed, see lock_rows
+            receipts = list(self.lock_rows())
+            (self.model._default_manager.using(self.db)
+             .filter(pk__in=[receipt.pk for receipt in receipts])
+             .update(status=status, failed_at=now, failure_reason=reason, error_code=error_code))
+            transitions = []
+            for receipt in receipts:
+                transitions.append((receipt, receipt.status))
+                receipt.status = status
+                receipt.failed_at = now
+                receipt.failure_reason = reason
+                receipt.error_code = error_code
+            count_transitions(transitions, using=self.db)
+            members = fail_consolidated(receipts, using=self.db)
+            invalidate_statuses(receipts + members, using=self.db)
+            logger.warning('declared %s receipts as failed', len(receipts))
+            self._send_signals(receipt_failed, receipts_failed, receipts + members)
+        return receipts
+
+    def bulk_initiate(self, uuids):
+        """
+        Bulk version of Receipt.initiate
+
+        :param uuids: Mapping of receipt id to the receipt uuid returned by atol
+        :return: list of initiated receipts
+        """
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            # receipts moved on by the pipeline meanwhile are left as they are
+            receipts = list(self.filter(pk__in=list(uuids), status__in=INITIABLE_STATUSES).lock_rows())
+            transitions = []
+            group_code = get_group_code()
+            for receipt in receipts:
+                transitions.append((receipt, receipt.status))
+                receipt.uuid = uuids[receipt.pk]
+                receipt.group_code = group_code
+                if receipt.status == ReceiptStatus.retried:
+                    receipt.retried_at = now
+                else:
+                    receipt.initiated_at = now
+                    receipt.status = ReceiptStatus.initiated
+            self.bulk_update_fields(receipts, ['uuid', 'group_code', 'status', 'initiated_at', 'retried_at'])
+            count_transitions(transitions, using=self.db)
+            invalidate_statuses(receipts, using=self.db)
+            logger.info('initiated %s receipts', len(receipts))
+            self._send_signals(receipt_initiated, receipts_initiated, receipts)
+        return receipts
+
+    def bulk_receive(self, contents):
+        """
+        Bulk version of Receipt.receive
+
+        :param contents: Mapping of receipt id to the receipt report received from atol
+        :return: list of received receipts
+        """
+        from atol.links import cache_ofd_urls
+
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            # receipts moved on by the pipeline meanwhile are left as they are
+            receipts = list(self.filter(pk__in=list(contents), status__in=RECEIVABLE_STATUSES).lock_rows())
+            transitions = []
+            for receipt in receipts:
+                transitions.append((receipt, receipt.status))
+                receipt.content = contents[receipt.pk]
+                receipt.status = ReceiptStatus.received
+                receipt.received_at = now
+                receipt.set_fiscal_data()
+            self.bulk_update_fields(receipts, ['content', 'status', 'received_at'] + FISCAL_FIELDS)
+            count_transitions(transitions, using=self.db)
+            members = receive_consolidated(receipts, using=self.db)
+            cache_ofd_urls(receipts + members, using=self.db)
+            invalidate_statuses(receipts + members, using=self.db)
+            logger.info('received %s receipts', len(receipts))
+            self._send_signals(receipt_received, receipts_received, receipts + members)
+        return receipts
+
+
 class Receipt(models.Model):
     internal_uuid = models.UUIDField(default=uuid4, unique=True, editable=False)
+    short_code = models.CharField(_('Короткий код ссылки на чек'), max_length=22, unique=True, null=True,
+                                  editable=False, help_text=_('Закодированный shortuuid internal_uuid'))
 
     created_at = models.DateTimeField(_('Дата создания чека'), auto_now_add=True, editable=False)
     initiated_at = models.DateTimeField(_('Дата инициализации чека в системе оператора'), blank=True, null=True)
@@ -39,6 +367,10 @@ class Receipt(models.Model):
                                       blank=True, null=True)
     received_at = models.DateTimeField(_('Дата получения чека от оператора'), blank=True, null=True)
     failed_at = models.DateTimeField(_('Дата ошибки'), blank=True, null=True)
+    failure_reason = models.CharField(_('Причина ошибки'), max_length=32, choices=FailureReason, null=True,
+                                      editable=False)
+    error_code = models.IntegerField(_('Код ошибки'), null=True, editable=False,
+                                     help_text=_('Код ошибки, которую вернул оператор'))
 
     status = models.CharField(_('Статус чека'), max_length=16, choices=ReceiptStatus,
                               default=ReceiptStatus.created)
@@ -46,30 +378,128 @@ class Receipt(models.Model):
                             help_text=_('Идентификатор чека платежа в системе оператора'))
     content = JSONField(_('Содержимое чека'), null=True, editable=False)
 
+    # fiscal attributes of the received receipt copied from the content
+    fn_number = models.CharField(_('Номер ФН'), max_length=32, null=True, editable=False)
+    fiscal_document_number = models.BigIntegerField(_('Номер фискального документа'), null=True, editable=False)
+    fiscal_document_attribute = models.BigIntegerField(_('Фискальный признак документа'), null=True,
+                                                       editable=False)
+    fiscal_receipt_number = models.BigIntegerField(_('Номер чека за смену'), null=True, editable=False)
+    total = models.DecimalField(_('Итоговая сумма чека'), max_digits=12, decimal_places=2, null=True,
+                                editable=False)
+    receipt_datetime = models.DateTimeField(_('Дата и время чека'), null=True, editable=False)
+
     user_email = models.CharField(_('Email пользователя'), max_length=254, null=True)
     user_phone = models.CharField(_('Телефон пользователя'), max_length=32, null=True)
     purchase_price = models.DecimalField(_('Цена покупки'), max_digits=8, decimal_places=2, null=True)
     purchase_name = models.TextField(_('Наименование покупки'), null=True)
 
+    operation = models.CharField(_('Операция'), max_length=16, choices=ReceiptOperation,
+                                 default=ReceiptOperation.sell, editable=False)
+    original_receipt = models.ForeignKey('self', verbose_name=_('Исходный чек'), null=True, editable=False,
+                                         on_delete=models.PROTECT, related_name='refunds', db_index=False,
+                                         help_text=_('Чек прихода, который отменяется чеком возврата'))
+    consolidated_into = models.ForeignKey('self', verbose_name=_('Объединенный чек'), null=True, editable=False,
+                                          on_delete=models.PROTECT, related_name='+', db_index=False,
+                                          help_text=_('Чек, зарегистрированный в системе оператора за несколько '
+                                                      'покупок, включая эту; ссылается на себя у первой покупки'))
+
+    group_code = models.CharField(_('Группа ККТ'), max_length=64, null=True, editable=False,
+                                  help_text=_('Группа ККТ, в которой чек был инициирован'))
+    attempts = models.PositiveIntegerField(_('Попытки регистрации'), default=0, editable=False)
+    polls = models.PositiveIntegerField(_('Запросы отчета'), default=0, editable=False)
+
+    archived_at = models.DateTimeField(_('Дата архивации чека'), null=True, editable=False,
+                                       help_text=_('Содержимое архивного чека хранится в ReceiptArchive'))
+
+    objects = ReceiptQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('Чек Атола')
         verbose_name_plural = _('Чеки Атола')
         ordering = ['id']
+        indexes = [
+            # reconciliation of receipt counters and exports by creation date
+            models.Index(fields=['created_at'], name='atol_receipt_created_at_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'internal_uuid' in update_fields:
+            self.set_short_code()
+            if update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + ['short_code']
+
+        if not self._state.adding:
+            super(Receipt, self).save(*args, **kwargs)
+            return
+        using = kwargs.get('using') or get_write_database(Receipt)
+        with transaction.atomic(using=using):
+            super(Receipt, self).save(*args, **kwargs)
+            count_transitions([(self, None)], using=self._state.db)
+
+    def set_short_code(self):
+        internal_uuid = self.internal_uuid
+        if not isinstance(internal_uuid, UUID):
+            internal_uuid = UUID(str(internal_uuid))
+        self.short_code = shortuuid.encode(internal_uuid)
 
     @cached_property
     def ofd_link(self):
         """Return the receipt url"""
         return reverse('receipt', kwargs={'short_uuid': shortuuid.encode(self.internal_uuid)})
 
+    @property
+    def signed_ofd_link(self):
+        """
+        Return the receipt url resolved without a database lookup, once the receipt is received.
+        Fall back to ofd_link until then.
+        """
+        from atol.links import make_signed_token
+
+        token = make_signed_token(self)
+        if not token:
+            return self.ofd_link
+        return reverse('receipt', kwargs={'short_uuid': token})
+
+    def dispatch(self):
+        """
+        Register the receipt in atol once the current transaction commits,
+        hold it instead while the intake is closed, see atol.admission
+        """
+        if self.status == ReceiptStatus.created and not admit(using=self._state.db):
+            self.hold()
+            return
+        schedule_receipts([self.id], using=self._state.db)
+
+    def hold(self):
+        """Keep the receipt from being registered in atol until it is released by atol_release_held_receipts"""
+        previous_status = self.status
+        self.status = ReceiptStatus.held
+        using = get_write_database(Receipt)
+        with transaction.atomic(using=using):
+            self.save(update_fields=['status'], using=using)
+            count_transitions([(self, previous_status)], using=using)
+            invalidate_statuses([self], using=using)
+        logger.info('holding receipt %s', self.id)
+
     @transaction.atomic()
-    def declare_failed(self, status=None):
-        logger.warning('declaring receipt %s as failed', self.id)
+    def declare_failed(self, status=None, reason=None, error_code=None):
+        logger.warning('declaring receipt %s as failed due to %s (error code %s)', self.id, reason, error_code)
+        previous_status = self.status
         self.status = status or ReceiptStatus.failed
         self.failed_at = timezone.now()
-        self.save(update_fields=['status', 'failed_at'])
-        receipt_failed.send(sender=None, receipt=self)
+        self.failure_reason = reason
+        self.error_code = error_code
+        self.save(update_fields=['status', 'failed_at', 'failure_reason', 'error_code'],
+                  using=get_write_database(Receipt))
+        count_transitions([(self, previous_status)], using=self._state.db)
+        members = fail_consolidated([self], using=self._state.db)
+        invalidate_statuses([self] + members, using=self._state.db)
+        send_receipt_signal(receipt_failed, [self] + members, using=self._state.db)
 
     def initiate(self, **kwargs):
+        previous_status = self.status
+        kwargs.setdefault('group_code', get_group_code())
         for k, v in kwargs.items():
             setattr(self, k, v)
         update_fields = list(kwargs.keys())
@@ -83,18 +513,102 @@ class Receipt(models.Model):
             self.status = ReceiptStatus.initiated
             update_fields += ['initiated_at', 'status']
 
-        self.save(update_fields=update_fields)
-        receipt_initiated.send(sender=None, receipt=self)
+        using = get_write_database(Receipt)
+        with transaction.atomic(using=using):
+            self.save(update_fields=update_fields, using=using)
+            count_transitions([(self, previous_status)], using=using)
+            invalidate_statuses([self], using=using)
+        send_receipt_signal(receipt_initiated, [self], using=using)
 
     def receive(self, **kwargs):
+        from atol.links import cache_ofd_urls
+
+        previous_status = self.status
         for k, v in kwargs.items():
             setattr(self, k, v)
         self.status = ReceiptStatus.received
         self.received_at = timezone.now()
-        self.save(update_fields=list(kwargs.keys()) + ['status', 'received_at'])
-        receipt_received.send(sender=None, receipt=self)
+        self.set_fiscal_data()
+        using = get_write_database(Receipt)
+        with transaction.atomic(using=using):
+            self.save(update_fields=list(kwargs.keys()) + ['status', 'received_at'] + FISCAL_FIELDS, using=using)
+            count_transitions([(self, previous_status)], using=using)
+            members = receive_consolidated([self], using=using)
+            cache_ofd_urls([self] + members, using=using)
+            invalidate_statuses([self] + members, using=using)
+        send_receipt_signal(receipt_received, [self] + members, using=using)
+
+    def retry(self):
+        """
+        Move the receipt to the retried status under a fresh internal_uuid,
+        since atol keeps the outcome of an external_id
+        """
+        previous_status = self.status
+        using = get_write_database(Receipt)
+        with transaction.atomic(using=using):
+            # links carry the code of the previous internal_uuid
+            invalidate_statuses([self], using=using)
+            self.internal_uuid = uuid4()
+            self.status = ReceiptStatus.retried
+            self.save(update_fields=['internal_uuid', 'status'], using=using)
+            count_transitions([(self, previous_status)], using=using)
+
+    def record_attempt(self):
+        """
+        Count a registration request about to be made to atol for the receipt,
+        unless a concurrent task has moved the receipt on (e.g. merged it into a consolidated receipt) since it was read
+
+        :return: whether the request may be made
+        """
+        updated = (Receipt.objects.using(get_write_database(Receipt)).filter(pk=self.pk, status=self.status)
+                   .update(attempts=F('attempts') + 1))
+        if updated:
+            self.attempts += 1
+        return bool(updated)
+
+    def record_poll(self):
+        """Count a report request made to atol for the receipt"""
+        self._increment('polls')
+
+    def _increment(self, field):
+        # atomic increment not to lose calls made by concurrent tasks
+        Receipt.objects.using(get_write_database(Receipt)).filter(pk=self.pk).update(**{field: F(field) + 1})
+        setattr(self, field, getattr(self, field) + 1)
+
+    def set_fiscal_data(self):
+        """Copy fiscal attributes from the content, so that they could be read without parsing the report"""
+        try:
+            fiscal_data = get_fiscal_data(self.content)
+        except (KeyError, TypeError, ValueError) as exc:
+            logger.warning('unable to get fiscal data of receipt %s due to %s', self.id, exc, exc_info=True)
+            fiscal_data = None
+
+        for field, value in (fiscal_data or dict.fromkeys(FISCAL_FIELDS)).items():
+            setattr(self, field, value)
+
+    @property
+    def is_consolidated(self):
+        """Whether the receipt has been registered in atol along with other purchases"""
+        return self.consolidated_into_id is not None
+
+    @property
+    def refund_amount(self):
+        # the total of a consolidated receipt covers the other purchases as well
+        if self.total is None or self.is_consolidated:
+            return self.purchase_price
+        return self.total
+
+    def get_consolidated_purchases(self):
+        """Return purchases registered by the receipt as dicts with name and price"""
+        receipts = (Receipt.objects.using(self._state.db)
+                    .filter(consolidated_into_id=self.id).order_by('id').only('purchase_name', 'purchase_price'))
+        return [{'name': receipt.purchase_name or 'Оплата подписки', 'price': receipt.purchase_price}
+                for receipt in receipts]
 
     def get_params(self):
+        if self.operation == ReceiptOperation.sell_refund:
+            return self.original_receipt.get_cancel_receipt_params(transaction_uuid=self.internal_uuid)
+
         params = {
             'timestamp': self.created_at.isoformat(),
             'transaction_uuid': str(self.internal_uuid),
@@ -108,18 +622,141 @@ class Receipt(models.Model):
         else:
             raise NoEmailAndPhoneError
 
+        if self.consolidated_into_id == self.id:
+            params['items'] = self.get_consolidated_purchases()
+            params['purchase_price'] = sum(item['price'] for item in params['items'])
         return params
 
-    def get_cancel_receipt_params(self) -> dict:
-        receipt_data = self.content['payload']
-        purchase_price = receipt_data['total']
-        original_fiscal_number = receipt_data['fiscal_document_attribute']
+    def get_content(self):
+        """Return the atol report of the receipt, archived or not"""
+        if self.archived_at is None:
+            return self.content
+        archive = (ReceiptArchive.objects.using(self._state.db)
+                   .filter(receipt_id=self.id).values_list('content', flat=True).first())
+        return decompress_content(archive) if archive is not None else None
+
+    def get_cancel_receipt_params(self, transaction_uuid=None) -> dict:
+        """
+        :param transaction_uuid: external_id of the refund receipt, a random one by default
+        """
+        if self.fiscal_document_attribute is not None:
+            # fiscal columns spare loading the report, which may also be archived
+            purchase_price = float(self.refund_amount)
+            original_fiscal_number = self.fiscal_document_attribute
+        else:
+            receipt_data = self.get_content()['payload']
+            purchase_price = float(self.purchase_price) if self.is_consolidated else receipt_data['total']
+            original_fiscal_number = receipt_data['fiscal_document_attribute']
         return {
             'user_email': uuid4().hex + '@example.com',
             'timestamp': (self.received_at or self.created_at).isoformat(),
-            'transaction_uuid': str(uuid4()),
+            'transaction_uuid': str(transaction_uuid or uuid4()),
             'purchase_price': purchase_price,
             'purchase_name': self.purchase_name or 'Оплата подписки',
             'payment_type': 4,  # consideration
             'original_fiscal_number': original_fiscal_number
         }
+
+
+def invalidate_statuses(receipts, using):
+    """Drop cached statuses of the receipts once the transition commits, see atol.status"""
+    from atol import status
+
+    status.invalidate_statuses(receipts, using=using)
+
+
+def receive_consolidated(receipts, using):
+    """
+    Receive the purchases merged into the received consolidated receipts with their report,
+    so that links of every purchase lead to the receipt registered in atol
+
+    :return: list of received purchases
+    """
+    consolidated = {receipt.id: receipt for receipt in receipts if receipt.consolidated_into_id == receipt.id}
+    if not consolidated:
+        return []
+
+    members = list(Receipt.objects.using(using)
+                   .filter(consolidated_into_id__in=list(consolidated), status=ReceiptStatus.consolidated)
+                   .lock_rows())
+    transitions = []
+    for member in members:
+        receipt = consolidated[member.consolidated_into_id]
+        transitions.append((member, member.status))
+        member.status = ReceiptStatus.received
+        for field in ['uuid', 'content', 'received_at', 'group_code'] + FISCAL_FIELDS:
+            setattr(member, field, getattr(receipt, field))
+    Receipt.objects.using(using).bulk_update_fields(
+        members, ['status', 'uuid', 'content', 'received_at', 'group_code'] + FISCAL_FIELDS)
+    count_transitions(transitions, using=using)
+    return members
+
+
+def fail_consolidated(receipts, using):
+    """
+    Fail the purchases merged into the failed consolidated receipts along with them.
+    The purchases are detached from the receipt, so that each of them is registered on its own once replayed,
+    while the replayed receipt registers its own purchase only
+
+    :return: list of failed purchases
+    """
+    consolidated = {receipt.id: receipt for receipt in receipts if receipt.consolidated_into_id == receipt.id}
+    if not consolidated:
+        return []
+
+    members = list(Receipt.objects.using(using)
+                   .filter(consolidated_into_id__in=list(consolidated), status=ReceiptStatus.consolidated)
+                   .lock_rows())
+    transitions = []
+    for member in members:
+        receipt = consolidated[member.consolidated_into_id]
+        transitions.append((member, member.status))
+        member.consolidated_into_id = None
+        for field in ['status', 'failed_at', 'failure_reason', 'error_code']:
+            setattr(member, field, getattr(receipt, field))
+    Receipt.objects.using(using).bulk_update_fields(
+        members, ['consolidated_into', 'status', 'failed_at', 'failure_reason', 'error_code'])
+    count_transitions(transitions, using=using)
+    if members:
+        logger.warning('declared %s consolidated purchases as failed', len(members))
+    return members
+
+
+class ReceiptArchive(models.Model):
+    """Compressed atol report of an archived receipt"""
+    receipt = models.OneToOneField(Receipt, verbose_name=_('Чек'), primary_key=True,
+                                   on_delete=models.CASCADE, related_name='archive')
+    content = models.BinaryField(_('Сжатое содержимое чека'))
+
+    class Meta:
+        verbose_name = _('Архив чека Атола')
+        verbose_name_plural = _('Архив чеков Атола')
+
+
+class ReceiptCounter(models.Model):
+    """
+    Number of receipts created on the day by status, see atol.counters
+    """
+    day = models.DateField(_('День создания чеков'))
+    status = models.CharField(_('Статус чеков'), max_length=16, choices=ReceiptStatus)
+    shard = models.PositiveSmallIntegerField(_('Шард счетчика'), default=0)
+    count = models.BigIntegerField(_('Количество чеков'), default=0)
+
+    class Meta:
+        verbose_name = _('Счетчик чеков Атола')
+        verbose_name_plural = _('Счетчики чеков Атола')
+        unique_together = [('day', 'status', 'shard')]
+
+
+class Checkpoint(models.Model):
+    """
+    Position of a resumable bulk operation over receipts (the last processed receipt id)
+    """
+    name = models.CharField(_('Название операции'), max_length=255, unique=True)
+    position = models.BigIntegerField(_('Последний обработанный чек'), default=0)
+    stats = JSONField(_('Статистика'), null=True, blank=True)
+    updated_at = models.DateTimeField(_('Дата обновления'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Контрольная точка')
+        verbose_name_plural = _('Контрольные точки')
@@ -0,0 +1,105 @@
+"""
+Reconciliation of receipts against their atol reports.
+
+Reports are polled on a bounded thread pool under a rate limit, which only makes http requests,
+while the results are applied by the calling thread with bulk transitions.
+"""
+import logging
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+from django.db.models import F
+
+from atol.core import ReceiptReport
+from atol.exceptions import AtolException, AtolReceiptNotProcessed, AtolUnrecoverableError
+from atol.links import cache_ofd_urls
+from atol.models import FISCAL_FIELDS, Checkpoint, FailureReason, Receipt, ReceiptStatus, invalidate_statuses
+from atol.routing import get_write_database
+
+logger = logging.getLogger(__name__)
+
+PENDING_STATUSES = [ReceiptStatus.initiated, ReceiptStatus.retried]
+
+
+def poll_reports(atol, receipts, workers, limiter):
+    """
+    Fetch reports of the receipts concurrently
+
+    :param atol: AtolAPI instance
+    :param limiter: RateLimiter shared by the workers
+    :return: list of (receipt, ReceiptReport or AtolException) pairs in the order of receipts
+    """
+    def poll(receipt):
+        limiter.wait()
+        try:
+            return receipt, atol.report(receipt.uuid)
+        except AtolException as exc:
+            return receipt, exc
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(poll, receipts))
+
+
+def apply_reports(results):
+    """
+    Apply polled reports with bulk transitions:
+    pending receipts with reports are received, not processed ones are retried and the rest failed,
+    received receipts get their content refreshed if it differs from the report.
+    Receipts which reports are not ready yet are left as they are.
+
+    :return: Counter of outcomes
+    """
+    stats = Counter()
+    contents, refreshed, retried, failed = {}, [], [], defaultdict(list)
+    for receipt, result in results:
+        if isinstance(result, ReceiptReport):
+            if receipt.status != ReceiptStatus.received:
+                contents[receipt.id] = result.data
+            elif receipt.content != result.data:
+                receipt.content = result.data
+                receipt.set_fiscal_data()
+                refreshed.append(receipt)
+            else:
+                stats['up_to_date'] += 1
+        elif isinstance(result, AtolReceiptNotProcessed):
+            retried.append(receipt.id)
+        elif isinstance(result, AtolUnrecoverableError):
+            failed[result.error_code].append(receipt.id)
+        else:
+            stats['not_ready'] += 1
+
+    Receipt.objects.filter(id__in=[receipt.id for receipt, _ in results]).update(polls=F('polls') + 1)
+
+    # receipts may have been moved on by the pipeline tasks while being polled
+    pending = Receipt.objects.filter(status__in=PENDING_STATUSES)
+    stats['received'] += len(pending.bulk_receive(contents)) if contents else 0
+    stats['retried'] += len(pending.filter(id__in=retried).bulk_retry()) if retried else 0
+    for error_code, ids in failed.items():
+        declared = pending.filter(id__in=ids).bulk_declare_failed(reason=FailureReason.report_rejected,
+                                                                  error_code=error_code)
+        stats['failed'] += len(declared)
+    if refreshed:
+        using = get_write_database(Receipt)
+        with transaction.atomic(using=using):
+            Receipt.objects.using(using).bulk_update_fields(refreshed, ['content'] + FISCAL_FIELDS)
+            # links of the refreshed receipts would otherwise lead to the stale ofd urls until their caches expire
+            cache_ofd_urls(refreshed, using=using)
+            invalidate_statuses(refreshed, using=using)
+        stats['refreshed'] += len(refreshed)
+    return stats
+
+
+def get_checkpoint(name, reset=False):
+    checkpoint, created = Checkpoint.objects.get_or_create(name=name)
+    if reset and not created:
+        checkpoint.position = 0
+        checkpoint.stats = None
+        checkpoint.save()
+    return checkpoint
+
+
+def save_checkpoint(checkpoint, position, stats):
+    checkpoint.position = position
+    checkpoint.stats = dict(stats)
+    checkpoint.save(update_fields=['position', 'stats', 'updated_at'])
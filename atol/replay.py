@@ -0,0 +1,68 @@
+"""
+Dead letters: failed receipts along with the reason and the atol error code of their failure,
+and their replay through the pipeline at a throttled rate.
+"""
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db.models import Avg, Count, Max
+
+from atol.dispatch import send_receipts
+from atol.models import Receipt
+from atol.routing import get_read_database
+from atol.utils import start_of_day
+
+FailureRow = namedtuple('FailureRow', ['status', 'failure_reason', 'error_code', 'receipts', 'attempts',
+                                       'last_failed_at'])
+
+
+def get_failed_receipts(day_from=None, day_to=None, reasons=None, error_codes=None):
+    """
+    Return failed receipts by the days of failure (inclusive), failure reasons and atol error codes
+    """
+    receipts = Receipt.objects.failed()
+    if day_from:
+        receipts = receipts.filter(failed_at__gte=start_of_day(day_from))
+    if day_to:
+        receipts = receipts.filter(failed_at__lt=start_of_day(day_to + timedelta(days=1)))
+    if reasons:
+        receipts = receipts.filter(failure_reason__in=reasons)
+    if error_codes:
+        receipts = receipts.filter(error_code__in=error_codes)
+    return receipts
+
+
+def get_failure_summary(receipts):
+    """
+    Return the number of failed receipts per status, failure reason and error code, read from the replica if any
+
+    :return: list of FailureRow, where attempts is the average number of registration requests
+    """
+    rows = (receipts.using(get_read_database(Receipt))
+            .order_by()
+            .values('status', 'failure_reason', 'error_code')
+            .annotate(receipts=Count('id'), attempts=Avg('attempts'), last_failed_at=Max('failed_at'))
+            .order_by('-receipts'))
+    return [FailureRow(**row) for row in rows]
+
+
+def replay_receipts(receipts, chunk_size, limiter):
+    """
+    Replay the failed receipts chunk by chunk, dispatching each of them once the limiter allows,
+    so that atol gets no more registrations per second than the limiter lets through
+
+    :param receipts: queryset of failed receipts
+    :param limiter: RateLimiter of receipts per second
+    :return: iterator of the replayed chunks
+    """
+    last_id = 0
+    while True:
+        ids = list(receipts.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return
+        replayed = Receipt.objects.filter(id__in=ids).bulk_replay(dispatch=False)
+        for receipt in replayed:
+            limiter.wait()
+            send_receipts([receipt.id])
+        yield replayed
+        last_id = ids[-1]
@@ -0,0 +1,81 @@
+"""
+Routing of heavy receipt reads (link clicks, sweeper scans) to a read replica.
+
+Reads go to the ``RECEIPTS_ATOL_READ_DATABASE`` alias unless its replication lag exceeds
+``RECEIPTS_ATOL_REPLICA_MAX_LAG`` seconds, in which case they fall back to the primary.
+Transitions always write to the primary, whichever database the receipt has been read from.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections, router
+
+logger = logging.getLogger(__name__)
+
+# replication lag is checked at most once per interval per process
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+# seconds behind the primary, NULL if unknown. A replica which has replayed everything it received is up to date
+# while it is still streaming from the primary, even though its last replayed transaction may be old when the
+# primary is idle; once streaming has stopped (or the receiver status is not visible to the database user,
+# see pg_monitor) the lag is told by the age of the last replayed transaction. Paused replay is never up to date.
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_is_wal_replay_paused() THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+             AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+_lags = {}
+_lock = threading.Lock()
+
+
+def get_write_database(model):
+    """Return the primary alias of the model regardless of where its instances were read from"""
+    return router.db_for_write(model)
+
+
+def get_replica_lag(alias):
+    """
+    Return the replication lag of the database in seconds, infinite if it is unknown or could not be checked
+    """
+    with _lock:
+        checked = _lags.get(alias)
+        if checked and time.monotonic() - checked[1] < REPLICA_LAG_CHECK_INTERVAL:
+            return checked[0]
+
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(REPLICA_LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except DatabaseError as exc:
+        logger.warning('unable to check replication lag of %s due to %s', alias, exc)
+        lag = None
+    # a replica which has never replayed a transaction or has paused replaying them is stale
+    lag = float('inf') if lag is None else float(lag)
+
+    with _lock:
+        _lags[alias] = (lag, time.monotonic())
+    return lag
+
+
+def get_read_database(model):
+    """
+    Return the alias to read receipts from: the replica if configured and up to date, the primary otherwise
+    """
+    alias = getattr(settings, 'RECEIPTS_ATOL_READ_DATABASE', None)
+    if not alias:
+        return router.db_for_read(model)
+
+    max_lag = getattr(settings, 'RECEIPTS_ATOL_REPLICA_MAX_LAG', 10)
+    if max_lag is not None:
+        lag = get_replica_lag(alias)
+        if lag > max_lag:
+            logger.warning('replica %s lags %s seconds behind, reading from the primary', alias, lag)
+            return get_write_database(model)
+    return alias
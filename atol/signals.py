@@ -13,9 +13,195 @@ receipt_failed:
 receipt_received:
     Called at the moment of Atol's response on successful processing of the receipt
 
+receipts_initiated, receipts_failed, receipts_received:
+    Batched variants of the signals above sent by the bulk transitions of Receipt.objects
+    (bulk_initiate, bulk_declare_failed, bulk_receive) with the list of affected receipts.
+    The per receipt signals are still sent by the bulk transitions as long as they have any receivers.
+
+Refunds (sell_refund receipts, see Receipt.objects.bulk_cancel) are only sent with the batched signals,
+receivers of those are to tell them apart by receipt.operation. The per receipt signals keep to sells.
+
+By default receivers are called synchronously at the time of the transition.
+Set RECEIPTS_ATOL_SIGNALS_DISPATCH to defer them until the transaction commits:
+
+    'thread' - receivers are called by an in-process thread pool
+    'celery' - receivers are called by the atol_send_receipt_signal task
+
+In both modes receivers are called with Signal.send_robust, so that their errors are logged rather than raised,
+on a pool of RECEIPTS_ATOL_SIGNALS_WORKERS threads (4) for each receipt (or batch), all the calls of a signal
+within RECEIPTS_ATOL_SIGNALS_TIMEOUT seconds. Python threads can not be killed, so a hung receiver keeps
+running in its thread past the deadline, the calls left are dropped, and no calls are made while every thread
+of the pool is taken by hung receivers. In the celery mode the time limit of the atol_send_receipt_signal task
+is the hard deadline.
 """
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.db import connections, transaction
 from django.dispatch import Signal
+from model_utils import Choices
+
+from atol.instrumentation import phase
+
+logger = logging.getLogger(__name__)
 
 receipt_initiated = Signal()
 receipt_failed = Signal()
 receipt_received = Signal()
+
+receipts_initiated = Signal()
+receipts_failed = Signal()
+receipts_received = Signal()
+
+SIGNALS = {
+    'receipt_initiated': receipt_initiated,
+    'receipt_failed': receipt_failed,
+    'receipt_received': receipt_received,
+    'receipts_initiated': receipts_initiated,
+    'receipts_failed': receipts_failed,
+    'receipts_received': receipts_received,
+}
+BATCH_SIGNALS = {receipts_initiated, receipts_failed, receipts_received}
+
+SignalsDispatch = Choices('sync', 'thread', 'celery')
+
+_executors = {}
+_executors_lock = threading.Lock()
+# receiver calls which have outlived their deadline, each of them takes a thread of the receivers pool
+_hanging = set()
+_hanging_lock = threading.Lock()
+
+
+def get_dispatch_mode():
+    mode = getattr(settings, 'RECEIPTS_ATOL_SIGNALS_DISPATCH', None) or SignalsDispatch.sync
+    if mode not in SignalsDispatch:
+        raise ValueError('unknown RECEIPTS_ATOL_SIGNALS_DISPATCH value {!r}'.format(mode))
+    return mode
+
+
+def _get_executor(name, max_workers):
+    with _executors_lock:
+        if (name, max_workers) not in _executors:
+            _executors[(name, max_workers)] = ThreadPoolExecutor(max_workers=max_workers)
+        return _executors[(name, max_workers)]
+
+
+def _get_signal_name(signal):
+    for name, known_signal in SIGNALS.items():
+        if known_signal is signal:
+            return name
+    raise ValueError('unknown receipt signal {!r}'.format(signal))
+
+
+def _send_robust(signal, named):
+    try:
+        for receiver, response in signal.send_robust(sender=None, **named):
+            if isinstance(response, Exception):
+                logger.error('receiver %s of %s failed due to %s', receiver, _get_signal_name(signal), response,
+                             exc_info=(type(response), response, response.__traceback__))
+    finally:
+        # receiver threads would otherwise keep their own database connections open
+        connections.close_all()
+
+
+def get_workers():
+    return getattr(settings, 'RECEIPTS_ATOL_SIGNALS_WORKERS', None) or 4
+
+
+def _get_free_workers(workers):
+    """Return the number of threads of the receivers pool which are not taken by hung receivers"""
+    with _hanging_lock:
+        _hanging.difference_update([future for future in _hanging if future.done()])
+        return workers - len(_hanging)
+
+
+def _submit_calls(executor, signal, calls, free, deadline):
+    """
+    Keep no more than `free` calls running until all of them are done or the deadline has passed
+
+    :return: (calls still running, number of calls not submitted)
+    """
+    pending = set()
+    submitted = 0
+    while submitted < len(calls) or pending:
+        while submitted < len(calls) and len(pending) < free:
+            pending.add(executor.submit(_send_robust, signal, calls[submitted]))
+            submitted += 1
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        _, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+    return pending, len(calls) - submitted
+
+
+def call_receivers(signal, receipts):
+    """
+    Call the receivers of the signal for each of the receipts (or once for the batched signals) on a bounded
+    pool of threads, waiting for all of them no longer than the timeout. Receivers which have not finished
+    by then keep their threads, calls left are dropped, and so are the calls made while every thread is taken
+    by hung receivers.
+    """
+    if signal in BATCH_SIGNALS:
+        calls = [{'receipts': receipts}]
+    else:
+        calls = [{'receipt': receipt} for receipt in receipts]
+
+    workers = get_workers()
+    timeout = getattr(settings, 'RECEIPTS_ATOL_SIGNALS_TIMEOUT', None) or 30
+    free = _get_free_workers(workers)
+    if free <= 0:
+        logger.error('receivers of %s are not called for %s receipts, all %s threads are taken by hung receivers',
+                     _get_signal_name(signal), len(receipts), workers)
+        return
+
+    executor = _get_executor('receivers', workers)
+    hung, dropped = _submit_calls(executor, signal, calls, free, time.monotonic() + timeout)
+    if hung or dropped:
+        with _hanging_lock:
+            _hanging.update(hung)
+        logger.error('receivers of %s did not finish in %s seconds, %s calls are left running and %s are dropped',
+                     _get_signal_name(signal), timeout, len(hung), dropped)
+
+
+def _dispatch(signal, receipts):
+    mode = get_dispatch_mode()
+
+    if mode == SignalsDispatch.thread:
+        # a single dispatcher thread keeps the order of signals and waits on receivers' timeouts
+        _get_executor('dispatcher', 1).submit(call_receivers, signal, receipts)
+    else:
+        from atol.tasks import atol_send_receipt_signal
+        atol_send_receipt_signal.delay(_get_signal_name(signal), [receipt.id for receipt in receipts])
+
+
+def send_receipt_signal(signal, receipts, using=None):
+    """
+    Send the signal for each of the receipts, or once with all of them for the batched signals.
+
+    :param signal: One of the receipt signals
+    :param receipts: List of receipts
+    :param using: Database alias of the transaction to wait for
+    """
+    from atol.models import ReceiptOperation
+
+    if not receipts or not signal.has_listeners():
+        return
+    if signal not in BATCH_SIGNALS:
+        receipts = [receipt for receipt in receipts if receipt.operation == ReceiptOperation.sell]
+        if not receipts:
+            return
+
+    if get_dispatch_mode() == SignalsDispatch.sync:
+        with phase('signals'):
+            if signal in BATCH_SIGNALS:
+                signal.send(sender=None, receipts=receipts)
+            else:
+                for receipt in receipts:
+                    signal.send(sender=None, receipt=receipt)
+        return
+
+    receipts = list(receipts)
+    transaction.on_commit(lambda: _dispatch(signal, receipts), using=using)
@@ -0,0 +1,100 @@
+"""
+Receipt status served to polling clients.
+
+Status of a receipt is cached by short uuid in the django cache along with its ETag and the time of its latest
+transition, so that polls are answered without loading the receipt, mostly with 304 Not Modified.
+Unknown receipts are cached as missing for a short while.
+
+Cached statuses carry the generation of the link they have been read under. Transitions bump the generations
+of the links of their receipts once they have committed, so that a status read by a poll made before the commit
+and cached after it is never served.
+"""
+import hashlib
+import logging
+from uuid import uuid4
+
+import shortuuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from atol.exceptions import MissingReceipt
+from atol.links import get_link_receipt, get_ofd_url, is_signed_token
+from atol.models import ReceiptStatus
+
+logger = logging.getLogger(__name__)
+
+STATUS_CACHE_KEY = 'atol_receipt_status:{}'
+GENERATION_CACHE_KEY = 'atol_receipt_status_generation:{}'
+TRANSITION_FIELDS = ['created_at', 'initiated_at', 'retried_at', 'received_at', 'failed_at']
+
+
+def get_timeout():
+    return getattr(settings, 'RECEIPTS_ATOL_STATUS_CACHE_TIMEOUT', 600)
+
+
+def get_generation_timeout():
+    # outlive the statuses cached under the previous generation
+    return 2 * get_timeout()
+
+
+def make_status(receipt):
+    ofd_link = None
+    if receipt.status == ReceiptStatus.received:
+        try:
+            ofd_link = get_ofd_url(receipt)
+        except (MissingReceipt, KeyError, TypeError, ValueError) as exc:
+            logger.error('invalid receipt format of receipt %s: %s', receipt.id, exc, exc_info=True)
+
+    last_modified = max(getattr(receipt, field) for field in TRANSITION_FIELDS if getattr(receipt, field))
+    if timezone.is_naive(last_modified):
+        last_modified = timezone.make_aware(last_modified)
+    etag = hashlib.md5('{}:{}:{}'.format(receipt.status, ofd_link, last_modified.isoformat())
+                       .encode('utf-8')).hexdigest()
+    return {
+        'status': receipt.status,
+        'ofd_link': ofd_link,
+        'etag': '"{}"'.format(etag),
+        'last_modified': last_modified,
+    }
+
+
+def get_receipt_status(short_uuid):
+    """
+    :return: dict of the status, the OFD link (None until received), the ETag and the time of the latest
+             transition of the receipt, None if there is no such receipt
+    """
+    key, generation_key = STATUS_CACHE_KEY.format(short_uuid), GENERATION_CACHE_KEY.format(short_uuid)
+    cached = cache.get_many([key, generation_key])
+    generation = cached.get(generation_key)
+    entry = cached.get(key)
+    if entry is not None and entry['generation'] == generation:
+        return entry['status']
+
+    receipt = None if is_signed_token(short_uuid) else get_link_receipt(short_uuid, fields=TRANSITION_FIELDS)
+    if receipt is None:
+        cache.set(key, {'generation': generation, 'status': None},
+                  getattr(settings, 'RECEIPTS_OFD_URL_MISSING_CACHE_TIMEOUT', 10))
+        return None
+
+    status = make_status(receipt)
+    cache.set(key, {'generation': generation, 'status': status}, get_timeout())
+    return status
+
+
+def invalidate_statuses(receipts, using=None):
+    """
+    Bump generations of the links of the receipts once the current transaction commits
+
+    :param using: Database alias of the transaction to wait for
+    """
+    keys = []
+    for receipt in receipts:
+        code = receipt.short_code or shortuuid.encode(receipt.internal_uuid)
+        # legacy links carry the very same code reversed
+        keys += [GENERATION_CACHE_KEY.format(code), GENERATION_CACHE_KEY.format(code[::-1])]
+    if keys:
+        transaction.on_commit(
+            lambda: cache.set_many(dict.fromkeys(keys, uuid4().hex), get_generation_timeout()), using=using)
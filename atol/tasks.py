@@ -1,52 +1,95 @@
 import math
 import logging
-from uuid import uuid4
 from datetime import timedelta
 
+from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
 from django.apps import apps
 from celery.exceptions import MaxRetriesExceededError
 from celery import shared_task
 
+from atol.admission import release_held_receipts
+from atol.consolidation import consolidate_receipt
 from atol.core import AtolAPI
-from atol.models import ReceiptStatus
-from atol.exceptions import AtolUnrecoverableError, NoEmailAndPhoneError, AtolReceiptNotProcessed
+from atol.counters import get_status_counts, reconcile_counters
+from atol.instrumentation import phase, recorded
+from atol.models import FailureReason, ReceiptStatus
+from atol.routing import get_read_database, get_write_database
+from atol.signals import SIGNALS, call_receivers
+from atol.exceptions import (AtolUnrecoverableError, AtolPrepRequestException,
+                             NoEmailAndPhoneError, AtolReceiptNotProcessed)
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task(name='atol_create_receipt', bind=True, max_retries=4, time_limit=60, soft_time_limit=45)
-def atol_create_receipt(self, receipt_id):
+def _init_receipt(atol, receipt, retry):
     """
-    Change receipt status and the change date accordingly
-    If received an unrecoverable error, stop any further attempts to init a receipt and mark its status as failed
+    Register the receipt in atol and schedule its report retrieval.
+
+    :param retry: Callable(receipt, params, exc) which is called to schedule another attempt on a recoverable error
     """
-    atol = AtolAPI()
-    Receipt = apps.get_model('atol', 'Receipt')
-    receipt = Receipt.objects.get(id=receipt_id)
+    with phase('consolidate'):
+        consolidate_receipt(receipt)
+    if receipt.status == ReceiptStatus.consolidated:
+        logger.info('receipt %s is registered along with receipt %s', receipt.id, receipt.consolidated_into_id)
+        return
 
     try:
-        params = receipt.get_params()
+        with phase('params'):
+            params = receipt.get_params()
     except NoEmailAndPhoneError:
         # this email should have been sent, but we got neither email
         logger.warning('unable to init receipt %s due to missing email/phone', receipt.id)
-        receipt.declare_failed(status=ReceiptStatus.no_email_phone)
+        with phase('save'):
+            receipt.declare_failed(status=ReceiptStatus.no_email_phone, reason=FailureReason.no_email_phone)
         return
 
     if receipt.status not in [ReceiptStatus.created, ReceiptStatus.retried]:
         logger.error('receipt %s has invalid status: %s', receipt.uuid, receipt.status)
         return
 
+    with phase('save'):
+        # purchases are merged only while no attempt has been made, see atol.consolidation
+        attempted = receipt.record_attempt()
+    if not attempted:
+        logger.info('receipt %s has been moved on by a concurrent task, skipping it', receipt.id)
+        return
     try:
-        receipt_data = atol.sell(**params)
-    except AtolUnrecoverableError as exc:
+        # sell or sell_refund
+        with phase('atol'):
+            receipt_data = getattr(atol, receipt.operation)(**params)
+    # malformed receipts would be rejected by atol anyway, there is no point in retrying them
+    except (AtolUnrecoverableError, AtolPrepRequestException) as exc:
         logger.error('unable to init receipt %s with params %s due to %s', receipt.id, params, exc,
                      exc_info=True, extra={'data': {'payment_params': params}})
-        receipt.declare_failed()
+        reason = FailureReason.invalid if isinstance(exc, AtolPrepRequestException) else FailureReason.rejected
+        with phase('save'):
+            receipt.declare_failed(reason=reason, error_code=exc.error_code)
     except Exception as exc:
         logger.warning('failed to init receipt %s with params %s due to %s', receipt.id, params, exc,
                        exc_info=True, extra={'data': {'payment_params': params}})
+        retry(receipt, params, exc)
+    else:
+        with phase('save'), transaction.atomic():
+            receipt.initiate(uuid=receipt_data.uuid)
+            transaction.on_commit(
+                lambda: atol_receive_receipt_report.apply_async(args=(receipt.id,), countdown=60)
+            )
+
+
+@shared_task(name='atol_create_receipt', bind=True, max_retries=4, time_limit=60, soft_time_limit=45)
+@recorded('atol_create_receipt', lambda self, receipt_id: {'receipt_id': receipt_id})
+def atol_create_receipt(self, receipt_id):
+    """
+    Change receipt status and the change date accordingly
+    If received an unrecoverable error, stop any further attempts to init a receipt and mark its status as failed
+    """
+    atol = AtolAPI()
+    Receipt = apps.get_model('atol', 'Receipt')
+    receipt = Receipt.objects.get(id=receipt_id)
+
+    def retry(receipt, params, exc):
         try:
             countdown = 60 * int(math.exp(self.request.retries))
             logger.info('retrying to create receipt %s with params %s countdown %s due to %s',
@@ -55,16 +98,40 @@ def atol_create_receipt(self, receipt_id):
         except MaxRetriesExceededError:
             logger.error('run out of attempts to create receipt %s with params %s due to %s',
                          receipt.id, params, exc)
-            receipt.declare_failed()
-    else:
-        with transaction.atomic():
-            receipt.initiate(uuid=receipt_data.uuid)
-            transaction.on_commit(
-                lambda: atol_receive_receipt_report.apply_async(args=(receipt.id,), countdown=60)
-            )
+            receipt.declare_failed(reason=FailureReason.attempts_exhausted,
+                                   error_code=getattr(exc, 'error_code', None))
+
+    _init_receipt(atol, receipt, retry)
+
+
+@shared_task(name='atol_create_receipts', time_limit=1800, soft_time_limit=1500)
+@recorded('atol_create_receipts', lambda receipt_ids: {'receipts': len(receipt_ids)})
+def atol_create_receipts(receipt_ids):
+    """
+    Register a chunk of receipts in atol one after another.
+    Receipts that fail with a recoverable error are handed over to atol_create_receipt with its own retries.
+    """
+    atol = AtolAPI()
+    Receipt = apps.get_model('atol', 'Receipt')
+    receipts = (Receipt.objects.filter(id__in=receipt_ids).order_by('id')
+                .select_related('original_receipt').defer('original_receipt__content'))
+
+    def retry(receipt, params, exc):
+        logger.info('retrying to create receipt %s with params %s countdown %s due to %s',
+                    receipt.id, params, 60, exc)
+        atol_create_receipt.apply_async(args=(receipt.id,), countdown=60)
+
+    count = 0
+    for receipt in receipts.iterator():
+        _init_receipt(atol, receipt, retry)
+        count += 1
+
+    if count < len(receipt_ids):
+        logger.warning('%s of %s receipts to create are missing', len(receipt_ids) - count, len(receipt_ids))
 
 
 @shared_task(name='atol_receive_receipt_report', bind=True, max_retries=8, time_limit=60, soft_time_limit=45)
+@recorded('atol_receive_receipt_report', lambda self, receipt_id: {'receipt_id': receipt_id})
 def atol_receive_receipt_report(self, receipt_id):
     """
     Attempt to retrieve a receipt report for given receipt_id
@@ -72,7 +139,8 @@ def atol_receive_receipt_report(self, receipt_id):
     """
     atol = AtolAPI()
     Receipt = apps.get_model('atol', 'Receipt')
-    receipt = Receipt.objects.get(id=receipt_id)
+    with phase('db'):
+        receipt = Receipt.objects.get(id=receipt_id)
 
     if not receipt.uuid:
         logger.error('receipt %s does not have a uuid', receipt.id)
@@ -82,23 +150,25 @@ def atol_receive_receipt_report(self, receipt_id):
         logger.error('receipt %s has invalid status: %s', receipt.uuid, receipt.status)
         return
 
+    with phase('save'):
+        receipt.record_poll()
     try:
-        report = atol.report(receipt.uuid)
+        with phase('atol'):
+            report = atol.report(receipt.uuid)
     except AtolUnrecoverableError as exc:
         logger.error('unable to fetch report for receipt %s due to %s',
                      receipt.id, exc, exc_info=True)
-        receipt.declare_failed()
+        receipt.declare_failed(reason=FailureReason.report_rejected, error_code=exc.error_code)
     except AtolReceiptNotProcessed as exc:
         logger.warning('unable to fetch report for receipt %s due to %s',
                        receipt.id, exc, exc_info=True)
         logger.info('repeat receipt registration: id %s; old internal_uuid %s',
                     receipt.id, receipt.internal_uuid)
-        with transaction.atomic():
-            receipt.internal_uuid = uuid4()
-            receipt.status = ReceiptStatus.retried
-            receipt.save(update_fields=['internal_uuid', 'status'])
+        using = get_write_database(Receipt)
+        with transaction.atomic(using=using):
+            receipt.retry()
             transaction.on_commit(
-                lambda: atol_create_receipt.apply_async(args=(receipt.id,), countdown=60)
+                lambda: atol_create_receipt.apply_async(args=(receipt.id,), countdown=60), using=using
             )
     except Exception as exc:
         logger.warning('failed to fetch report for receipt %s due to %s',
@@ -111,9 +181,10 @@ def atol_receive_receipt_report(self, receipt_id):
         except MaxRetriesExceededError:
             logger.error('run out of attempts to create receipt %s due to %s',
                          receipt.id, exc)
-            receipt.declare_failed()
+            receipt.declare_failed(reason=FailureReason.report_attempts_exhausted,
+                                   error_code=getattr(exc, 'error_code', None))
     else:
-        with transaction.atomic():
+        with phase('save'), transaction.atomic():
             receipt.receive(content=report.data)
 
 
@@ -126,11 +197,10 @@ def atol_retry_created_receipts():
     now = timezone.now()
     retry_date_range = (now - timedelta(days=2), now - timedelta(days=1))
 
-    created_receipts = (Receipt.objects
-                        .filter(status=ReceiptStatus.created,
-                                created_at__range=retry_date_range))
+    created_receipts = Receipt.objects.using(get_read_database(Receipt)).created_between(*retry_date_range)
 
-    logger.info('there are %s receipts waiting to be initiated', created_receipts.count())
+    logger.info('there are %s receipts waiting to be initiated',
+                get_status_counts().get(ReceiptStatus.created, 0))
 
     for receipt in created_receipts.only('pk').iterator():
         logger.info('retrying created receipt %s', receipt.id)
@@ -146,18 +216,29 @@ def atol_retry_initiated_receipts():
     now = timezone.now()
     retry_date_range = (now - timedelta(days=2), now - timedelta(days=1))
 
-    initiated_receipts = (Receipt.objects
-                          .filter(status=ReceiptStatus.initiated,
-                                  initiated_at__range=retry_date_range))
+    initiated_receipts = Receipt.objects.using(get_read_database(Receipt)).initiated_between(*retry_date_range)
 
-    logger.info('there are %s initiated receipts waiting for report', initiated_receipts.count())
+    logger.info('there are %s initiated receipts waiting for report',
+                get_status_counts().get(ReceiptStatus.initiated, 0))
 
     for receipt in initiated_receipts.only('pk').iterator():
         logger.info('retrying initiated payment %s', receipt.id)
         atol_receive_receipt_report.delay(receipt.id)
 
 
+@shared_task(name='atol_release_held_receipts', time_limit=300)
+def atol_release_held_receipts():
+    """
+    Dispatch receipts held by the admission control as the pipeline makes room for them
+    """
+    released = release_held_receipts()
+    if released:
+        logger.info('released %s held receipts, %s are still held',
+                    len(released), get_status_counts().get(ReceiptStatus.held, 0))
+
+
 @shared_task(name='atol_cancel_receipt', time_limit=60)
+@recorded('atol_cancel_receipt', lambda receipt_id: {'receipt_id': receipt_id})
 def atol_cancel_receipt(receipt_id):
     atol = AtolAPI()
     Receipt = apps.get_model('atol', 'Receipt')
@@ -174,3 +255,30 @@ def atol_cancel_receipt(receipt_id):
     else:
         logger.info('cancel: receipt %s successfully canceled with data: %s', receipt.id, receipt_data)
         return True
+
+
+@shared_task(name='atol_send_receipt_signal', time_limit=600)
+@recorded('atol_send_receipt_signal',
+          lambda signal_name, receipt_ids: {'signal': signal_name, 'receipts': len(receipt_ids)})
+def atol_send_receipt_signal(signal_name, receipt_ids):
+    """
+    Call the receivers of a receipt signal deferred until the transaction of the receipt transition has committed
+    """
+    Receipt = apps.get_model('atol', 'Receipt')
+    with phase('db'):
+        receipts = list(Receipt.objects.filter(id__in=receipt_ids))
+    logger.info('sending %s for %s receipts', signal_name, len(receipts))
+    with phase('signals'):
+        call_receivers(SIGNALS[signal_name], receipts)
+
+
+@shared_task(name='atol_reconcile_receipt_counters', time_limit=3600)
+def atol_reconcile_receipt_counters(days=None):
+    """
+    Fix the drift of receipt counters of the recent days against the actual number of receipts
+    """
+    if days is None:
+        days = getattr(settings, 'RECEIPTS_ATOL_COUNTERS_RECONCILE_DAYS', 2)
+    today = timezone.localdate() if settings.USE_TZ else timezone.now().date()
+    drift = reconcile_counters(day_from=today - timedelta(days=days))
+    logger.info('reconciled receipt counters, %s day/status pairs fixed', len(drift))
@@ -0,0 +1,27 @@
+"""
+Throttling of bulk atol requests made by management commands, so that they do not overload the group's KKT
+"""
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Thread safe limiter spacing calls out evenly to at most `rate` calls per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_call = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed"""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            call_at = max(self._next_call, now)
+            self._next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
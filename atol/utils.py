@@ -1,7 +1,13 @@
+import json
 import logging
 import datetime
+import zlib
+from decimal import Decimal
 from dateutil.parser import parse as parse_date
 
+from django.conf import settings
+from django.utils import timezone
+
 logger = logging.getLogger(__name__)
 
 
@@ -11,3 +17,48 @@ def parse_receipt_datetime(date_str):
     except Exception:
         logger.warning('unexpected date format in receipt, %s', date_str)
         return parse_date(date_str)
+
+
+def get_fiscal_data(content):
+    """
+    Extract fiscal attributes of the receipt from the atol report
+
+    :param content: Atol report
+    :return: dict of Receipt fiscal fields or None, if the report does not contain the payload
+    """
+    payload = content.get('payload') if isinstance(content, dict) else None
+    if not isinstance(payload, dict):
+        return None
+
+    receipt_dt = parse_receipt_datetime(payload['receipt_datetime'])
+    # atol reports local time of the register
+    if settings.USE_TZ and timezone.is_naive(receipt_dt):
+        receipt_dt = timezone.make_aware(receipt_dt)
+
+    return {
+        'fn_number': str(payload['fn_number']),
+        'fiscal_document_number': int(payload['fiscal_document_number']),
+        'fiscal_document_attribute': int(payload['fiscal_document_attribute']),
+        'fiscal_receipt_number': int(payload['fiscal_receipt_number']),
+        'total': Decimal(str(payload['total'])),
+        'receipt_datetime': receipt_dt,
+    }
+
+
+def start_of_day(date):
+    dt = datetime.datetime.combine(date, datetime.time.min)
+    return timezone.make_aware(dt) if settings.USE_TZ else dt
+
+
+def format_receipt_total(total):
+    """Format the total the way atol reports it: 12, 199.99, 12.5"""
+    return '{:f}'.format(Decimal(str(total)).normalize())
+
+
+def compress_content(content):
+    """Pack the atol report for the archive"""
+    return zlib.compress(json.dumps(content, separators=(',', ':')).encode('utf-8'))
+
+
+def decompress_content(data):
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
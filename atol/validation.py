@@ -0,0 +1,169 @@
+"""
+Client side validation of the v4 registration payload (sell, sell_refund).
+
+The schema below is compiled once at import time into a tree of plain python closures,
+so that validating a receipt costs a handful of dict lookups and comparisons
+instead of a round trip to atol followed by a series of retries.
+"""
+import re
+
+from atol.exceptions import AtolValidationError
+
+MAX_PRICE = 42949672.95
+MAX_QUANTITY = 99999.999
+
+EMAIL_RE = r'^[^@\s]+@[^@\s]+\.[^@\s]+$'
+# leading plus and non-russian country codes are allowed, formatting characters are not
+PHONE_RE = r'^\+?\d{10,19}$'
+
+
+def _number(minimum=None, exclusive_minimum=None, maximum=None, integer=False):
+    types = (int,) if integer else (int, float)
+
+    def validate(value):
+        # bool is a subclass of int, but atol expects real numbers only
+        if isinstance(value, bool) or not isinstance(value, types):
+            raise AtolValidationError('', 'expected a number, got {!r}'.format(value))
+        if minimum is not None and value < minimum:
+            raise AtolValidationError('', 'must be greater than or equal to {}'.format(minimum))
+        if exclusive_minimum is not None and value <= exclusive_minimum:
+            raise AtolValidationError('', 'must be greater than {}'.format(exclusive_minimum))
+        if maximum is not None and value > maximum:
+            raise AtolValidationError('', 'must be less than or equal to {}'.format(maximum))
+    return validate
+
+
+def _string(min_length=0, max_length=None, pattern=None):
+    match = re.compile(pattern).match if pattern else None
+
+    def validate(value):
+        if not isinstance(value, str):
+            raise AtolValidationError('', 'expected a string, got {!r}'.format(value))
+        if len(value) < min_length:
+            raise AtolValidationError('', 'must not be empty' if min_length == 1 else
+                                      'must be at least {} characters long'.format(min_length))
+        if max_length is not None and len(value) > max_length:
+            raise AtolValidationError('', 'must be at most {} characters long'.format(max_length))
+        if match and not match(value):
+            raise AtolValidationError('', 'invalid value {!r}'.format(value))
+    return validate
+
+
+def _object(properties, required=()):
+    fields = tuple(properties.items())
+
+    def validate(value):
+        if not isinstance(value, dict):
+            raise AtolValidationError('', 'expected an object, got {!r}'.format(value))
+        for name in required:
+            if name not in value:
+                raise AtolValidationError(name, 'is required')
+        for name, validator in fields:
+            if name in value:
+                try:
+                    validator(value[name])
+                except AtolValidationError as exc:
+                    raise _nested(exc, '.' + name)
+    return validate
+
+
+def _array(items, min_items=1, max_items=None):
+    def validate(value):
+        if not isinstance(value, list):
+            raise AtolValidationError('', 'expected a list, got {!r}'.format(value))
+        if len(value) < min_items:
+            raise AtolValidationError('', 'must contain at least {} item(s)'.format(min_items))
+        if max_items is not None and len(value) > max_items:
+            raise AtolValidationError('', 'must contain at most {} items'.format(max_items))
+        for index, item in enumerate(value):
+            try:
+                items(item)
+            except AtolValidationError as exc:
+                raise _nested(exc, '[{}]'.format(index))
+    return validate
+
+
+def _nested(exc, prefix):
+    # paths are only built on failure, so that valid receipts do not pay for string formatting
+    path = exc.path if not exc.path or exc.path.startswith('[') else '.' + exc.path
+    return AtolValidationError((prefix + path).lstrip('.'), exc.message)
+
+
+def _client(value):
+    # receipt must contain either of the two
+    if isinstance(value, dict) and not (value.get('email') or value.get('phone')):
+        raise AtolValidationError('', 'either email or phone is required')
+    _client_fields(value)
+
+
+_client_fields = _object({
+    'email': _string(min_length=1, max_length=64, pattern=EMAIL_RE),
+    'phone': _string(min_length=1, max_length=19, pattern=PHONE_RE),
+})
+
+_price = _number(exclusive_minimum=0, maximum=MAX_PRICE)
+
+validate_schema = _object({
+    'external_id': _string(min_length=1, max_length=128),
+    'timestamp': _string(pattern=r'^\d{2}\.\d{2}\.\d{4} \d{2}:\d{2}:\d{2}$'),
+    'receipt': _object({
+        'client': _client,
+        'company': _object({
+            'email': _string(max_length=64),
+            'sno': _string(max_length=32),
+            'inn': _string(pattern=r'^(\d{10}|\d{12})$'),
+            'payment_address': _string(min_length=1, max_length=256),
+        }, required=('inn', 'payment_address')),
+        'items': _array(_object({
+            'name': _string(min_length=1, max_length=128),
+            'price': _price,
+            'quantity': _number(exclusive_minimum=0, maximum=MAX_QUANTITY),
+            'sum': _price,
+            'payment_method': _string(min_length=1),
+            'payment_object': _string(min_length=1),
+            'vat': _object({'type': _string(min_length=1)}, required=('type',)),
+        }, required=('name', 'price', 'quantity', 'sum', 'payment_method', 'payment_object', 'vat')),
+            max_items=100),
+        'payments': _array(_object({
+            'sum': _price,
+            'type': _number(minimum=0, maximum=9, integer=True),
+        }, required=('sum', 'type')), max_items=10),
+        'total': _price,
+        'additional_check_props': _string(max_length=16),
+    }, required=('client', 'company', 'items', 'payments', 'total')),
+    'service': _object({
+        'callback_url': _string(max_length=256),
+    }),
+}, required=('external_id', 'timestamp', 'receipt'))
+
+
+def _same_amount(a, b):
+    # amounts are sent in roubles with kopecks precision
+    return abs(a - b) < 0.005
+
+
+def validate_totals(receipt):
+    for index, item in enumerate(receipt['items']):
+        if not _same_amount(item['price'] * item['quantity'], item['sum']):
+            raise AtolValidationError('receipt.items[{}].sum'.format(index),
+                                      '{} does not equal price * quantity'.format(item['sum']))
+
+    total = receipt['total']
+    items_sum = sum(item['sum'] for item in receipt['items'])
+    if not _same_amount(items_sum, total):
+        raise AtolValidationError('receipt.total', '{} does not equal the sum of items {}'.format(total, items_sum))
+
+    payments_sum = sum(payment['sum'] for payment in receipt['payments'])
+    if not _same_amount(payments_sum, total):
+        raise AtolValidationError('receipt.total',
+                                  '{} does not equal the sum of payments {}'.format(total, payments_sum))
+
+
+def validate_registration_data(request_data):
+    """
+    Validate the request data produced by AtolAPI.get_registration_data
+
+    :raises AtolValidationError: pointing at the first offending field
+    """
+    validate_schema(request_data)
+    validate_totals(request_data['receipt'])
@@ -1,16 +1,24 @@
+import calendar
 import logging
-import shortuuid
 
-from django.conf import settings
-from django.http import HttpResponseNotFound
-from django.shortcuts import get_object_or_404
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponseBadRequest, HttpResponseNotFound, JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from django.utils.decorators import method_decorator
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.encoding import force_bytes
-from django.views.generic import RedirectView
+from django.utils.http import http_date
+from django.views.decorators.cache import never_cache
+from django.views.generic import RedirectView, View
 from django.utils.translation import gettext_lazy as _
 
-from atol.models import Receipt
+from atol.health import get_health
+from atol.export import CONTENT_TYPES, EXPORT_FORMATS, get_export_queryset, iter_export
+from atol.links import (MISSING, get_link_receipt, get_ofd_url, get_signed_token_ofd_url, is_signed_token,
+                        link_cache)
+from atol.models import ReceiptStatus
+from atol.status import get_receipt_status
 from atol.exceptions import MissingReceipt
-from atol.utils import parse_receipt_datetime
 
 logger = logging.getLogger(__name__)
 
@@ -36,26 +44,98 @@ class ReceiptView(RedirectView):
             return HttpResponseNotFound(content=force_bytes(_('Чек не найден')))  # do not face 500 to user
 
     def get_redirect_url(self, *args, **kwargs):
-        try:
-            uuid = shortuuid.decode(kwargs['short_uuid'])
-        except ValueError:
-            logger.warning('can not convert %s to uuid with actual decode() method', kwargs['short_uuid'])
-            uuid = shortuuid.decode(kwargs['short_uuid'], legacy=True)
+        short_uuid = kwargs['short_uuid']
 
-        receipt = get_object_or_404(Receipt, internal_uuid=uuid)
+        if is_signed_token(short_uuid):
+            return get_signed_token_ofd_url(short_uuid)
 
-        if not receipt.content:
-            logger.warning('access receipt before backend processed receipt, suspicious')
+        ofd_url = link_cache.get(short_uuid)
+        if ofd_url == MISSING:
             raise MissingReceipt()
+        if ofd_url is not None:
+            return ofd_url
+
+        try:
+            ofd_url = self.resolve_ofd_url(short_uuid)
+        except (MissingReceipt, Http404):
+            link_cache.set_missing(short_uuid)
+            raise
+
+        link_cache.set(short_uuid, ofd_url)
+        return ofd_url
+
+    def resolve_ofd_url(self, short_uuid):
+        receipt = get_link_receipt(short_uuid)
+        if receipt is None:
+            raise Http404('No receipt matches the given query.')
+        return get_ofd_url(receipt)
+
+
+class ReceiptStatusView(View):
+    """
+    Anonymous JSON status of the receipt of a short uuid link for clients polling until it is ready:
+    {"status": "received", "ofd_link": "https://..."}, the link is null until the receipt is received.
+
+    Supports conditional requests with ETag and Last-Modified, served from cache, see atol.status.
+    """
 
-        payload = receipt.content['payload']
-        receipt_dt = parse_receipt_datetime(payload['receipt_datetime'])
-
-        return settings.RECEIPTS_OFD_URL_TEMPLATE.format(
-            t='{:%Y%m%dT%H%M%S}'.format(receipt_dt),
-            s=payload['total'],
-            fn=payload['fn_number'],
-            fd=payload['fiscal_document_number'],
-            fp=payload['fiscal_document_attribute'],
-            n=payload['fiscal_receipt_number'],
-        )
+    def get(self, request, *args, **kwargs):
+        status = get_receipt_status(kwargs['short_uuid'])
+        if status is None:
+            response = JsonResponse({'status': None, 'ofd_link': None}, status=404)
+        else:
+            last_modified = calendar.timegm(status['last_modified'].utctimetuple())
+            response = get_conditional_response(request, etag=status['etag'], last_modified=last_modified)
+            if response is None:
+                response = JsonResponse({'status': status['status'], 'ofd_link': status['ofd_link']})
+            response['ETag'] = status['etag']
+            response['Last-Modified'] = http_date(last_modified)
+        # let clients keep the response but make them revalidate it on every poll
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+@method_decorator(staff_member_required, name='dispatch')
+class ReceiptExportView(View):
+    """
+    Staff only streaming export of receipts with their fiscal attributes.
+
+    Query parameters: format (csv or jsonl), from and to (YYYY-MM-DD, inclusive), status (may be repeated)
+    """
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return HttpResponseBadRequest('unknown format')
+
+        dates = {}
+        for param in ('from', 'to'):
+            value = request.GET.get(param)
+            try:
+                dates[param] = value and parse_date(value)
+            except ValueError:  # well formatted, but not a valid date
+                dates[param] = None
+            if value and not dates[param]:
+                return HttpResponseBadRequest('invalid {} date'.format(param))
+
+        statuses = request.GET.getlist('status')
+        if any(status not in ReceiptStatus for status in statuses):
+            return HttpResponseBadRequest('unknown status')
+
+        queryset = get_export_queryset(dates['from'], dates['to'], statuses)
+        response = StreamingHttpResponse(iter_export(queryset, export_format),
+                                         content_type=CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = 'attachment; filename="receipts.{}"'.format(export_format)
+        return response
+
+
+@method_decorator(never_cache, name='dispatch')
+class HealthView(View):
+    """
+    Health and readiness probe of the receipt pipeline: responds 503 while degraded.
+    Served out of the django cache, see atol.health.
+    """
+
+    def get(self, request, *args, **kwargs):
+        health = get_health()
+        return JsonResponse(health, status=200 if health['status'] == 'ok' else 503)
@@ -0,0 +1,107 @@
+"""
+Compare throughput of ReceiptView and AsyncReceiptView under concurrent clicks.
+The link cache is disabled, so that every click reaches the database.
+
+Requires a PostgreSQL server the test settings connect to, a throwaway test database is created:
+
+    python benchmarks/receipt_view.py [concurrency] [requests]
+"""
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.test_app.settings')
+
+import django  # noqa: E402
+from asgiref.sync import sync_to_async  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.db import connection, connections  # noqa: E402
+from django.test import AsyncClient, Client  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+
+from atol.models import Receipt, ReceiptStatus  # noqa: E402
+
+RECEIPTS = 1000
+CONTENT = {
+    'payload': {
+        'fiscal_document_attribute': 4146968358,
+        'fiscal_document_number': 40,
+        'fiscal_receipt_number': 1,
+        'fn_number': '8710000100942521',
+        'receipt_datetime': '26.07.2017 10:32:00',
+        'total': 12,
+    },
+}
+
+
+def seed():
+    receipts = []
+    for _ in range(RECEIPTS):
+        receipt = Receipt(status=ReceiptStatus.received, content=CONTENT)
+        receipt.set_short_code()
+        receipt.set_fiscal_data()
+        receipts.append(receipt)
+    Receipt.objects.bulk_create(receipts)
+    return [receipt.short_code for receipt in receipts]
+
+
+def bench_sync(codes, concurrency, requests):
+    def clicks(indexes):
+        client = Client()
+        for index in indexes:
+            response = client.get(reverse('receipt', kwargs={'short_uuid': codes[index % len(codes)]}))
+            assert response.status_code == 302
+        connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        started = time.perf_counter()
+        list(executor.map(clicks, [range(worker, requests, concurrency) for worker in range(concurrency)]))
+        return time.perf_counter() - started
+
+
+def bench_async(codes, concurrency, requests):
+    async def clicks():
+        semaphore = asyncio.Semaphore(concurrency)
+        client = AsyncClient()
+
+        async def click(index):
+            async with semaphore:
+                response = await client.get(reverse('receipt_async', kwargs={'short_uuid': codes[index % len(codes)]}))
+                assert response.status_code == 302
+
+        await asyncio.gather(*(click(index) for index in range(requests)))
+        await sync_to_async(connections.close_all)()
+
+    started = time.perf_counter()
+    asyncio.run(clicks())
+    return time.perf_counter() - started
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    setup_test_environment()
+    settings.RECEIPTS_OFD_URL_CACHE_TIMEOUT = 0
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        codes = seed()
+        for name, bench in [('ReceiptView', bench_sync), ('AsyncReceiptView', bench_async)]:
+            elapsed = bench(codes, concurrency, requests)
+            rps = requests / elapsed
+            print('{:<17} {} clicks, concurrency {}: {:.0f} rps'.format(name, requests, concurrency, rps))
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Measure the cost of client side receipt validation relative to json encoding of the very same payload,
+which every sell request pays anyway.
+
+    python benchmarks/validation.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from atol.validation import validate_registration_data  # noqa: E402
+
+NUMBER = 100000
+
+REQUEST_DATA = {
+    'external_id': '973f3bef-1c39-40c9-abd0-33a91ab005ca',
+    'timestamp': '22.11.2017 10:47:32',
+    'receipt': {
+        'client': {'email': 'user@example.com', 'phone': '+75551234567'},
+        'company': {
+            'email': 'company@example.com',
+            'sno': 'osn',
+            'inn': '112233445573',
+            'payment_address': 'www.company.ru',
+        },
+        'items': [{
+            'name': 'Стандартная подписка на 1 месяц',
+            'price': 199.99,
+            'quantity': 1,
+            'sum': 199.99,
+            'payment_method': 'full_payment',
+            'payment_object': 'service',
+            'vat': {'type': 'vat20'},
+        }],
+        'payments': [{'sum': 199.99, 'type': 1}],
+        'total': 199.99,
+    },
+    'service': {'callback_url': ''},
+}
+
+
+def main():
+    validation = timeit.timeit(lambda: validate_registration_data(REQUEST_DATA), number=NUMBER)
+    encoding = timeit.timeit(lambda: json.dumps(REQUEST_DATA), number=NUMBER)
+
+    print('validate_registration_data: {:.2f} us per receipt'.format(validation / NUMBER * 1e6))
+    print('json.dumps:                 {:.2f} us per receipt'.format(encoding / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
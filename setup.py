@@ -42,6 +42,8 @@ setup(
     url='https://github.com/MyBook/django-atol',
     packages=[
         'atol',
+        'atol.management',
+        'atol.management.commands',
         'atol.migrations'
     ],
     package_dir={'atol': 'atol'},
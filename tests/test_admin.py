@@ -0,0 +1,202 @@
+import mock
+import pytest
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from atol.admin import EstimatedCountPaginator, ReceiptAdmin
+from atol.models import FailureReason, Receipt, ReceiptOperation, ReceiptStatus
+from atol.tasks import atol_create_receipts, atol_receive_receipt_report
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+CHANGELIST_URL = reverse('admin:atol_receipt_changelist')
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+def listed_ids(response):
+    return [receipt.id for receipt in response.context['cl'].result_list]
+
+
+def test_changelist_does_not_load_reports(admin_client):
+    for _ in range(3):
+        Receipt.objects.create(purchase_price=100, content={'payload': {'total': 100}})
+
+    with CaptureQueriesContext(connection) as queries:
+        response = admin_client.get(CHANGELIST_URL)
+    assert response.status_code == 200
+    assert listed_ids(response) == sorted(listed_ids(response), reverse=True)
+    assert len(listed_ids(response)) == 3
+
+    receipt_queries = [query['sql'] for query in queries if 'FROM "atol_receipt"' in query['sql']]
+    assert receipt_queries
+    assert not any('"atol_receipt"."content"' in sql for sql in receipt_queries)
+    # neither offsets nor COUNT(*) of the whole table
+    assert not any('OFFSET' in sql for sql in receipt_queries)
+
+
+def test_changelist_keyset_pages(admin_client):
+    ids = [Receipt.objects.create(purchase_price=100).id for _ in range(5)]
+
+    with mock.patch.object(ReceiptAdmin, 'list_per_page', 2):
+        response = admin_client.get(CHANGELIST_URL)
+        assert listed_ids(response) == [ids[4], ids[3]]
+        cl = response.context['cl']
+        assert cl.first_page_url is None
+        assert cl.next_page_url == '?before={}'.format(ids[3])
+
+        response = admin_client.get(CHANGELIST_URL + cl.next_page_url)
+        assert listed_ids(response) == [ids[2], ids[1]]
+        response = admin_client.get(CHANGELIST_URL + response.context['cl'].next_page_url)
+        assert listed_ids(response) == [ids[0]]
+        assert response.context['cl'].next_page_url is None
+        assert response.context['cl'].first_page_url == '?'
+        assert 'First page' in response.content.decode()
+
+        # sorted by a column, paged by offsets
+        response = admin_client.get(CHANGELIST_URL + '?o=1')
+        assert listed_ids(response) == [ids[0], ids[1]]
+
+
+def test_changelist_keyset_keeps_filters(admin_client):
+    failed = [Receipt.objects.create(purchase_price=100, status=ReceiptStatus.failed).id for _ in range(3)]
+    Receipt.objects.create(purchase_price=100)
+
+    with mock.patch.object(ReceiptAdmin, 'list_per_page', 2):
+        response = admin_client.get(CHANGELIST_URL + '?status__exact=failed')
+        next_page_url = response.context['cl'].next_page_url
+        assert 'status__exact=failed' in next_page_url
+        response = admin_client.get(CHANGELIST_URL + next_page_url)
+    assert listed_ids(response) == [failed[0]]
+
+
+def test_estimated_count():
+    for _ in range(3):
+        Receipt.objects.create(purchase_price=100)
+
+    paginator = EstimatedCountPaginator(Receipt.objects.all(), 10)
+    assert paginator.count == 3
+    assert not paginator.estimated
+
+    with override_settings(RECEIPTS_ATOL_ADMIN_EXACT_COUNT_LIMIT=0):
+        paginator = EstimatedCountPaginator(Receipt.objects.all(), 10)
+        assert paginator.count >= 0
+        assert paginator.estimated
+
+
+@pytest.mark.parametrize('term, found', [
+    ('atol-uuid-1', [0]),
+    ('JOHN@', [0, 1]),
+    ('john@example.com', [0, 1]),
+    ('+7999', [1]),
+    ('nobody', []),
+])
+def test_changelist_search(admin_client, term, found):
+    receipts = [
+        Receipt.objects.create(purchase_price=100, uuid='atol-uuid-1', user_email='john@example.com'),
+        Receipt.objects.create(purchase_price=100, user_email='John@example.com', user_phone='+79991234567'),
+        Receipt.objects.create(purchase_price=100, user_email='jane@example.com'),
+    ]
+    response = admin_client.get(CHANGELIST_URL, {'q': term})
+    assert sorted(listed_ids(response)) == [receipts[index].id for index in found]
+
+
+def test_changelist_search_by_internal_uuid_and_short_code(admin_client):
+    receipt = Receipt.objects.create(purchase_price=100)
+    Receipt.objects.create(purchase_price=100)
+
+    response = admin_client.get(CHANGELIST_URL, {'q': str(receipt.internal_uuid)})
+    assert listed_ids(response) == [receipt.id]
+    response = admin_client.get(CHANGELIST_URL, {'q': receipt.short_code})
+    assert listed_ids(response) == [receipt.id]
+
+
+def test_change_form_shows_report(admin_client):
+    receipt = Receipt.objects.create(purchase_price=100, content={'payload': {'total': 100}})
+    response = admin_client.get(reverse('admin:atol_receipt_change', args=[receipt.id]))
+    assert response.status_code == 200
+    content = response.content.decode()
+    assert '<pre>{\n  &quot;payload&quot;: {\n    &quot;total&quot;: 100\n  }\n}</pre>' in content
+
+
+def test_replay_action(admin_client):
+    failed = Receipt.objects.create(purchase_price=100, status=ReceiptStatus.failed,
+                                    failure_reason=FailureReason.rejected)
+    received = Receipt.objects.create(purchase_price=100, status=ReceiptStatus.received)
+
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        response = admin_client.post(CHANGELIST_URL, {'action': 'replay_receipts',
+                                                      '_selected_action': [failed.id, received.id]})
+    assert response.status_code == 302
+    assert task_mock.call_args[1]['args'] == ([failed.id],)
+    assert Receipt.objects.get(id=failed.id).status == ReceiptStatus.created
+    assert Receipt.objects.get(id=received.id).status == ReceiptStatus.received
+
+
+def test_repoll_action(admin_client):
+    initiated = Receipt.objects.create(purchase_price=100, status=ReceiptStatus.initiated, uuid='1')
+    retried = Receipt.objects.create(purchase_price=100, status=ReceiptStatus.retried, uuid='2')
+    created = Receipt.objects.create(purchase_price=100)
+
+    with mock.patch.object(atol_receive_receipt_report, 'apply_async') as task_mock:
+        admin_client.post(CHANGELIST_URL, {'action': 'repoll_receipts',
+                                           '_selected_action': [initiated.id, retried.id, created.id]})
+    assert sorted(call[1]['args'][0] for call in task_mock.call_args_list) == [initiated.id, retried.id]
+
+
+def test_cancel_action_is_confirmed(admin_client):
+    receipts = [Receipt.objects.create(purchase_price=100, status=ReceiptStatus.received) for _ in range(2)]
+    Receipt.objects.create(purchase_price=100, status=ReceiptStatus.failed)
+    data = {'action': 'cancel_receipts', 'select_across': '1', '_selected_action': [receipts[0].id]}
+
+    response = admin_client.post(CHANGELIST_URL, data)
+    assert response.status_code == 200
+    assert response.context['count'] == 2
+    content = response.content.decode()
+    assert 'name="confirm_count"' in content
+    assert 'name="select_across" value="1"' in content
+    assert not Receipt.objects.filter(original_receipt__isnull=False).exists()
+
+    # a wrong count shows the confirmation again
+    response = admin_client.post(CHANGELIST_URL, dict(data, post='yes', confirm_count='1'))
+    assert response.context['mismatch']
+    assert not Receipt.objects.filter(original_receipt__isnull=False).exists()
+
+    with mock.patch.object(atol_create_receipts, 'apply_async'):
+        response = admin_client.post(CHANGELIST_URL, dict(data, post='yes', confirm_count='2'))
+    assert response.status_code == 302
+    refunds = Receipt.objects.filter(original_receipt__isnull=False)
+    assert sorted(refund.original_receipt_id for refund in refunds) == [receipt.id for receipt in receipts]
+    assert {refund.operation for refund in refunds} == {ReceiptOperation.sell_refund}
+
+
+@override_settings(RECEIPTS_ATOL_ADMIN_CANCEL_LIMIT=1)
+def test_cancel_action_is_limited(admin_client):
+    receipts = [Receipt.objects.create(purchase_price=100, status=ReceiptStatus.received) for _ in range(2)]
+    response = admin_client.post(CHANGELIST_URL, {'action': 'cancel_receipts', 'post': 'yes', 'confirm_count': '2',
+                                                  '_selected_action': [receipt.id for receipt in receipts]},
+                                 follow=True)
+    assert 'за раз можно отменить не больше 1' in response.content.decode()
+    assert not Receipt.objects.filter(original_receipt__isnull=False).exists()
+
+
+def test_actions_page_ids(admin_client):
+    receipts = [Receipt.objects.create(purchase_price=100, status=ReceiptStatus.initiated, uuid=str(index))
+                for index in range(5)]
+    with mock.patch('atol.admin.ACTION_BATCH_SIZE', 2), \
+            mock.patch.object(atol_receive_receipt_report, 'apply_async') as task_mock:
+        admin_client.post(CHANGELIST_URL, {'action': 'repoll_receipts', 'select_across': '1',
+                                           '_selected_action': [receipts[0].id]})
+    assert [call[1]['args'][0] for call in task_mock.call_args_list] == [receipt.id for receipt in receipts]
+
+
+def test_receipts_can_not_be_added_or_deleted(admin_client):
+    receipt = Receipt.objects.create(purchase_price=100)
+    assert admin_client.get(reverse('admin:atol_receipt_add')).status_code == 403
+    assert admin_client.get(reverse('admin:atol_receipt_delete', args=[receipt.id])).status_code == 403
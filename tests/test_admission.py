@@ -0,0 +1,123 @@
+import mock
+import pytest
+from django.core.cache import cache
+from django.db import transaction
+from django.test import override_settings
+
+from atol.admission import admit, get_backlog, release_held_receipts
+from atol.counters import get_status_counts
+from atol.models import FailureReason, Receipt, ReceiptStatus
+from atol.tasks import atol_create_receipts, atol_release_held_receipts
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+def dispatched_ids(task_mock):
+    return [receipt_id for call in task_mock.call_args_list for receipt_id in call[1]['args'][0]]
+
+
+def fail(receipts):
+    Receipt.objects.filter(id__in=[receipt.id for receipt in receipts]).bulk_declare_failed(
+        reason=FailureReason.rejected)
+    # the backlog is cached for a few seconds
+    cache.delete('atol_admission:backlog')
+
+
+def test_admission_is_off_by_default():
+    Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 3, dispatch=False)
+    assert admit()
+
+    receipt = Receipt.objects.create(purchase_price=100)
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        receipt.dispatch()
+    assert dispatched_ids(task_mock) == [receipt.id]
+
+
+@override_settings(RECEIPTS_ATOL_ADMISSION_HIGH_WATERMARK=3, RECEIPTS_ATOL_ADMISSION_LOW_WATERMARK=1)
+def test_intake_closes_at_high_and_opens_at_low_watermark():
+    Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 3, dispatch=False)
+    receipts = list(Receipt.objects.order_by('id'))
+    assert not admit()
+
+    receipt = Receipt.objects.create(purchase_price=100)
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        receipt.dispatch()
+    assert not task_mock.called
+    receipt.refresh_from_db()
+    assert receipt.status == ReceiptStatus.held
+    assert get_status_counts()[ReceiptStatus.held] == 1
+
+    # between the watermarks
+    fail(receipts[:1])
+    assert not admit()
+    fail(receipts[1:2])
+    assert admit()
+
+    # held receipts are not counted
+    fail(receipts[2:])
+    assert admit()
+
+
+@override_settings(RECEIPTS_ATOL_ADMISSION_HIGH_WATERMARK=2)
+def test_bulk_created_receipts_are_held():
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        first = Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 2)
+        second = Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 2)
+    assert dispatched_ids(task_mock) == [receipt.id for receipt in first]
+    assert list(Receipt.objects.held().order_by('id').values_list('id', flat=True)) == [r.id for r in second]
+
+    # nothing to release until the pipeline makes room
+    assert release_held_receipts() == []
+
+
+@override_settings(RECEIPTS_ATOL_ADMISSION_HIGH_WATERMARK=3)
+def test_bulk_is_admitted_up_to_the_high_watermark():
+    Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 2, dispatch=False)
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        created = Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 3)
+    assert dispatched_ids(task_mock) == [created[0].id]
+    assert sorted(Receipt.objects.held().values_list('id', flat=True)) == [created[1].id, created[2].id]
+    assert cache.get('atol_admission:backlog') == 3
+
+
+@override_settings(RECEIPTS_ATOL_ADMISSION_HIGH_WATERMARK=10)
+def test_rolled_back_intake_is_not_added_to_the_backlog():
+    assert get_backlog() == 0
+    with mock.patch.object(atol_create_receipts, 'apply_async'):
+        with pytest.raises(ZeroDivisionError):
+            with transaction.atomic():
+                Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 3)
+                1 / 0
+        assert get_backlog() == 0
+
+        Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 3)
+    assert get_backlog() == 3
+
+
+@override_settings(RECEIPTS_ATOL_ADMISSION_HIGH_WATERMARK=2)
+def test_held_receipts_are_released_into_the_room():
+    Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 2, dispatch=False)
+    in_flight = list(Receipt.objects.order_by('id'))
+    with mock.patch.object(atol_create_receipts, 'apply_async'):
+        Receipt.objects.bulk_create_receipts([{'purchase_price': 100}] * 3)
+    held = list(Receipt.objects.held().order_by('id'))
+    assert len(held) == 3
+
+    fail(in_flight[:1])
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        atol_release_held_receipts()
+    # the oldest one
+    assert dispatched_ids(task_mock) == [held[0].id]
+    assert Receipt.objects.get(id=held[0].id).status == ReceiptStatus.created
+    assert get_status_counts()[ReceiptStatus.held] == 2
+
+    with override_settings(RECEIPTS_ATOL_ADMISSION_HIGH_WATERMARK=None):
+        with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+            assert len(release_held_receipts()) == 2
+    assert sorted(dispatched_ids(task_mock)) == [held[1].id, held[2].id]
+    assert not Receipt.objects.held().exists()
@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 from uuid import uuid4
 import responses
@@ -168,6 +169,7 @@ def test_atol_create_refund_receipt_workflow():
 
     receipt = atol.sell_refund(**sell_refund_params)
 
+    assert json.loads(responses.calls[-1].request.body)['receipt']['items'][0]['name'] == u'Оплата подписки'
     assert receipt.uuid == '973f3bef-1c39-40c9-abd0-33a91ab005ca'
     assert receipt.data['status'] == 'wait'
 
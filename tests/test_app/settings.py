@@ -55,7 +55,14 @@ DATABASES = {
         'NAME': 'atol',
         'PORT': os.environ['PGPORT'],
         'USER': os.environ['PGUSER'],
-    }
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': 'atol',
+        'PORT': os.environ['PGPORT'],
+        'USER': os.environ['PGUSER'],
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
 
@@ -71,6 +78,8 @@ CACHES = {
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
+STATIC_URL = '/static/'
+
 CELERY_ALWAYS_EAGER = True
 CELERY_IGNORE_RESULT = True
 
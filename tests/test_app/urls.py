@@ -1,6 +1,17 @@
+import django
+from django.contrib import admin
 from django.urls import re_path
-from atol.views import ReceiptView
+from atol.views import HealthView, ReceiptExportView, ReceiptStatusView, ReceiptView
 
 urlpatterns = [
+    re_path(r'^admin/', admin.site.urls),
     re_path(r'^r/(?P<short_uuid>[\w]+)/$', ReceiptView.as_view(), name='receipt'),
+    re_path(r'^s/(?P<short_uuid>[\w]+)/$', ReceiptStatusView.as_view(), name='receipt_status'),
+    re_path(r'^receipts/export/$', ReceiptExportView.as_view(), name='receipt_export'),
+    re_path(r'^health/$', HealthView.as_view(), name='health'),
 ]
+
+if django.VERSION >= (4, 1):
+    from atol.async_views import AsyncReceiptView
+
+    urlpatterns.append(re_path(r'^ar/(?P<short_uuid>[\w]+)/$', AsyncReceiptView.as_view(), name='receipt_async'))
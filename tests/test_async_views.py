@@ -0,0 +1,98 @@
+"""
+AsyncReceiptView, which requires Django >= 4.1
+"""
+from uuid import uuid4
+
+import django
+import pytest
+import shortuuid
+from django.core.cache import cache
+from django.test import override_settings
+from django.urls import reverse
+
+from atol.links import link_cache
+from atol.models import Receipt, ReceiptStatus
+
+if django.VERSION < (4, 1):
+    pytest.skip('async ORM and cache API require Django >= 4.1', allow_module_level=True)
+
+from asgiref.sync import async_to_sync  # noqa: E402
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def clear_link_cache():
+    link_cache.local.clear()
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def empty_link_cache():
+    clear_link_cache()
+
+
+@pytest.fixture
+def receipt_data():
+    return {
+        'callback_url': '',
+        'daemon_code': 'prod-agent-3',
+        'device_code': 'KSR13.11-8-18',
+        'error': None,
+        'group_code': 'mybook-ru_1815',
+        'payload': {
+            'ecr_registration_number': '0000932756018558',
+            'fiscal_document_attribute': 4146968358,
+            'fiscal_document_number': 40,
+            'fiscal_receipt_number': 1,
+            'fn_number': '8710000100942521',
+            'fns_site': 'www.nalog.ru',
+            'receipt_datetime': '26.07.2017 10:32:00',
+            'shift_number': 19,
+            'total': 12
+        },
+        'status': 'done',
+        'timestamp': '26.07.2017 10:32:21',
+        'uuid': 'd407f2bf-edb8-43c9-aac4-468c05f1a8d8'
+    }
+
+
+@async_to_sync
+async def async_get(async_client, short_uuid):
+    return await async_client.get(reverse('receipt_async', kwargs={'short_uuid': short_uuid}))
+
+
+def test_async_receipt_view(async_client, receipt_data, django_assert_num_queries):
+    legacy_receipt = Receipt.objects.create(content=receipt_data, status=ReceiptStatus.received)
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt.receive(content=receipt_data)
+    clear_link_cache()
+
+    template = u'fake?t={t}&s={s}&fn={fn}&i={fd}&fp={fp}&n={n}'
+    location = 'fake?t=20170726T103200&s=12&fn=8710000100942521&i=40&fp=4146968358&n=1'
+    with override_settings(RECEIPTS_OFD_URL_TEMPLATE=template):
+        with django_assert_num_queries(1):
+            resp = async_get(async_client, receipt.short_code)
+        assert (resp.status_code, resp['Location']) == (302, location)
+        with django_assert_num_queries(0):
+            assert async_get(async_client, receipt.short_code)['Location'] == location
+
+        # content of receipts yet to be backfilled is fetched separately
+        with django_assert_num_queries(2):
+            resp = async_get(async_client, shortuuid.encode(legacy_receipt.internal_uuid))
+        assert resp['Location'] == location
+
+        signed_token = receipt.signed_ofd_link.strip('/').split('/')[-1]
+        with django_assert_num_queries(0):
+            assert async_get(async_client, signed_token)['Location'] == location
+
+
+@pytest.mark.parametrize('content, status', [
+    (None, ReceiptStatus.initiated),
+    ({'a': 'b'}, ReceiptStatus.received),
+])
+def test_async_receipt_view_404(async_client, content, status):
+    receipt = Receipt.objects.create(content=content, status=status)
+
+    resp = async_get(async_client, shortuuid.encode(receipt.internal_uuid))
+    assert resp.status_code == 404
+    assert async_get(async_client, shortuuid.encode(uuid4())).status_code == 404
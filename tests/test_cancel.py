@@ -0,0 +1,159 @@
+from uuid import uuid4
+
+import mock
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from atol.core import AtolAPI, NewReceipt
+from atol.exceptions import AtolRecoverableError, AtolUnrecoverableError
+from atol.models import Checkpoint, FailureReason, Receipt, ReceiptOperation, ReceiptStatus
+from atol.signals import receipt_received, receipts_received
+from atol.tasks import atol_create_receipt, atol_create_receipts, atol_receive_receipt_report
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+REPORT = {'status': 'done', 'payload': {'fn_number': '8710000100942521', 'fiscal_document_number': 40,
+                                        'fiscal_document_attribute': 4146968358, 'fiscal_receipt_number': 1,
+                                        'receipt_datetime': '26.07.2017 10:32:00', 'total': 707.1}}
+
+
+def create_received(**kwargs):
+    receipt = Receipt.objects.create(status=ReceiptStatus.received, user_email='foo@bar.com', purchase_price=707.1,
+                                     purchase_name='Подписка', content=REPORT, received_at=timezone.now(), **kwargs)
+    receipt.set_fiscal_data()
+    receipt.save()
+    return receipt
+
+
+def test_cancel_params_from_fiscal_columns():
+    receipt = create_received()
+    Receipt.objects.filter(id=receipt.id).update(content=None)
+    receipt = Receipt.objects.defer('content').get(id=receipt.id)
+    transaction_uuid = uuid4()
+
+    with mock.patch.object(Receipt, 'get_content') as content_mock:
+        params = receipt.get_cancel_receipt_params(transaction_uuid=transaction_uuid)
+        assert not content_mock.called
+
+    assert params['purchase_price'] == 707.1
+    assert params['original_fiscal_number'] == 4146968358
+    assert params['transaction_uuid'] == str(transaction_uuid)
+
+
+def test_bulk_cancel():
+    received = create_received()
+    cancelled = create_received()
+    Receipt.objects.create(operation=ReceiptOperation.sell_refund, original_receipt=cancelled)
+    refund_failed = create_received()
+    Receipt.objects.create(operation=ReceiptOperation.sell_refund, original_receipt=refund_failed,
+                           status=ReceiptStatus.failed)
+    Receipt.objects.create(status=ReceiptStatus.failed)
+    Receipt.objects.create(status=ReceiptStatus.initiated)
+
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        refunds = Receipt.objects.all().bulk_cancel()
+
+    refunds = list(Receipt.objects.filter(id__in=[refund.id for refund in refunds]))
+    assert [refund.original_receipt_id for refund in refunds] == [received.id]
+    assert {refund.operation for refund in refunds} == {ReceiptOperation.sell_refund}
+    assert {refund.purchase_price for refund in refunds} == {received.total}
+    assert task_mock.call_args[1]['args'] == ([refunds[0].id],)
+
+
+def test_refund_is_registered_by_pipeline():
+    original = create_received()
+    refund = Receipt.objects.create(operation=ReceiptOperation.sell_refund, original_receipt=original)
+
+    new_receipt = NewReceipt(uuid='refund-uuid', data=None)
+    with mock.patch.object(AtolAPI, 'sell_refund', return_value=new_receipt) as refund_mock:
+        with mock.patch.object(atol_receive_receipt_report, 'apply_async') as report_mock:
+            atol_create_receipts([refund.id])
+
+    params = refund_mock.call_args[1]
+    assert params['transaction_uuid'] == str(refund.internal_uuid)
+    assert params['original_fiscal_number'] == 4146968358
+    assert params['payment_type'] == 4
+    assert report_mock.call_args[1]['args'] == (refund.id,)
+    refund.refresh_from_db()
+    assert (refund.status, refund.uuid, refund.attempts) == (ReceiptStatus.initiated, 'refund-uuid', 1)
+
+
+def test_refunds_are_sent_with_batched_signals_only():
+    refund = Receipt.objects.create(operation=ReceiptOperation.sell_refund, original_receipt=create_received(),
+                                    status=ReceiptStatus.initiated)
+    sell = Receipt.objects.create(status=ReceiptStatus.initiated)
+    handler, batch_handler = mock.Mock(), mock.Mock()
+    receipt_received.connect(handler)
+    receipts_received.connect(batch_handler)
+    try:
+        Receipt.objects.bulk_receive({refund.id: REPORT, sell.id: REPORT})
+    finally:
+        receipt_received.disconnect(handler)
+        receipts_received.disconnect(batch_handler)
+
+    assert [call[1]['receipt'].id for call in handler.call_args_list] == [sell.id]
+    assert sorted(receipt.id for receipt in batch_handler.call_args[1]['receipts']) == [refund.id, sell.id]
+
+
+def test_cancel_command():
+    today = timezone.now().date()
+    originals = [create_received() for _ in range(4)]
+    # neither content nor fiscal attributes to refund
+    malformed = Receipt.objects.create(status=ReceiptStatus.received)
+    outcomes = [NewReceipt(uuid='ok', data=None), AtolUnrecoverableError(error_code=34), AtolRecoverableError(),
+                NewReceipt(uuid='ok-too', data=None)]
+    original_outcomes = dict(zip((str(original.id) for original in originals), outcomes))
+
+    def sell_refund(self, **params):
+        refund = Receipt.objects.get(internal_uuid=params['transaction_uuid'])
+        outcome = original_outcomes[str(refund.original_receipt_id)]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    with mock.patch.object(AtolAPI, 'sell_refund', autospec=True, side_effect=sell_refund) as refund_mock:
+        with mock.patch.object(atol_receive_receipt_report, 'apply_async') as report_mock:
+            with mock.patch.object(atol_create_receipt, 'apply_async') as retry_mock:
+                call_command('atol_cancel_receipts', '--from', str(today), '--to', str(today),
+                             '--chunk-size', '2', '--rate', '0')
+
+    assert refund_mock.call_count == 4
+    refunds = {refund.original_receipt_id: refund for refund in Receipt.objects.filter(
+        operation=ReceiptOperation.sell_refund)}
+    assert len(refunds) == 5
+    assert refunds[originals[0].id].status == ReceiptStatus.initiated
+    assert refunds[originals[1].id].status == ReceiptStatus.failed
+    assert (refunds[originals[1].id].failure_reason, refunds[originals[1].id].error_code) == \
+        (FailureReason.rejected, 34)
+    assert refunds[originals[2].id].status == ReceiptStatus.created
+    assert refunds[originals[3].id].uuid == 'ok-too'
+    assert refunds[malformed.id].failure_reason == FailureReason.invalid
+    assert sorted(call[1]['args'][0] for call in report_mock.call_args_list) == \
+        sorted([refunds[originals[0].id].id, refunds[originals[3].id].id])
+    assert [call[1]['args'] for call in retry_mock.call_args_list] == [(refunds[originals[2].id].id,)]
+    assert not Checkpoint.objects.exists()
+
+    # cancelled receipts and retried refunds are skipped by another run, failed refunds are to be replayed
+    with mock.patch.object(AtolAPI, 'sell_refund') as refund_mock:
+        call_command('atol_cancel_receipts', '--from', str(today), '--to', str(today), '--rate', '0')
+    assert refund_mock.call_count == 0
+    assert Receipt.objects.filter(operation=ReceiptOperation.sell_refund).count() == 5
+
+
+def test_cancel_command_registers_refunds_of_interrupted_run(tmp_path):
+    today = timezone.now().date()
+    original, other = create_received(), create_received()
+    refund = Receipt.objects.create(operation=ReceiptOperation.sell_refund, original_receipt=original)
+    ids_file = tmp_path / 'ids.txt'
+    ids_file.write_text('{}\n'.format(original.id))
+
+    with mock.patch.object(AtolAPI, 'sell_refund', return_value=NewReceipt(uuid='ok', data=None)) as refund_mock:
+        with mock.patch.object(atol_receive_receipt_report, 'apply_async'):
+            call_command('atol_cancel_receipts', '--from', str(today), '--to', str(today),
+                         '--ids-file', str(ids_file), '--rate', '0')
+
+    assert refund_mock.call_count == 1
+    refund.refresh_from_db()
+    assert refund.status == ReceiptStatus.initiated
+    assert not other.refunds.exists()
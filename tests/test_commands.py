@@ -0,0 +1,88 @@
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from atol.models import Receipt, ReceiptArchive, ReceiptStatus
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def test_backfill_fiscal_fields():
+    payload = {
+        'fiscal_document_attribute': 4146968358,
+        'fiscal_document_number': 40,
+        'fiscal_receipt_number': 1,
+        'fn_number': '8710000100942521',
+        'receipt_datetime': '26.07.2017 10:32:00',
+        'total': 199.99,
+    }
+    receipts = [Receipt.objects.create(status=ReceiptStatus.received, content={'payload': payload})
+                for _ in range(3)]
+    malformed = Receipt.objects.create(status=ReceiptStatus.received, content={'payload': {'total': 1}})
+    pending = Receipt.objects.create(status=ReceiptStatus.initiated)
+
+    call_command('atol_backfill_fiscal_fields', chunk_size=2)
+
+    for receipt in receipts:
+        receipt.refresh_from_db()
+        assert receipt.fn_number == '8710000100942521'
+        assert receipt.fiscal_document_number == 40
+        assert receipt.fiscal_document_attribute == 4146968358
+        assert receipt.fiscal_receipt_number == 1
+        assert receipt.total == Decimal('199.99')
+        assert receipt.receipt_datetime == datetime(2017, 7, 26, 10, 32)
+
+    for receipt in [malformed, pending]:
+        receipt.refresh_from_db()
+        assert receipt.fn_number is None
+
+
+def test_backfill_short_codes():
+    receipts = [Receipt.objects.create() for _ in range(3)]
+    Receipt.objects.update(short_code=None)
+
+    call_command('atol_backfill_short_codes', chunk_size=2)
+
+    for receipt in receipts:
+        short_code = receipt.short_code
+        receipt.refresh_from_db()
+        assert receipt.short_code == short_code
+
+
+def test_archive_receipts(django_assert_num_queries):
+    payload = {
+        'fiscal_document_attribute': 4146968358,
+        'fiscal_document_number': 40,
+        'fiscal_receipt_number': 1,
+        'fn_number': '8710000100942521',
+        'receipt_datetime': '26.07.2017 10:32:00',
+        'total': 199.99,
+    }
+    old = [Receipt.objects.create(status=status, content={'payload': payload})
+           for status in [ReceiptStatus.received, ReceiptStatus.received, ReceiptStatus.failed]]
+    pending = Receipt.objects.create(status=ReceiptStatus.initiated)
+    Receipt.objects.filter(id__in=[receipt.id for receipt in old + [pending]]).update(
+        created_at=timezone.now() - timedelta(days=40))
+    recent = Receipt.objects.create(status=ReceiptStatus.received, content={'payload': payload})
+
+    call_command('atol_archive_receipts', days=30, chunk_size=2)
+
+    for receipt in old:
+        receipt.refresh_from_db()
+        assert receipt.archived_at is not None
+        assert receipt.content is None
+        assert receipt.get_content() == {'payload': payload}
+    assert old[0].fn_number == '8710000100942521'
+    assert ReceiptArchive.objects.count() == 3
+
+    for receipt in [pending, recent]:
+        receipt.refresh_from_db()
+        assert receipt.archived_at is None
+        assert receipt.content == ({'payload': payload} if receipt == recent else None)
+
+    # nothing is left to archive on the next run
+    with django_assert_num_queries(1):
+        call_command('atol_archive_receipts', days=30)
@@ -0,0 +1,178 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from uuid import uuid4
+
+import mock
+import pytest
+from django.core.cache import cache
+from django.test import override_settings
+from django.urls import reverse
+
+from atol.consolidation import consolidate_receipt
+from atol.core import AtolAPI, NewReceipt, ReceiptReport
+from atol.counters import get_status_counts
+from atol.dispatch import send_receipts
+from atol.models import FailureReason, Receipt, ReceiptStatus
+from atol.signals import receipt_failed
+from atol.tasks import atol_create_receipts, atol_receive_receipt_report
+from atol.validation import validate_registration_data
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+REPORT = {'status': 'done', 'payload': {'fn_number': '8710000100942521', 'fiscal_document_number': 40,
+                                        'fiscal_document_attribute': 4146968358, 'fiscal_receipt_number': 1,
+                                        'receipt_datetime': '26.07.2017 10:32:00', 'total': 300.3}}
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+def test_multi_item_registration_data():
+    request_data = AtolAPI().get_registration_data({
+        'timestamp': datetime(2017, 11, 22, 10, 47, 32), 'transaction_uuid': str(uuid4()),
+        'purchase_name': 'unused', 'purchase_price': 0, 'user_email': 'user@example.com',
+        'items': [{'name': 'Книга', 'price': Decimal('100.1')}, {'name': 'Подписка', 'price': Decimal('200.2')}],
+    })
+    validate_registration_data(request_data)
+
+    receipt = request_data['receipt']
+    assert [(item['name'], item['price'], item['sum']) for item in receipt['items']] == [
+        ('Книга', 100.1, 100.1), ('Подписка', 200.2, 200.2)]
+    assert receipt['total'] == 300.3
+    assert receipt['payments'] == [{'sum': 300.3, 'type': 1}]
+
+
+@override_settings(RECEIPTS_ATOL_CONSOLIDATION_WINDOW=60)
+def test_dispatch_waits_for_consolidation_window():
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        send_receipts([1, 2])
+    assert task_mock.call_args[1]['countdown'] == 60
+
+
+@override_settings(RECEIPTS_ATOL_CONSOLIDATION_WINDOW=60)
+def test_purchases_are_consolidated(client):
+    def create(minutes=0, **kwargs):
+        kwargs.setdefault('user_email', 'foo@bar.com')
+        receipt = Receipt.objects.create(purchase_price=kwargs.pop('price', 100), **kwargs)
+        Receipt.objects.filter(id=receipt.id).update(created_at=receipt.created_at + timedelta(minutes=minutes))
+        return receipt
+
+    first = create(price=Decimal('100.1'), purchase_name='Книга')
+    second = create(price=Decimal('200.2'), purchase_name='Подписка')
+    other_customer = create(user_email='bar@foo.com')
+    later = create(minutes=2)
+    ids = [first.id, second.id, other_customer.id, later.id]
+
+    uuids = iter(['first-uuid', 'other-uuid', 'later-uuid'])
+    with mock.patch.object(AtolAPI, 'sell', side_effect=lambda **params: NewReceipt(uuid=next(uuids), data=None)) \
+            as sell_mock:
+        with mock.patch.object(atol_receive_receipt_report, 'apply_async'):
+            atol_create_receipts(ids)
+
+    assert sell_mock.call_count == 3
+    params = sell_mock.call_args_list[0][1]
+    assert params['transaction_uuid'] == str(first.internal_uuid)
+    assert params['items'] == [{'name': 'Книга', 'price': Decimal('100.1')},
+                               {'name': 'Подписка', 'price': Decimal('200.2')}]
+    assert params['purchase_price'] == Decimal('300.3')
+
+    receipts = Receipt.objects.in_bulk(ids)
+    assert [receipts[pk].status for pk in ids] == [ReceiptStatus.initiated, ReceiptStatus.consolidated,
+                                                   ReceiptStatus.initiated, ReceiptStatus.initiated]
+    assert receipts[second.id].consolidated_into_id == receipts[first.id].consolidated_into_id == first.id
+    assert receipts[other_customer.id].consolidated_into_id is None
+    assert receipts[second.id].attempts == 0
+
+    with mock.patch.object(AtolAPI, 'report', return_value=ReceiptReport(uuid='first-uuid', data=REPORT)):
+        atol_receive_receipt_report(first.id)
+
+    second.refresh_from_db()
+    assert (second.status, second.uuid, second.fn_number) == (ReceiptStatus.received, 'first-uuid', '8710000100942521')
+    assert second.total == Decimal('300.3')
+    assert get_status_counts() == {ReceiptStatus.received: 2, ReceiptStatus.initiated: 2}
+
+    response = client.get(second.ofd_link)
+    assert response.status_code == 302
+    assert 'fp=4146968358' in response['Location']
+
+    # each purchase is refunded on its own
+    assert second.get_cancel_receipt_params()['purchase_price'] == 200.2
+
+
+@override_settings(RECEIPTS_ATOL_CONSOLIDATION_WINDOW=60)
+def test_attempted_receipts_are_not_consolidated():
+    first = Receipt.objects.create(user_email='foo@bar.com', purchase_price=100, attempts=1)
+    second = Receipt.objects.create(user_email='foo@bar.com', purchase_price=100)
+
+    with mock.patch.object(AtolAPI, 'sell', return_value=NewReceipt(uuid='uuid', data=None)) as sell_mock:
+        with mock.patch.object(atol_receive_receipt_report, 'apply_async'):
+            atol_create_receipts([first.id, second.id])
+
+    assert sell_mock.call_count == 2
+    assert not Receipt.objects.filter(consolidated_into__isnull=False).exists()
+
+
+@override_settings(RECEIPTS_ATOL_CONSOLIDATION_WINDOW=60)
+def test_purchase_merged_meanwhile_is_not_registered_on_its_own(client):
+    first = Receipt.objects.create(user_email='foo@bar.com', purchase_price=100)
+    second = Receipt.objects.create(user_email='foo@bar.com', purchase_price=200)
+    status_url = reverse('receipt_status', kwargs={'short_uuid': second.short_code})
+    assert client.get(status_url).json()['status'] == 'created'
+
+    def consolidate_meanwhile(receipt):
+        merged = consolidate_receipt(receipt)
+        if receipt.id == second.id:
+            # the task registering the first purchase merges the second one after it has been found alone
+            consolidate_receipt(Receipt.objects.get(id=first.id))
+        return merged
+
+    with mock.patch('atol.tasks.consolidate_receipt', side_effect=consolidate_meanwhile), \
+            mock.patch.object(AtolAPI, 'sell') as sell_mock:
+        atol_create_receipts([second.id])
+
+    assert not sell_mock.called
+    second.refresh_from_db()
+    assert (second.status, second.consolidated_into_id, second.attempts) == (ReceiptStatus.consolidated, first.id, 0)
+    assert client.get(status_url).json()['status'] == 'consolidated'
+
+
+@pytest.mark.parametrize('bulk', [False, True])
+@override_settings(RECEIPTS_ATOL_CONSOLIDATION_WINDOW=60)
+def test_purchases_fail_along_with_consolidated_receipt(bulk):
+    first = Receipt.objects.create(user_email='foo@bar.com', purchase_price=100)
+    second = Receipt.objects.create(user_email='foo@bar.com', purchase_price=200)
+
+    with mock.patch.object(AtolAPI, 'sell', return_value=NewReceipt(uuid='uuid', data=None)):
+        with mock.patch.object(atol_receive_receipt_report, 'apply_async'):
+            atol_create_receipts([first.id, second.id])
+
+    failed = []
+
+    def on_failed(sender, receipt, **kwargs):
+        failed.append(receipt.id)
+
+    receipt_failed.connect(on_failed)
+    try:
+        if bulk:
+            Receipt.objects.filter(id=first.id).bulk_declare_failed(reason=FailureReason.rejected, error_code=34)
+        else:
+            Receipt.objects.get(id=first.id).declare_failed(reason=FailureReason.rejected, error_code=34)
+    finally:
+        receipt_failed.disconnect(on_failed)
+    assert sorted(failed) == [first.id, second.id]
+
+    second.refresh_from_db()
+    assert (second.status, second.failure_reason, second.error_code) == (
+        ReceiptStatus.failed, FailureReason.rejected, 34)
+    assert second.failed_at is not None
+    assert second.consolidated_into_id is None
+    assert get_status_counts() == {ReceiptStatus.failed: 2}
+
+    # both are replayed, the consolidated receipt registers its own purchase only
+    with mock.patch.object(atol_create_receipts, 'apply_async'):
+        replayed = Receipt.objects.failed().bulk_replay()
+    assert sorted(receipt.id for receipt in replayed) == [first.id, second.id]
+    first.refresh_from_db()
+    assert first.get_params()['items'] == [{'name': 'Оплата подписки', 'price': Decimal('100')}]
@@ -0,0 +1,88 @@
+from datetime import timedelta
+
+import mock
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from atol.counters import get_daily_counts, get_status_counts, reconcile_counters
+from atol.models import Receipt, ReceiptCounter, ReceiptStatus
+from atol.exceptions import AtolReceiptNotProcessed
+from atol.tasks import (atol_create_receipts, atol_reconcile_receipt_counters,
+                        atol_receive_receipt_report)
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def test_transitions_are_counted():
+    receipt = Receipt.objects.create()
+    with mock.patch.object(atol_create_receipts, 'apply_async'):
+        Receipt.objects.bulk_create_receipts([{'user_email': 'foo@bar.com', 'purchase_price': 1}] * 3)
+    assert get_status_counts() == {ReceiptStatus.created: 4}
+
+    receipt.initiate(uuid='uuid')
+    receipt.receive(content={'payload': {}})
+    created = list(Receipt.objects.filter(status=ReceiptStatus.created))
+    Receipt.objects.bulk_initiate({created[0].id: 'uuid-1', created[1].id: 'uuid-2'})
+    Receipt.objects.bulk_receive({created[0].id: {'payload': {}}})
+    Receipt.objects.filter(id=created[2].id).bulk_declare_failed()
+    Receipt.objects.get(id=created[1].id).declare_failed(status=ReceiptStatus.no_email_phone)
+
+    assert get_status_counts() == {
+        ReceiptStatus.received: 2,
+        ReceiptStatus.failed: 1,
+        ReceiptStatus.no_email_phone: 1,
+    }
+    today = timezone.now().date()
+    assert get_daily_counts() == {today: get_status_counts()}
+    assert get_status_counts(day_to=today - timedelta(days=1)) == {}
+    assert reconcile_counters() == {}
+
+
+def test_retried_receipts_are_counted():
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated, uuid='uuid')
+
+    with mock.patch('atol.tasks.AtolAPI') as api_mock, mock.patch('atol.tasks.atol_create_receipt.apply_async'):
+        api_mock.return_value.report.side_effect = AtolReceiptNotProcessed()
+        atol_receive_receipt_report(receipt.id)
+
+    assert get_status_counts() == {ReceiptStatus.retried: 1}
+
+
+def test_reconcile_counters():
+    receipts = [Receipt.objects.create() for _ in range(3)]
+    old = Receipt.objects.create()
+    Receipt.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=10))
+    # transitions made behind the back of counters
+    Receipt.objects.filter(id=receipts[0].id).update(status=ReceiptStatus.received)
+    ReceiptCounter.objects.create(day=timezone.now().date() - timedelta(days=20), status='failed', count=5)
+
+    atol_reconcile_receipt_counters()
+    today = timezone.now().date()
+    assert get_daily_counts(day_from=today) == {today: {ReceiptStatus.created: 2, ReceiptStatus.received: 1}}
+    # older days are left for the full reconciliation
+    assert get_status_counts(day_to=today - timedelta(days=3)) == {'failed': 5}
+
+    drift = reconcile_counters()
+    assert drift == {
+        (today - timedelta(days=10), ReceiptStatus.created): 1,
+        (today - timedelta(days=20), 'failed'): -5,
+    }
+    assert get_status_counts() == {ReceiptStatus.created: 3, ReceiptStatus.received: 1}
+
+
+def test_receipt_counters_command(capsys):
+    Receipt.objects.create()
+    Receipt.objects.filter().update(status=ReceiptStatus.failed)
+
+    call_command('atol_receipt_counters', '--reconcile', '--daily')
+
+    out = capsys.readouterr().out.splitlines()
+    today = timezone.now().date()
+    assert out == [
+        'fixed {} created: -1'.format(today),
+        'fixed {} failed: +1'.format(today),
+        'reconciled: 2 day/status pairs fixed',
+        '{} created=0 initiated=0 retried=0 received=0 no_email_phone=0 failed=1 consolidated=0 held=0'
+        .format(today),
+    ]
@@ -0,0 +1,80 @@
+import mock
+import pytest
+from django.db import transaction
+from django.test import override_settings
+
+from atol.models import Receipt, ReceiptStatus
+from atol.tasks import atol_create_receipts
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def test_bulk_create_receipts():
+    receipts_data = [{'user_email': 'user%s@example.com' % i, 'purchase_price': 100 + i} for i in range(5)]
+
+    with override_settings(RECEIPTS_ATOL_DISPATCH_CHUNK_SIZE=2):
+        with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+            created = Receipt.objects.bulk_create_receipts(receipts_data)
+
+    assert len(created) == 5
+    receipts = list(Receipt.objects.all())
+    assert [receipt.id for receipt in receipts] == [receipt.id for receipt in created]
+    assert [receipt.ofd_link for receipt in receipts] == [receipt.ofd_link for receipt in created]
+    assert all(receipt.status == ReceiptStatus.created for receipt in receipts)
+
+    assert [call[1]['args'] for call in task_mock.call_args_list] == [
+        ([created[0].id, created[1].id],),
+        ([created[2].id, created[3].id],),
+        ([created[4].id],),
+    ]
+
+
+def test_receipts_of_one_transaction_are_dispatched_once_on_commit():
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        with transaction.atomic():
+            created = Receipt.objects.bulk_create_receipts([Receipt(user_email='foo@bar.com', purchase_price=1)])
+            receipt = Receipt.objects.create(user_email='foo@bar.com', purchase_price=2)
+            receipt.dispatch()
+            assert len(task_mock.mock_calls) == 0
+
+        assert len(task_mock.mock_calls) == 1
+        assert task_mock.call_args[1]['args'] == ([created[0].id, receipt.id],)
+
+        # the next transaction gets a batch of its own
+        with transaction.atomic():
+            receipt.dispatch()
+        assert len(task_mock.mock_calls) == 2
+        assert task_mock.call_args[1]['args'] == ([receipt.id],)
+
+
+def test_rolled_back_receipts_are_not_dispatched():
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        with pytest.raises(ZeroDivisionError):
+            with transaction.atomic():
+                Receipt.objects.bulk_create_receipts([{'user_email': 'foo@bar.com', 'purchase_price': 1}])
+                1 / 0
+
+        with transaction.atomic():
+            receipt = Receipt.objects.create(user_email='foo@bar.com', purchase_price=2)
+            receipt.dispatch()
+
+    assert len(task_mock.mock_calls) == 1
+    assert task_mock.call_args[1]['args'] == ([receipt.id],)
+
+
+def test_receipts_of_rolled_back_savepoint_are_not_dispatched():
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        with transaction.atomic():
+            first = Receipt.objects.create(user_email='foo@bar.com', purchase_price=1)
+            first.dispatch()
+            with pytest.raises(ZeroDivisionError):
+                with transaction.atomic():
+                    rolled_back = Receipt.objects.create(user_email='foo@bar.com', purchase_price=2)
+                    rolled_back.dispatch()
+                    1 / 0
+            with transaction.atomic():
+                released = Receipt.objects.create(user_email='foo@bar.com', purchase_price=3)
+                released.dispatch()
+
+    dispatched = [receipt_id for call in task_mock.call_args_list for receipt_id in call[1]['args'][0]]
+    assert sorted(dispatched) == [first.id, released.id]
@@ -0,0 +1,116 @@
+import csv
+import io
+import json
+from datetime import timedelta
+
+import pytest
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from atol.models import Receipt, ReceiptStatus
+
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+@pytest.fixture
+def receipts():
+    content = {
+        'payload': {
+            'ecr_registration_number': '0000932756018558',
+            'fiscal_document_attribute': 4146968358,
+            'fiscal_document_number': 40,
+            'fiscal_receipt_number': 1,
+            'fn_number': '8710000100942521',
+            'fns_site': 'www.nalog.ru',
+            'receipt_datetime': '26.07.2017 10:32:00',
+            'total': 199.99,
+        },
+    }
+    received = Receipt.objects.create(status=ReceiptStatus.initiated, user_email='user@example.com',
+                                      purchase_price=199.99, purchase_name='Подписка')
+    received.receive(content=content)
+    failed = Receipt.objects.create(status=ReceiptStatus.failed)
+    old = Receipt.objects.create(status=ReceiptStatus.received)
+    Receipt.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=40))
+    return received, failed, old
+
+
+def test_export_csv_command(receipts):
+    received, failed, old = receipts
+    today = timezone.now().date()
+    out = io.StringIO()
+
+    with CaptureQueriesContext(connection) as ctx:
+        call_command('atol_export_receipts', '--from', str(today - timedelta(days=1)), '--status', 'received',
+                     stdout=out)
+
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    assert [row['id'] for row in rows] == [str(received.id)]
+    assert rows[0]['fn_number'] == '8710000100942521'
+    assert rows[0]['total'] == '199.99'
+    assert rows[0]['ecr_registration_number'] == '0000932756018558'
+    assert rows[0]['purchase_name'] == 'Подписка'
+    # the report is never loaded whole
+    assert not any('"content"' in query['sql'].replace('"content" #>>', '') for query in ctx.captured_queries)
+
+    out = io.StringIO()
+    call_command('atol_export_receipts', '--to', str(today - timedelta(days=30)), stdout=out)
+    assert [row['id'] for row in csv.DictReader(io.StringIO(out.getvalue()))] == [str(old.id)]
+
+
+def test_export_csv_escapes_formulas():
+    Receipt.objects.create(user_email='=HYPERLINK("http://example.com")', purchase_name='-1+2',
+                           user_phone='+79991234567')
+    out = io.StringIO()
+
+    call_command('atol_export_receipts', stdout=out)
+
+    row = next(csv.DictReader(io.StringIO(out.getvalue())))
+    assert row['user_email'] == '\'=HYPERLINK("http://example.com")'
+    assert row['purchase_name'] == "'-1+2"
+    assert row['user_phone'] == "'+79991234567"
+    assert row['status'] == 'created'
+
+
+def test_export_jsonl_command(receipts, tmpdir):
+    received, failed, old = receipts
+    output = tmpdir.join('receipts.jsonl')
+
+    call_command('atol_export_receipts', '--format', 'jsonl', '--output', str(output))
+
+    rows = [json.loads(line) for line in output.read_text('utf-8').splitlines()]
+    assert [row['id'] for row in rows] == sorted(receipt.id for receipt in receipts)
+    assert rows[0]['fiscal_document_attribute'] == 4146968358
+    assert rows[0]['fns_site'] == 'www.nalog.ru'
+
+
+def test_export_view(client, admin_user, receipts):
+    received, failed, old = receipts
+    url = reverse('receipt_export')
+    assert client.get(url).status_code == 302
+
+    client.force_login(admin_user)
+    response = client.get(url, {'format': 'jsonl', 'status': ['failed', 'received']})
+    assert response.status_code == 200
+    assert response.streaming
+    assert response['Content-Type'].startswith('application/x-ndjson')
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    assert [json.loads(line)['id'] for line in lines] == [received.id, failed.id, old.id]
+
+    response = client.get(url, {'from': '2017-01-01', 'to': '2017-12-31'})
+    assert b''.join(response.streaming_content).decode('utf-8').splitlines() == [
+        'id,internal_uuid,uuid,status,operation,original_receipt_id,created_at,received_at,user_email,user_phone,'
+        'purchase_price,purchase_name,'
+        'fn_number,fiscal_document_number,fiscal_document_attribute,fiscal_receipt_number,total,receipt_datetime,'
+        'ecr_registration_number,fns_site',
+    ]
+
+    for params in [{'format': 'xml'}, {'from': 'yesterday'}, {'to': '2022-02-30'}, {'status': 'lost'}]:
+        assert client.get(url, params).status_code == 400
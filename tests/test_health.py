@@ -0,0 +1,102 @@
+from datetime import timedelta
+
+import mock
+import pytest
+import responses
+from django.core.cache import cache
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from atol.core import AtolAPI
+from atol.exceptions import AtolClientRequestException, AtolRequestException
+from atol.health import get_health, get_request_stats, get_token_age, record_request
+from atol.models import Receipt, ReceiptStatus
+from tests import ATOL_BASE_URL
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+@responses.activate
+def test_atol_requests_are_counted():
+    responses.add(responses.POST, ATOL_BASE_URL + '/getToken', status=200, json={'code': 0, 'token': 'foobar'})
+    responses.add(responses.GET, ATOL_BASE_URL + '/ATOL-ProdTest-1/report/1', status=200,
+                  json={'uuid': '1', 'status': 'wait', 'error': {'code': 34, 'text': 'not yet'}})
+    responses.add(responses.GET, ATOL_BASE_URL + '/ATOL-ProdTest-1/report/2', status=500)
+    responses.add(responses.GET, ATOL_BASE_URL + '/ATOL-ProdTest-1/report/3', status=200,
+                  json={'uuid': '3', 'status': 'wait', 'error': None})
+
+    assert get_token_age() is None
+    atol = AtolAPI()
+    with pytest.raises(AtolClientRequestException):
+        atol.request('get', 'report/1')
+    with pytest.raises(AtolRequestException):
+        atol.request('get', 'report/2')
+    atol.request('get', 'report/3')
+
+    assert 0 <= get_token_age() < 5
+    stats = get_request_stats()
+    assert (stats['window'], stats['requests'], stats['errors'], stats['rejected']) == (300, 3, 1, 1)
+    assert stats['error_rate'] == 0.3333
+    assert stats['latency'] >= 0
+
+
+def test_request_stats_of_the_window():
+    with mock.patch('atol.health.time.time', return_value=600 * 60):
+        record_request(0.5)
+        record_request(1.5, 'errors')
+        assert get_request_stats()['latency'] == 1
+    with mock.patch('atol.health.time.time', return_value=604 * 60):
+        assert get_request_stats()['requests'] == 2
+    with mock.patch('atol.health.time.time', return_value=605 * 60):
+        assert get_request_stats() == {'window': 300, 'requests': 0, 'errors': 0, 'rejected': 0,
+                                       'error_rate': None, 'latency': None}
+
+
+def test_pipeline_is_served_from_cache(django_assert_num_queries):
+    now = timezone.now()
+    Receipt.objects.create(purchase_price=100)
+    Receipt.objects.create(purchase_price=100, status=ReceiptStatus.initiated, initiated_at=now - timedelta(hours=1))
+    Receipt.objects.create(purchase_price=100, status=ReceiptStatus.received)
+
+    # counters and the oldest receipt of each pending status
+    with django_assert_num_queries(5):
+        pipeline = get_health()['pipeline']
+    assert pipeline['created']['count'] == 1
+    assert 0 <= pipeline['created']['oldest_age'] < 60
+    assert pipeline['initiated']['count'] == 1
+    assert pipeline['initiated']['oldest_age'] >= 3600
+    assert pipeline['retried'] == {'count': 0, 'oldest_age': None}
+
+    with django_assert_num_queries(0):
+        get_health()
+
+
+def test_health_view(client):
+    response = client.get(reverse('health'))
+    assert response.status_code == 200
+    assert response['Cache-Control'].startswith('max-age=0')
+    health = response.json()
+    assert (health['status'], health['problems'], health['token_age']) == ('ok', [], None)
+    assert set(health['pipeline']) == {'created', 'initiated', 'retried', 'held'}
+
+
+@override_settings(RECEIPTS_ATOL_HEALTH_MAX_BACKLOG_AGE=600)
+def test_health_view_degraded(client):
+    Receipt.objects.create(purchase_price=100, status=ReceiptStatus.retried,
+                           retried_at=timezone.now() - timedelta(hours=1))
+    for _ in range(9):
+        record_request(0.1, 'errors')
+    record_request(0.1)
+
+    response = client.get(reverse('health'))
+    assert response.status_code == 503
+    health = response.json()
+    assert health['status'] == 'degraded'
+    assert health['problems'][0] == 'atol error rate 90%'
+    assert health['problems'][1].startswith('retried receipts wait for 36')
@@ -0,0 +1,146 @@
+import threading
+
+import mock
+import pytest
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
+
+from atol.core import AtolAPI
+from atol.exceptions import AtolRequestException
+from atol.hedging import HedgeBudget, Hedger, LatencyWindow, get_hedger, get_hedging_stats
+from atol.instrumentation import get_slow_calls, record_call
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+def warmed_up_hedger(max_rate=1):
+    hedger = Hedger(percentile=90, max_rate=max_rate)
+    for _ in range(100):
+        hedger.latencies.add(0.01)
+    return hedger
+
+
+def slow_then_fast(hedger, answers):
+    """Function blocking its first call until the future of the hedge has completed"""
+    hedge_done = threading.Event()
+    calls = []
+    futures = []
+    submit = hedger._submit
+
+    def submit_gated(func, args):
+        future = submit(func, args)
+        futures.append(future)
+        if len(futures) == 2:
+            future.add_done_callback(lambda future: hedge_done.set())
+        return future
+    hedger._submit = submit_gated
+
+    def call(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            hedge_done.wait(5)
+            return answers[0]
+        if isinstance(answers[1], Exception):
+            raise answers[1]
+        return answers[1]
+    call.__name__ = 'request'
+    return call, calls, hedge_done
+
+
+def test_latency_window_percentile():
+    window = LatencyWindow(size=100)
+    assert window.percentile(50, min_samples=1) is None
+    for latency in range(1, 101):
+        window.add(latency / 100.0)
+    assert window.percentile(50) == 0.5
+    assert window.percentile(99) == 0.99
+    assert window.percentile(99, min_samples=101) is None
+
+
+def test_hedge_budget_caps_rate():
+    budget = HedgeBudget(max_rate=0.1, burst=2)
+    spent = 0
+    for _ in range(100):
+        budget.earn()
+        spent += budget.spend()
+    assert spent == 10
+
+
+def test_fast_request_is_not_hedged():
+    hedger = warmed_up_hedger()
+    func = mock.Mock(return_value='answer', __name__='request')
+    assert hedger.call(func, 'get', 'report/1') == 'answer'
+    assert func.call_count == 1
+
+
+def test_slow_request_is_hedged():
+    hedger = warmed_up_hedger()
+    func, calls, _ = slow_then_fast(hedger, ['slow', 'fast'])
+
+    assert hedger.call(func, 'get', 'report/1') == 'fast'
+    assert calls == [('get', 'report/1')] * 2
+    assert get_hedging_stats() == {'requests': 1, 'hedged': 1, 'hedge_won': 1, 'budget_exhausted': 0}
+
+
+def test_transport_failure_of_hedge_is_not_an_answer():
+    hedger = warmed_up_hedger()
+    func, calls, _ = slow_then_fast(hedger, ['slow', AtolRequestException()])
+
+    assert hedger.call(func, 'get', 'report/1') == 'slow'
+    assert get_hedging_stats()['hedge_won'] == 0
+
+
+def test_hedges_are_capped():
+    hedger = warmed_up_hedger(max_rate=0.01)
+    func, calls, hedge_done = slow_then_fast(hedger, ['slow', 'fast'])
+
+    threading.Timer(0.2, hedge_done.set).start()
+    assert hedger.call(func, 'get', 'report/1') == 'slow'
+    assert get_hedging_stats()['budget_exhausted'] == 1
+
+
+@override_settings(RECEIPTS_ATOL_SLOW_CALL_THRESHOLD=0)
+def test_hedged_requests_are_phases_of_the_call():
+    hedger = warmed_up_hedger()
+    func, calls, _ = slow_then_fast(hedger, ['slow', 'fast'])
+
+    def request(*args):
+        with record_call('atol_request'):
+            return func(*args)
+    request.__name__ = 'request'
+
+    with record_call('atol_receive_receipt_report'):
+        assert hedger.call(request, 'get', 'report/1') == 'fast'
+    slow_calls = get_slow_calls()
+    assert [call['name'] for call in slow_calls] == ['atol_receive_receipt_report']
+    assert 'atol_request' in slow_calls[0]['phases']
+
+
+@override_settings(RECEIPTS_ATOL_HEDGE_REPORTS=True, RECEIPTS_ATOL_HEDGE_PERCENTILE=90)
+def test_reports_are_hedged():
+    hedger = get_hedger()
+    assert hedger is get_hedger()
+    with mock.patch.object(hedger, 'call', return_value={'status': 'done'}) as call_mock:
+        report = AtolAPI().report('uuid')
+    assert report.data == {'status': 'done'}
+    assert call_mock.call_args[0][1:] == ('get', 'report/uuid')
+
+
+@pytest.mark.django_db
+@override_settings(RECEIPTS_ATOL_HEDGE_REPORTS=True)
+def test_latency_report_shows_hedging_stats(capsys):
+    hedger = warmed_up_hedger()
+    func, calls, _ = slow_then_fast(hedger, ['slow', 'fast'])
+    hedger.call(func, 'get', 'report/1')
+
+    call_command('atol_latency_report')
+    assert capsys.readouterr().out.splitlines()[-1] == (
+        'report hedging: 1 requests, 1 hedged (100.0%), 1 won by the hedge, 0 denied by the rate cap')
+
+
+def test_hedging_is_off_by_default():
+    assert get_hedger() is None
@@ -0,0 +1,134 @@
+import json
+import os
+import time
+
+import mock
+import pytest
+import responses
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
+
+from atol.instrumentation import get_slow_calls, phase, record_call, record_size, store_call
+from atol.models import Receipt, ReceiptStatus
+from atol.tasks import atol_create_receipt, atol_receive_receipt_report
+from tests import ATOL_BASE_URL
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+@responses.activate
+@override_settings(RECEIPTS_ATOL_SLOW_CALL_THRESHOLD=0)
+def test_slow_task_is_recorded_with_phases():
+    responses.add(responses.POST, ATOL_BASE_URL + '/getToken', status=200, json={'code': 0, 'token': 'foobar'})
+    responses.add(responses.POST, ATOL_BASE_URL + '/ATOL-ProdTest-1/sell', status=200,
+                  json={'uuid': '5869a6d9-1540-4ebb-a2a2-f1d11501f213', 'status': 'wait', 'error': None})
+    receipt = Receipt.objects.create(user_email='foo@bar.com', purchase_price=707.1)
+
+    with mock.patch.object(atol_receive_receipt_report, 'apply_async'):
+        atol_create_receipt(receipt.id)
+
+    receipt.refresh_from_db()
+    assert receipt.status == ReceiptStatus.initiated
+
+    calls = get_slow_calls()
+    # the atol request is timed as a phase of the task
+    assert [call['name'] for call in calls] == ['atol_create_receipt']
+    call = calls[0]
+    assert call['details'] == {'receipt_id': receipt.id}
+    assert {'consolidate', 'params', 'atol', 'atol_request', 'token', 'encode', 'http', 'decode', 'save'} \
+        <= set(call['phases'])
+    assert call['phases']['atol'] <= call['duration']
+    assert call['sizes']['request_bytes'] > 0
+    assert call['sizes']['response_bytes'] > 0
+    assert call['profile'] is None
+
+
+def test_fast_calls_are_not_recorded():
+    with record_call('atol_request'):
+        pass
+    with override_settings(RECEIPTS_ATOL_SLOW_CALL_THRESHOLD=10):
+        with record_call('atol_request'):
+            pass
+    assert get_slow_calls() == []
+
+
+@override_settings(RECEIPTS_ATOL_SLOW_CALL_THRESHOLD=0)
+def test_phases_and_sizes_add_up():
+    with record_call('atol_request', endpoint='sell'):
+        for _ in range(2):
+            with phase('http'):
+                time.sleep(0.01)
+            record_size('response_bytes', 10)
+    # outside of a call
+    with phase('http'):
+        record_size('response_bytes', 10)
+
+    call, = get_slow_calls()
+    assert call['details'] == {'endpoint': 'sell'}
+    assert 0.02 <= call['phases']['http'] <= call['duration']
+    assert call['sizes'] == {'response_bytes': 20}
+
+
+@override_settings(RECEIPTS_ATOL_SLOW_CALL_THRESHOLD=0)
+def test_call_failing_is_recorded():
+    with pytest.raises(ValueError):
+        with record_call('atol_request'):
+            raise ValueError()
+    assert len(get_slow_calls()) == 1
+
+
+@override_settings(RECEIPTS_ATOL_SLOW_CALLS=3)
+def test_ring_buffer_keeps_latest_calls():
+    for number in range(5):
+        store_call({'name': str(number), 'started_at': '2022-08-01T00:00:0{}'.format(number)})
+    assert [call['name'] for call in get_slow_calls()] == ['2', '3', '4']
+
+
+def test_sampled_task_is_profiled():
+    with mock.patch.dict(os.environ, {'ATOL_PROFILE_TASKS': '1', 'ATOL_PROFILE_INTERVAL': '1'}):
+        with record_call('atol_create_receipt', profile=True, receipt_id=1):
+            time.sleep(0.05)
+        # only task executions are profiled
+        with record_call('atol_request'):
+            time.sleep(0.01)
+
+    call, = get_slow_calls()
+    assert call['name'] == 'atol_create_receipt'
+    assert call['profile']
+    stack, samples = call['profile'][0]
+    assert 'test_sampled_task_is_profiled' in stack
+    assert samples > 1
+
+
+def test_profiling_is_off_by_default():
+    with record_call('atol_create_receipt', profile=True):
+        time.sleep(0.01)
+    assert get_slow_calls() == []
+
+
+def test_slow_calls_command(capsys):
+    store_call({'name': 'atol_request', 'details': {'endpoint': 'sell'}, 'started_at': '2022-08-01T00:00:00',
+                'duration': 1.5, 'phases': {'http': 1.4}, 'sizes': {'request_bytes': 100}, 'profile': None})
+    store_call({'name': 'atol_create_receipt', 'details': {'receipt_id': 1}, 'started_at': '2022-08-01T00:00:01',
+                'duration': 2, 'phases': {}, 'sizes': {}, 'profile': [['tasks.py:1:f;core.py:2:g', 7]]})
+
+    call_command('atol_slow_calls')
+    out = capsys.readouterr().out.splitlines()
+    assert out == [
+        '2022-08-01T00:00:00 atol_request 1.500s endpoint=sell',
+        '  phases: http 1.400s',
+        '  sizes: request_bytes 100B',
+        '2022-08-01T00:00:01 atol_create_receipt 2.000s receipt_id=1',
+        '      7 tasks.py:1:f;core.py:2:g',
+    ]
+
+    call_command('atol_slow_calls', '--json', '--name', 'atol_request', '--clear')
+    out = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)['name'] for line in out] == ['atol_request']
+    assert get_slow_calls() == []
@@ -0,0 +1,68 @@
+from datetime import timedelta
+
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from atol.latency import get_latency_report
+from atol.models import Receipt, ReceiptStatus
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def create_receipt(created_at, group_code='group', initiated_after=None, received_after=None, attempts=1, polls=0):
+    initiated_at = received_at = None
+    if initiated_after is not None:
+        initiated_at = created_at + timedelta(seconds=initiated_after)
+    if received_after is not None:
+        received_at = initiated_at + timedelta(seconds=received_after)
+
+    receipt = Receipt.objects.create()
+    Receipt.objects.filter(id=receipt.id).update(
+        created_at=created_at,
+        initiated_at=initiated_at,
+        received_at=received_at,
+        status=ReceiptStatus.received if received_at else ReceiptStatus.created,
+        group_code=group_code,
+        attempts=attempts,
+        polls=polls,
+    )
+    return receipt
+
+
+def test_latency_report():
+    today = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0)
+    yesterday = today - timedelta(days=1)
+    for seconds in range(1, 101):
+        create_receipt(today, initiated_after=seconds, received_after=seconds * 10, polls=2)
+    create_receipt(today, attempts=3)  # not initiated yet
+    create_receipt(today, group_code='other', initiated_after=5)
+    create_receipt(yesterday, initiated_after=7, received_after=70)
+
+    report = get_latency_report(day_from=today.date())
+
+    assert [(row.day, row.group_code, row.receipts) for row in report] == [
+        (today.date(), 'group', 101),
+        (today.date(), 'other', 1),
+    ]
+    row = report[0]
+    assert list(row.initiation) == [50, 90, 99]
+    assert row.initiation[50] == pytest.approx(50.5)
+    assert row.initiation[90] == pytest.approx(90.1)
+    assert row.initiation[99] == pytest.approx(99.01)
+    assert row.reception[50] == pytest.approx(505)
+    assert float(row.attempts) == pytest.approx(103 / 101.0)
+    assert float(row.polls) == pytest.approx(200 / 101.0)
+    assert report[1].reception == {50: None, 90: None, 99: None}
+
+    assert [row.day for row in get_latency_report(day_to=yesterday.date())] == [yesterday.date()]
+
+
+def test_latency_report_command(capsys):
+    create_receipt(timezone.now(), initiated_after=2, received_after=20)
+
+    call_command('atol_latency_report')
+
+    header, row = capsys.readouterr().out.splitlines()
+    assert header.split('\t')[:4] == ['day', 'group_code', 'receipts', 'initiation_p50']
+    assert row.split('\t')[1:] == ['group', '1', '2.0', '2.0', '2.0', '20.0', '20.0', '20.0', '1.00', '0.00']
@@ -0,0 +1,26 @@
+import mock
+
+from atol.links import LRUCache
+
+
+def test_lru_cache_is_bounded():
+    lru = LRUCache(maxsize=2)
+    lru.set('a', 1, timeout=60)
+    lru.set('b', 2, timeout=60)
+    assert lru.get('a') == 1
+    lru.set('c', 3, timeout=60)
+
+    # the least recently used key is evicted
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+
+
+def test_lru_cache_entries_expire():
+    lru = LRUCache(maxsize=2)
+    with mock.patch('atol.links.time.monotonic', return_value=100):
+        lru.set('a', 1, timeout=10)
+        lru.set('b', 2, timeout=60)
+    with mock.patch('atol.links.time.monotonic', return_value=120):
+        assert lru.get('a') is None
+        assert lru.get('b') == 2
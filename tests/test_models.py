@@ -0,0 +1,123 @@
+import mock
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from atol.counters import get_status_counts
+from atol.models import Receipt, ReceiptStatus
+from atol.signals import receipt_received, receipts_failed, receipts_initiated, receipts_received
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+@pytest.fixture
+def signal_receiver():
+    def connect(signal):
+        handler = mock.Mock()
+        signal.connect(handler)
+        connected.append((signal, handler))
+        return handler
+
+    connected = []
+    yield connect
+    for signal, handler in connected:
+        signal.disconnect(handler)
+
+
+def test_bulk_declare_failed(signal_receiver):
+    handler = signal_receiver(receipts_failed)
+    receipt1 = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt2 = Receipt.objects.create(status=ReceiptStatus.created)
+    receipt3 = Receipt.objects.create(status=ReceiptStatus.received)
+
+    receipts = Receipt.objects.exclude(status=ReceiptStatus.received).bulk_declare_failed()
+
+    assert {receipt.id for receipt in receipts} == {receipt1.id, receipt2.id}
+    assert handler.call_count == 1
+    assert handler.call_args[1]['receipts'] == receipts
+
+    failed = Receipt.objects.filter(status=ReceiptStatus.failed, failed_at__isnull=False)
+    assert set(failed.values_list('id', flat=True)) == {receipt1.id, receipt2.id}
+    receipt3.refresh_from_db()
+    assert receipt3.status == ReceiptStatus.received
+
+    Receipt.objects.filter(id=receipt1.id).bulk_declare_failed(status=ReceiptStatus.no_email_phone)
+    receipt1.refresh_from_db()
+    assert receipt1.status == ReceiptStatus.no_email_phone
+
+
+def test_bulk_initiate(signal_receiver):
+    handler = signal_receiver(receipts_initiated)
+    now = timezone.now()
+    receipt1 = Receipt.objects.create(status=ReceiptStatus.created)
+    receipt2 = Receipt.objects.create(status=ReceiptStatus.retried, initiated_at=now)
+
+    Receipt.objects.bulk_initiate({receipt1.id: 'uuid-1', receipt2.id: 'uuid-2'})
+
+    assert handler.call_count == 1
+    assert {receipt.id for receipt in handler.call_args[1]['receipts']} == {receipt1.id, receipt2.id}
+
+    receipt1.refresh_from_db()
+    receipt2.refresh_from_db()
+    assert (receipt1.uuid, receipt1.status) == ('uuid-1', ReceiptStatus.initiated)
+    assert receipt1.initiated_at > now
+    assert receipt1.retried_at is None
+    assert (receipt2.uuid, receipt2.status) == ('uuid-2', ReceiptStatus.retried)
+    assert receipt2.initiated_at == now
+    assert receipt2.retried_at > now
+
+
+def test_bulk_receive(signal_receiver):
+    handler = signal_receiver(receipts_received)
+    single_handler = signal_receiver(receipt_received)
+    receipt1 = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt2 = Receipt.objects.create(status=ReceiptStatus.retried)
+
+    Receipt.objects.bulk_receive({receipt1.id: {'payload': {'total': 1}}, receipt2.id: {'payload': {'total': 2}}})
+
+    assert handler.call_count == 1
+    # per receipt receivers are not left behind
+    assert single_handler.call_count == 2
+
+    for receipt, total in [(receipt1, 1), (receipt2, 2)]:
+        receipt.refresh_from_db()
+        assert receipt.status == ReceiptStatus.received
+        assert receipt.received_at is not None
+        assert receipt.content == {'payload': {'total': total}}
+
+
+def test_bulk_transitions_do_not_move_receipts_backwards(signal_receiver):
+    handler = signal_receiver(receipts_received)
+    failed = Receipt.objects.create(status=ReceiptStatus.failed)
+    received = Receipt.objects.create(status=ReceiptStatus.received, content={'payload': {'total': 1}})
+
+    assert Receipt.objects.bulk_initiate({failed.id: 'uuid-1', received.id: 'uuid-2'}) == []
+    assert Receipt.objects.bulk_receive({failed.id: {'payload': {}}, received.id: {'payload': {}}}) == []
+    assert not handler.called
+    assert get_status_counts() == {ReceiptStatus.failed: 1, ReceiptStatus.received: 1}
+
+    received.refresh_from_db()
+    assert (received.uuid, received.content) == (None, {'payload': {'total': 1}})
+    assert Receipt.objects.get(id=failed.id).status == ReceiptStatus.failed
+
+
+def test_bulk_declare_failed_does_not_load_reports():
+    Receipt.objects.create(status=ReceiptStatus.initiated, content={'payload': {}})
+    with CaptureQueriesContext(connection) as queries:
+        Receipt.objects.bulk_declare_failed()
+    locks = [query['sql'] for query in queries if 'FOR UPDATE' in query['sql']]
+    assert locks
+    assert not any('"atol_receipt"."content"' in sql for sql in locks)
+
+
+def test_archived_receipt_cancel_params():
+    content = {'payload': {'total': 199.99, 'fiscal_document_attribute': 4146968358}}
+    receipt = Receipt.objects.create(status=ReceiptStatus.received, content=content)
+
+    [archived] = Receipt.objects.filter(id=receipt.id).bulk_archive()
+    assert archived.content is None
+
+    receipt = Receipt.objects.get(id=receipt.id)
+    params = receipt.get_cancel_receipt_params()
+    assert (params['purchase_price'], params['original_fiscal_number']) == (199.99, 4146968358)
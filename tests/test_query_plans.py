@@ -0,0 +1,92 @@
+"""
+Make sure the pipeline queries keep being served by indexes once the receipt table grows large
+"""
+from datetime import timedelta
+from uuid import uuid4
+
+import pytest
+from django.contrib import admin
+from django.db import connection
+from django.utils import timezone
+
+from atol.admin import ReceiptAdmin, estimate_count
+from atol.models import Receipt
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+SEED_SIZE = 50000
+
+
+@pytest.fixture
+def seeded_receipts():
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        # the vast majority of receipts are terminal, a tiny fraction is stuck in the pipeline
+        cursor.execute("""
+            INSERT INTO atol_receipt (internal_uuid, short_code, uuid, user_email, user_phone, created_at,
+                                      initiated_at, received_at, status)
+            SELECT md5(i::text)::uuid,
+                   left(md5(i::text), 22),
+                   md5(i::text),
+                   'user' || i || '@example.com',
+                   '+7999' || lpad(i::text, 7, '0'),
+                   %(now)s - i * interval '1 minute',
+                   %(now)s - i * interval '1 minute',
+                   CASE WHEN i %% 1000 = 0 THEN NULL ELSE %(now)s END,
+                   CASE WHEN i %% 1000 = 0 THEN 'initiated'
+                        WHEN i %% 1000 = 1 THEN 'created'
+                        WHEN i %% 1000 = 2 THEN 'retried'
+                        ELSE 'received' END
+            FROM generate_series(1, %(size)s) AS i
+        """, {'now': now, 'size': SEED_SIZE})
+        cursor.execute('ANALYZE atol_receipt')
+    return now
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def test_created_receipts_sweeper_plan(seeded_receipts):
+    now = seeded_receipts
+    plan = explain(Receipt.objects.created_between(now - timedelta(days=2), now - timedelta(days=1)).only('pk'))
+    assert 'Seq Scan' not in plan
+    assert 'atol_receipt_created_partial_idx' in plan
+
+
+def test_initiated_receipts_sweeper_plan(seeded_receipts):
+    now = seeded_receipts
+    plan = explain(Receipt.objects.initiated_between(now - timedelta(days=2), now - timedelta(days=1)).only('pk'))
+    assert 'Seq Scan' not in plan
+    assert 'atol_receipt_initiated_partial_idx' in plan
+
+
+def test_retried_receipts_plan(seeded_receipts):
+    now = seeded_receipts
+    plan = explain(Receipt.objects.filter(status='retried', retried_at__lt=now))
+    assert 'Seq Scan' not in plan
+
+
+@pytest.mark.parametrize('lookup', [
+    lambda: {'id': 42},
+    lambda: {'internal_uuid': uuid4()},
+    lambda: {'short_code__in': ['HDSgoRwD7D4qmgAoyk4QQw', 'wQQ4kyoAgmq4D7DwRogSDH']},
+])
+def test_receipt_lookup_plan(seeded_receipts, lookup):
+    plan = explain(Receipt.objects.filter(**lookup()))
+    assert 'Seq Scan' not in plan
+
+
+@pytest.mark.parametrize('term', ['user42@', 'USER42@EXAMPLE.COM', '+79990000042', str(uuid4())])
+def test_admin_search_plan(seeded_receipts, term):
+    queryset, _ = ReceiptAdmin(Receipt, admin.site).get_search_results(None, Receipt.objects.all(), term)
+    plan = explain(queryset.order_by('-id')[:100])
+    assert 'Seq Scan' not in plan
+
+
+def test_estimated_count(seeded_receipts):
+    assert abs(estimate_count(Receipt.objects.all()) - SEED_SIZE) < SEED_SIZE * 0.1
+    assert estimate_count(Receipt.objects.filter(status='initiated')) < SEED_SIZE * 0.1
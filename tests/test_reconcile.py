@@ -0,0 +1,138 @@
+import threading
+import time
+from datetime import timedelta
+
+import mock
+import pytest
+import shortuuid
+from django.core.cache import cache
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+
+from atol.core import AtolAPI, ReceiptReport
+from atol.exceptions import AtolReceiptNotProcessed, AtolRecoverableError, AtolUnrecoverableError
+from atol.links import get_ofd_url, link_cache
+from atol.models import Checkpoint, FailureReason, Receipt, ReceiptStatus
+from atol.reconcile import apply_reports
+from atol.tasks import atol_create_receipts
+from atol.throttling import RateLimiter
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+REPORT = {'status': 'done', 'payload': {'fn_number': '8710000100942521', 'fiscal_document_number': 40,
+                                        'fiscal_document_attribute': 4146968358, 'fiscal_receipt_number': 1,
+                                        'receipt_datetime': '26.07.2017 10:32:00', 'total': 12}}
+
+
+def test_rate_limiter_spaces_calls_across_threads():
+    limiter = RateLimiter(rate=100)
+    calls = []
+
+    def call():
+        for _ in range(5):
+            limiter.wait()
+            calls.append(time.monotonic())
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    calls.sort()
+    assert calls[-1] - calls[0] >= 19 * 0.01 * 0.9
+
+
+def fake_report(outcomes):
+    def report(self, uuid):
+        outcome = outcomes[uuid]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return ReceiptReport(uuid=uuid, data=outcome)
+    return report
+
+
+def test_reconcile():
+    today = timezone.now().date()
+    outcomes = {
+        'received': REPORT,
+        'not-ready': AtolRecoverableError(),
+        'not-processed': AtolReceiptNotProcessed(),
+        'broken': AtolUnrecoverableError(error_code=34),
+        'stale': REPORT,
+    }
+    receipts = {uuid: Receipt.objects.create(status=ReceiptStatus.initiated, uuid=uuid) for uuid in outcomes}
+    Receipt.objects.filter(uuid='stale').update(status=ReceiptStatus.received, content={'status': 'wait'})
+    old = Receipt.objects.create(status=ReceiptStatus.initiated, uuid='old')
+    Receipt.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=3))
+
+    with mock.patch.object(AtolAPI, 'report', autospec=True, side_effect=fake_report(outcomes)) as report_mock:
+        with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+            call_command('atol_reconcile', '--from', str(today), '--to', str(today), '--chunk-size', '2',
+                         '--include-received', '--rate', '0')
+
+    assert sorted(call[0][1] for call in report_mock.call_args_list) == sorted(outcomes)
+    statuses = {receipt.uuid: receipt.status for receipt in Receipt.objects.all()}
+    assert statuses == {
+        'received': ReceiptStatus.received,
+        'not-ready': ReceiptStatus.initiated,
+        'not-processed': ReceiptStatus.retried,
+        'broken': ReceiptStatus.failed,
+        'stale': ReceiptStatus.received,
+        'old': ReceiptStatus.initiated,
+    }
+    stale = Receipt.objects.get(uuid='stale')
+    assert (stale.content, stale.fn_number) == (REPORT, '8710000100942521')
+    retried = Receipt.objects.get(uuid='not-processed')
+    assert retried.internal_uuid != receipts['not-processed'].internal_uuid
+    assert task_mock.call_args[1]['args'] == ([retried.id],)
+    assert Receipt.objects.get(uuid='received').polls == 1
+    broken = Receipt.objects.get(uuid='broken')
+    assert (broken.failure_reason, broken.error_code) == (FailureReason.report_rejected, 34)
+    assert not Checkpoint.objects.exists()
+
+
+def test_refreshed_receipts_links_are_updated(client):
+    cache.clear()
+    link_cache.local.clear()
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated, uuid='stale')
+    receipt.receive(content=dict(REPORT, payload=dict(REPORT['payload'], fn_number='9999078900004312')))
+    code = shortuuid.encode(receipt.internal_uuid)
+    status_url = reverse('receipt_status', kwargs={'short_uuid': receipt.short_code})
+    assert '9999078900004312' in link_cache.get(code)
+    etag = client.get(status_url)['ETag']
+
+    assert apply_reports([(receipt, ReceiptReport(uuid='stale', data=REPORT))])['refreshed'] == 1
+
+    receipt = Receipt.objects.get(id=receipt.id)
+    assert receipt.fn_number == '8710000100942521'
+    assert link_cache.get(code) == get_ofd_url(receipt)
+    response = client.get(status_url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert '8710000100942521' in response.json()['ofd_link']
+
+
+def test_reconcile_resumes_from_checkpoint():
+    today = timezone.now().date()
+    first = Receipt.objects.create(status=ReceiptStatus.initiated, uuid='first')
+    second = Receipt.objects.create(status=ReceiptStatus.initiated, uuid='second')
+    outcomes = {'first': REPORT, 'second': REPORT}
+
+    with mock.patch.object(AtolAPI, 'report', autospec=True, side_effect=fake_report(outcomes)):
+        with mock.patch('atol.management.commands.atol_reconcile.apply_reports',
+                        side_effect=[{'received': 1}, KeyboardInterrupt]):
+            with pytest.raises(KeyboardInterrupt):
+                call_command('atol_reconcile', '--from', str(today), '--to', str(today), '--chunk-size', '1')
+
+    checkpoint = Checkpoint.objects.get()
+    assert checkpoint.position == first.id
+    assert checkpoint.stats == {'received': 1, 'polled': 1}
+
+    with mock.patch.object(AtolAPI, 'report', autospec=True, side_effect=fake_report(outcomes)) as report_mock:
+        call_command('atol_reconcile', '--from', str(today), '--to', str(today))
+
+    assert [call[0][1] for call in report_mock.call_args_list] == ['second']
+    second.refresh_from_db()
+    assert second.status == ReceiptStatus.received
+    assert not Checkpoint.objects.exists()
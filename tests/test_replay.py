@@ -0,0 +1,100 @@
+from datetime import timedelta
+
+import mock
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from atol.models import FailureReason, Receipt, ReceiptStatus
+from atol.replay import get_failed_receipts, get_failure_summary
+from atol.tasks import atol_create_receipts
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def create_failed(reason, error_code=None, uuid=None, status=ReceiptStatus.failed, **kwargs):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated if uuid else ReceiptStatus.created, uuid=uuid,
+                                     user_email='foo@bar.com', purchase_price=100, **kwargs)
+    receipt.declare_failed(status=status, reason=reason, error_code=error_code)
+    return receipt
+
+
+def test_failure_summary():
+    create_failed(FailureReason.rejected, error_code=32)
+    create_failed(FailureReason.rejected, error_code=32)
+    create_failed(FailureReason.report_rejected, error_code=34, uuid='foo')
+    create_failed(FailureReason.no_email_phone, status=ReceiptStatus.no_email_phone)
+    Receipt.objects.create(status=ReceiptStatus.received)
+
+    rows = get_failure_summary(get_failed_receipts())
+    assert [(row.status, row.failure_reason, row.error_code, row.receipts) for row in rows][0] == \
+        (ReceiptStatus.failed, FailureReason.rejected, 32, 2)
+    assert sorted((row.failure_reason, row.receipts) for row in rows) == [
+        (FailureReason.no_email_phone, 1), (FailureReason.rejected, 2), (FailureReason.report_rejected, 1)]
+
+    rows = get_failure_summary(get_failed_receipts(error_codes=[34]))
+    assert [(row.failure_reason, row.receipts) for row in rows] == [(FailureReason.report_rejected, 1)]
+
+
+def test_failed_receipts_by_day():
+    today = timezone.now().date()
+    recent = create_failed(FailureReason.rejected)
+    old = create_failed(FailureReason.rejected)
+    Receipt.objects.filter(id=old.id).update(failed_at=timezone.now() - timedelta(days=3))
+
+    assert list(get_failed_receipts(day_from=today).values_list('id', flat=True)) == [recent.id]
+    assert list(get_failed_receipts(day_to=today - timedelta(days=1)).values_list('id', flat=True)) == [old.id]
+
+
+def test_bulk_replay():
+    rejected = create_failed(FailureReason.rejected, error_code=32)
+    report_rejected = create_failed(FailureReason.report_rejected, error_code=34, uuid='foo')
+    received = Receipt.objects.create(status=ReceiptStatus.received)
+    internal_uuids = {receipt.id: receipt.internal_uuid for receipt in Receipt.objects.all()}
+
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        replayed = Receipt.objects.all().bulk_replay()
+
+    assert sorted(receipt.id for receipt in replayed) == [rejected.id, report_rejected.id]
+    assert task_mock.call_args[1]['args'] == ([rejected.id, report_rejected.id],)
+
+    rejected.refresh_from_db()
+    assert rejected.status == ReceiptStatus.created
+    assert rejected.internal_uuid == internal_uuids[rejected.id]
+    assert (rejected.failed_at, rejected.failure_reason, rejected.error_code) == (None, None, None)
+
+    # atol keeps the outcome of the old external_id
+    report_rejected.refresh_from_db()
+    assert report_rejected.status == ReceiptStatus.retried
+    assert report_rejected.internal_uuid != internal_uuids[report_rejected.id]
+
+    received.refresh_from_db()
+    assert received.status == ReceiptStatus.received
+
+
+def test_replay_command():
+    rejected = [create_failed(FailureReason.rejected, error_code=32) for _ in range(3)]
+    other = create_failed(FailureReason.attempts_exhausted)
+
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        with mock.patch('atol.throttling.time.sleep') as sleep_mock:
+            call_command('atol_replay_failed', '--reason', FailureReason.rejected, '--replay',
+                         '--chunk-size', '2', '--rate', '10')
+
+    # each receipt is sent on its own: the first one right away, the others spaced out
+    assert [call[1]['args'] for call in task_mock.call_args_list] == [([receipt.id],) for receipt in rejected]
+    assert sleep_mock.call_count == 2
+    assert Receipt.objects.filter(status=ReceiptStatus.created).count() == 3
+    other.refresh_from_db()
+    assert other.status == ReceiptStatus.failed
+
+
+def test_replay_command_lists_failures(capsys):
+    create_failed(FailureReason.rejected, error_code=32)
+
+    with mock.patch.object(atol_create_receipts, 'apply_async') as task_mock:
+        call_command('atol_replay_failed')
+        assert not task_mock.called
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[1].split('\t')[:4] == [ReceiptStatus.failed, FailureReason.rejected, '32', '1']
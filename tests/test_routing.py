@@ -0,0 +1,144 @@
+import django
+import mock
+import pytest
+from django.core.cache import cache
+from django.db import connections
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from atol import links, routing
+from atol.models import Receipt, ReceiptStatus
+from atol.routing import get_read_database, get_replica_lag
+from atol.tasks import atol_retry_created_receipts
+
+pytestmark = [
+    pytest.mark.django_db(transaction=True, databases=['default', 'replica']),
+    pytest.mark.usefixtures('clear_replica_lags'),
+]
+
+
+@pytest.fixture
+def clear_replica_lags():
+    routing._lags.clear()
+    yield
+    routing._lags.clear()
+
+
+def clear_link_cache():
+    links.link_cache.local.clear()
+    cache.clear()
+
+
+@pytest.fixture
+def receipt_data():
+    return {
+        'payload': {
+            'fiscal_document_attribute': 4146968358,
+            'fiscal_document_number': 40,
+            'fiscal_receipt_number': 1,
+            'fn_number': '8710000100942521',
+            'receipt_datetime': '26.07.2017 10:32:00',
+            'total': 12,
+        },
+    }
+
+
+def test_reads_go_to_primary_by_default():
+    assert get_read_database(Receipt) == 'default'
+    with override_settings(RECEIPTS_ATOL_READ_DATABASE='replica'):
+        # a primary is never behind
+        assert get_replica_lag('replica') == 0
+        assert get_read_database(Receipt) == 'replica'
+
+
+@override_settings(RECEIPTS_ATOL_READ_DATABASE='replica', RECEIPTS_ATOL_REPLICA_MAX_LAG=10)
+def test_lagging_replica_falls_back_to_primary():
+    routing._lags['replica'] = (60.0, float('inf'))
+    assert get_read_database(Receipt) == 'default'
+
+    with override_settings(RECEIPTS_ATOL_REPLICA_MAX_LAG=None):
+        assert get_read_database(Receipt) == 'replica'
+
+    routing._lags.clear()
+    with mock.patch.object(connections['replica'], 'cursor', side_effect=routing.DatabaseError('down')):
+        assert get_replica_lag('replica') == float('inf')
+        assert get_read_database(Receipt) == 'default'
+
+
+@override_settings(RECEIPTS_ATOL_READ_DATABASE='replica')
+def test_replica_of_unknown_lag_is_stale():
+    with mock.patch.object(connections['replica'], 'cursor') as cursor_mock:
+        # paused replay or nothing replayed yet
+        cursor_mock.return_value.__enter__.return_value.fetchone.return_value = (None,)
+        assert get_replica_lag('replica') == float('inf')
+    assert get_read_database(Receipt) == 'default'
+
+
+@override_settings(RECEIPTS_ATOL_READ_DATABASE='replica')
+def test_receipt_view_reads_replica(client, receipt_data):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt.receive(content=receipt_data)
+    clear_link_cache()
+
+    with CaptureQueriesContext(connections['replica']) as replica:
+        with CaptureQueriesContext(connections['default']) as primary:
+            assert client.get(receipt.ofd_link).status_code == 302
+    assert len(primary.captured_queries) == 0
+    assert any('"atol_receipt"' in query['sql'] for query in replica.captured_queries)
+
+
+@override_settings(RECEIPTS_ATOL_READ_DATABASE='replica')
+def test_receipt_view_falls_back_to_primary_for_stale_receipts(client, receipt_data):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt.receive(content=receipt_data)
+    clear_link_cache()
+
+    link_receipts = links.get_link_receipts
+
+    def get_link_receipts(short_uuid, using=None, fields=None):
+        # the replica has not caught up with the receipt yet
+        return [] if using == 'replica' else link_receipts(short_uuid, using, fields)
+
+    with mock.patch('atol.links.get_link_receipts', side_effect=get_link_receipts):
+        with CaptureQueriesContext(connections['default']) as primary:
+            assert client.get(receipt.ofd_link).status_code == 302
+    assert len(primary.captured_queries) == 1
+
+
+@override_settings(RECEIPTS_ATOL_READ_DATABASE='replica')
+def test_transitions_write_to_primary(receipt_data):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    replica_receipt = Receipt.objects.using('replica').get(id=receipt.id)
+
+    with CaptureQueriesContext(connections['replica']) as replica:
+        replica_receipt.receive(content=receipt_data)
+    assert len(replica.captured_queries) == 0
+    assert replica_receipt._state.db == 'default'
+    receipt.refresh_from_db()
+    assert receipt.status == ReceiptStatus.received
+
+
+@override_settings(RECEIPTS_ATOL_READ_DATABASE='replica')
+def test_sweeper_scans_replica():
+    receipt = Receipt.objects.create(status=ReceiptStatus.created)
+    Receipt.objects.filter(id=receipt.id).update(created_at=timezone.now() - timezone.timedelta(hours=36))
+
+    with mock.patch('atol.tasks.atol_create_receipt.delay') as task_mock:
+        with CaptureQueriesContext(connections['default']) as primary:
+            atol_retry_created_receipts()
+    assert not any('"atol_receipt"' in query['sql'] for query in primary.captured_queries)
+    task_mock.assert_called_once_with(receipt.id)
+
+
+@pytest.mark.skipif(django.VERSION < (4, 1), reason='async ORM requires Django >= 4.1')
+@override_settings(RECEIPTS_ATOL_READ_DATABASE='replica')
+def test_async_link_receipt_reads_replica(receipt_data):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt.receive(content=receipt_data)
+
+    from asgiref.sync import async_to_sync
+    from atol.async_views import aget_link_receipt
+
+    found = async_to_sync(aget_link_receipt)(receipt.short_code)
+    assert (found.id, found._state.db) == (receipt.id, 'replica')
@@ -0,0 +1,150 @@
+import threading
+import time
+from concurrent.futures import wait
+
+import mock
+import pytest
+from django.db import transaction
+from django.test import override_settings
+
+from atol import signals
+from atol.models import Receipt, ReceiptStatus
+from atol.signals import _get_executor, call_receivers, receipt_failed, receipts_received
+from atol.tasks import atol_send_receipt_signal
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+@pytest.fixture
+def connect():
+    connected = []
+
+    def connect(signal, handler):
+        signal.connect(handler, weak=False)
+        connected.append((signal, handler))
+        return handler
+
+    yield connect
+    for signal, handler in connected:
+        signal.disconnect(handler)
+
+
+def wait_for_dispatcher():
+    _get_executor('dispatcher', 1).submit(lambda: None).result(timeout=5)
+
+
+def test_sync_signals_are_sent_right_away(connect):
+    handler = connect(receipt_failed, mock.Mock())
+    receipt = Receipt.objects.create()
+
+    with transaction.atomic():
+        receipt.declare_failed()
+        assert handler.call_count == 1
+    assert handler.call_args[1]['receipt'] is receipt
+
+
+@override_settings(RECEIPTS_ATOL_SIGNALS_DISPATCH='thread', RECEIPTS_ATOL_SIGNALS_TIMEOUT=0.1,
+                   RECEIPTS_ATOL_SIGNALS_WORKERS=2)
+def test_thread_signals_are_deferred_until_commit(connect):
+    stuck = Receipt.objects.create()
+    receipt = Receipt.objects.create()
+    called = threading.Event()
+    release = threading.Event()
+
+    def slow_handler(receipt, **kwargs):
+        if receipt == stuck:
+            release.wait(5)
+
+    def failing_handler(**kwargs):
+        raise ValueError('boom')
+
+    def handler(receipt, **kwargs):
+        assert Receipt.objects.get(id=receipt.id).status == ReceiptStatus.failed
+        if receipt != stuck:
+            called.set()
+
+    connect(receipt_failed, slow_handler)
+    connect(receipt_failed, failing_handler)
+    connect(receipt_failed, handler)
+
+    with mock.patch('atol.signals.logger') as logger_mock:
+        try:
+            stuck.declare_failed()
+            with transaction.atomic():
+                receipt.declare_failed()
+                time.sleep(0.05)
+                assert not called.is_set()
+
+            # a hung receiver does not hold up the signals sent after it
+            assert called.wait(5)
+            wait_for_dispatcher()
+        finally:
+            release.set()
+    wait(list(signals._hanging), timeout=5)
+
+    errors = [call[0][0] for call in logger_mock.error.call_args_list]
+    assert errors == ['receivers of %s did not finish in %s seconds, %s calls are left running and %s are dropped',
+                      'receiver %s of %s failed due to %s']
+
+
+@override_settings(RECEIPTS_ATOL_SIGNALS_TIMEOUT=0.1, RECEIPTS_ATOL_SIGNALS_WORKERS=2)
+def test_hung_receivers_are_bounded(connect):
+    release = threading.Event()
+    calls = []
+
+    def slow_handler(receipt, **kwargs):
+        calls.append(receipt)
+        release.wait(5)
+
+    connect(receipt_failed, slow_handler)
+    receipts = [Receipt(id=index) for index in range(6)]
+    with mock.patch('atol.signals.logger') as logger_mock:
+        try:
+            started = time.monotonic()
+            call_receivers(receipt_failed, receipts)
+            # a single deadline for all the receipts
+            assert time.monotonic() - started < 1
+            assert len(calls) == 2
+            assert logger_mock.error.call_args[0][3:] == (2, 4)
+
+            # every thread is taken by the hung receivers
+            call_receivers(receipt_failed, receipts[:1])
+            assert len(calls) == 2
+            assert 'all %s threads are taken' in logger_mock.error.call_args[0][0]
+        finally:
+            release.set()
+
+    # the threads are given back once the receivers finish
+    wait(list(signals._hanging), timeout=5)
+    call_receivers(receipt_failed, receipts[:1])
+    assert len(calls) == 3
+
+
+@override_settings(RECEIPTS_ATOL_SIGNALS_DISPATCH='thread')
+def test_thread_signals_of_rolled_back_transaction_are_not_sent(connect):
+    handler = connect(receipt_failed, mock.Mock())
+    receipt = Receipt.objects.create()
+
+    with pytest.raises(ZeroDivisionError):
+        with transaction.atomic():
+            receipt.declare_failed()
+            1 / 0
+
+    wait_for_dispatcher()
+    assert handler.call_count == 0
+
+
+@override_settings(RECEIPTS_ATOL_SIGNALS_DISPATCH='celery')
+def test_celery_signals(connect):
+    handler = connect(receipts_received, mock.Mock())
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+
+    with mock.patch.object(atol_send_receipt_signal, 'delay', wraps=atol_send_receipt_signal.delay) as task_mock:
+        with transaction.atomic():
+            Receipt.objects.bulk_receive({receipt.id: {'payload': {}}})
+            assert len(task_mock.mock_calls) == 0
+
+    # signals without receivers are not dispatched
+    assert task_mock.call_args_list == [mock.call('receipts_received', [receipt.id])]
+    assert [r.id for r in handler.call_args[1]['receipts']] == [receipt.id]
+    assert handler.call_args[1]['receipts'][0].status == ReceiptStatus.received
@@ -0,0 +1,147 @@
+import mock
+import pytest
+from django.core.cache import cache
+from django.db import transaction
+from django.test import override_settings
+from django.urls import reverse
+from django.utils.http import http_date
+
+from atol.models import FailureReason, Receipt, ReceiptStatus
+from atol.core import AtolAPI
+from atol.exceptions import AtolReceiptNotProcessed
+from atol.tasks import atol_create_receipt, atol_create_receipts, atol_receive_receipt_report
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+@pytest.fixture
+def receipt_data():
+    return {
+        'uuid': 'd407f2bf-edb8-43c9-aac4-468c05f1a8d8',
+        'status': 'done',
+        'error': None,
+        'payload': {
+            'fiscal_document_attribute': 4146968358,
+            'fiscal_document_number': 40,
+            'fiscal_receipt_number': 1,
+            'fn_number': '8710000100942521',
+            'receipt_datetime': '26.07.2017 10:32:00',
+            'total': 12
+        },
+    }
+
+
+def status_url(receipt):
+    return reverse('receipt_status', kwargs={'short_uuid': receipt.short_code})
+
+
+def test_receipt_status_is_revalidated_from_cache(client, django_assert_num_queries):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+
+    with django_assert_num_queries(1):
+        response = client.get(status_url(receipt))
+    assert response.status_code == 200
+    assert response.json() == {'status': 'initiated', 'ofd_link': None}
+    assert response['Cache-Control'] in ('private, no-cache', 'no-cache, private')
+    etag, last_modified = response['ETag'], response['Last-Modified']
+    assert last_modified == http_date(receipt.created_at.timestamp())
+
+    with django_assert_num_queries(0):
+        assert client.get(status_url(receipt), HTTP_IF_NONE_MATCH=etag).status_code == 304
+        response = client.get(status_url(receipt), HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert response.status_code == 304
+        assert response['ETag'] == etag
+        assert client.get(status_url(receipt), HTTP_IF_NONE_MATCH='"other"').status_code == 200
+
+
+def test_receipt_status_is_invalidated_by_transitions(client, receipt_data):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    etag = client.get(status_url(receipt))['ETag']
+
+    with transaction.atomic():
+        receipt.receive(content=receipt_data)
+        # the previous status is served until the transition has committed
+        assert client.get(status_url(receipt), HTTP_IF_NONE_MATCH=etag).status_code == 304
+
+    response = client.get(status_url(receipt), HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()['status'] == 'received'
+    assert response.json()['ofd_link'] == ('https://lk.platformaofd.ru/web/noauth/cheque'
+                                           '?fn=8710000100942521&fp=4146968358')
+    assert response['ETag'] != etag
+
+
+def test_failed_receipt_status(client):
+    receipt = Receipt.objects.create()
+    assert client.get(status_url(receipt)).json() == {'status': 'created', 'ofd_link': None}
+
+    receipt.declare_failed(reason=FailureReason.rejected)
+    assert client.get(status_url(receipt)).json() == {'status': 'failed', 'ofd_link': None}
+
+
+def test_missing_receipt_status_is_cached(client, django_assert_num_queries):
+    url = reverse('receipt_status', kwargs={'short_uuid': 'wQQ4kyoAgmq4D7DwRogSDH'})
+    with django_assert_num_queries(1):
+        assert client.get(url).status_code == 404
+    with django_assert_num_queries(0):
+        response = client.get(url)
+    assert response.status_code == 404
+    assert response.json() == {'status': None, 'ofd_link': None}
+
+
+def test_status_read_before_transition_is_not_served_after_it(client, receipt_data):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    stale = Receipt.objects.get(id=receipt.id)
+
+    def get_link_receipt(short_uuid, fields=None):
+        # the transition commits while the poll is between reading the receipt and caching its status
+        receipt.receive(content=receipt_data)
+        return stale
+
+    with mock.patch('atol.status.get_link_receipt', side_effect=get_link_receipt):
+        assert client.get(status_url(receipt)).json()['status'] == 'initiated'
+    assert client.get(status_url(receipt)).json()['status'] == 'received'
+
+
+def test_status_is_invalidated_by_replay(client):
+    receipt = Receipt.objects.create(status=ReceiptStatus.failed, failure_reason=FailureReason.rejected)
+    assert client.get(status_url(receipt)).json()['status'] == 'failed'
+
+    with mock.patch.object(atol_create_receipts, 'apply_async'):
+        Receipt.objects.filter(id=receipt.id).bulk_replay()
+    assert client.get(status_url(receipt)).json()['status'] == 'created'
+
+
+@override_settings(RECEIPTS_ATOL_SIGNALS_DISPATCH='thread')
+def test_caches_do_not_dispatch_signals(receipt_data):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    with mock.patch('atol.signals._dispatch') as dispatch_mock:
+        receipt.initiate(uuid='uuid')
+        receipt.receive(content=receipt_data)
+        receipt.declare_failed()
+    assert not dispatch_mock.called
+
+
+def test_receipt_status_is_invalidated_by_retries(client):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated, uuid='uuid')
+    old_url = status_url(receipt)
+    assert client.get(old_url).json()['status'] == 'initiated'
+
+    with mock.patch.object(AtolAPI, 'report', side_effect=AtolReceiptNotProcessed()), \
+            mock.patch.object(atol_create_receipt, 'apply_async'):
+        atol_receive_receipt_report(receipt.id)
+
+    # the previous link is not served the previous status anymore
+    assert client.get(old_url).json()['status'] is None
+    receipt.refresh_from_db()
+    assert status_url(receipt) != old_url
+    assert client.get(status_url(receipt)).json()['status'] == 'retried'
+
+    with mock.patch.object(atol_create_receipts, 'apply_async'):
+        Receipt.objects.filter(id=receipt.id).bulk_retry()
+    assert client.get(status_url(receipt)).json()['status'] is None
@@ -8,8 +8,9 @@ import pytest
 from django.utils import timezone
 
 from atol.core import AtolAPI, NewReceipt
-from atol.models import Receipt, ReceiptStatus
-from atol.tasks import (atol_create_receipt, atol_receive_receipt_report,
+from atol.exceptions import AtolRecoverableError
+from atol.models import FailureReason, Receipt, ReceiptStatus
+from atol.tasks import (atol_create_receipt, atol_create_receipts, atol_receive_receipt_report,
                         atol_retry_created_receipts, atol_retry_initiated_receipts, atol_cancel_receipt)
 from tests import ATOL_BASE_URL
 
@@ -34,6 +35,32 @@ def test_created_receipt_ok():
     assert receipt.uuid == '5869a6d9-1540-4ebb-a2a2-f1d11501f213'
     assert receipt.status == ReceiptStatus.initiated
     assert receipt.initiated_at > now
+    assert (receipt.attempts, receipt.polls, receipt.group_code) == (1, 0, 'ATOL-ProdTest-1')
+
+
+def test_created_receipts_chunk():
+    receipt1 = Receipt.objects.create(user_email='foo@bar.com', purchase_price=100)
+    receipt2 = Receipt.objects.create(user_email='foo@bar.com', purchase_price=200)
+    receipt3 = Receipt.objects.create(purchase_price=300)
+
+    sell_results = [NewReceipt(uuid='5869a6d9-1540-4ebb-a2a2-f1d11501f213', data=None), AtolRecoverableError()]
+    with mock.patch.object(AtolAPI, 'sell', side_effect=sell_results) as sell_mock:
+        with mock.patch.object(atol_receive_receipt_report, 'apply_async') as report_task_mock:
+            with mock.patch.object(atol_create_receipt, 'apply_async') as create_task_mock:
+                atol_create_receipts([receipt1.id, receipt2.id, receipt3.id, 0])
+        assert len(sell_mock.mock_calls) == 2
+
+    assert report_task_mock.call_args[1]['args'] == (receipt1.id,)
+    # recoverable failures are retried one by one
+    assert create_task_mock.call_args[1] == {'args': (receipt2.id,), 'countdown': 60}
+
+    receipt1.refresh_from_db()
+    receipt2.refresh_from_db()
+    receipt3.refresh_from_db()
+    assert receipt1.status == ReceiptStatus.initiated
+    assert receipt2.status == ReceiptStatus.created
+    assert receipt3.status == ReceiptStatus.no_email_phone
+    assert [receipt.attempts for receipt in (receipt1, receipt2, receipt3)] == [1, 1, 0]
 
 
 @responses.activate
@@ -51,6 +78,8 @@ def test_atol_create_failing_receipt_progressive_countdown():
 
     receipt.refresh_from_db()
     assert receipt.status == 'failed'
+    assert receipt.failure_reason == FailureReason.attempts_exhausted
+    assert receipt.attempts == 5
 
 
 @responses.activate
@@ -64,6 +93,22 @@ def test_atol_create_receipt_stopped_on_unrecoverable_error():
     atol_create_receipt(receipt.id)
     receipt.refresh_from_db()
     assert receipt.status == 'failed'
+    assert receipt.failure_reason == FailureReason.rejected
+    assert receipt.error_code == 3
+
+
+def test_atol_create_receipt_invalid_data_is_not_retried():
+    receipt = Receipt.objects.create(user_phone='not a phone', purchase_price=999)
+
+    with mock.patch.object(AtolAPI, 'request') as request_mock:
+        with mock.patch.object(atol_create_receipt, 'retry') as retry_mock:
+            atol_create_receipt(receipt.id)
+            assert len(retry_mock.mock_calls) == 0
+        assert len(request_mock.mock_calls) == 0
+
+    receipt.refresh_from_db()
+    assert receipt.status == ReceiptStatus.failed
+    assert receipt.failure_reason == FailureReason.invalid
 
 
 @pytest.mark.parametrize(['receipt_data', 'status'], [
@@ -99,6 +144,8 @@ def test_atol_failing_receive_report_progressive_countdown():
 
     receipt.refresh_from_db()
     assert receipt.status == 'failed'
+    assert receipt.polls == 9
+    assert receipt.failure_reason == FailureReason.report_attempts_exhausted
 
 
 @responses.activate
@@ -114,6 +161,8 @@ def test_atol_fetch_receipt_report_stopped_on_unrecoverable_error():
     atol_receive_receipt_report(receipt.id)
     receipt.refresh_from_db()
     assert receipt.status == 'failed'
+    assert receipt.failure_reason == FailureReason.report_rejected
+    assert receipt.error_code == 3
 
 
 @responses.activate
@@ -1,7 +1,35 @@
 from datetime import datetime
-from atol.utils import parse_receipt_datetime
+from decimal import Decimal
+
+from django.test import override_settings
+from django.utils import timezone
+
+from atol.utils import format_receipt_total, get_fiscal_data, parse_receipt_datetime
 
 
 def test_parse_receipt_datetime():
     assert parse_receipt_datetime('13.12.2017 18:55:19') == datetime(2017, 12, 13, 18, 55, 19)
     assert parse_receipt_datetime('2017.12.13') == datetime(2017, 12, 13, 0, 0)
+
+
+def test_format_receipt_total():
+    assert format_receipt_total(12) == '12'
+    assert format_receipt_total(Decimal('12.00')) == '12'
+    assert format_receipt_total(Decimal('100.00')) == '100'
+    assert format_receipt_total(199.99) == '199.99'
+    assert format_receipt_total(Decimal('12.50')) == '12.5'
+
+
+def test_get_fiscal_data():
+    assert get_fiscal_data(None) is None
+    assert get_fiscal_data({'payload': None}) is None
+
+    content = {'payload': {'fn_number': '8710000100942521', 'fiscal_document_number': 40,
+                           'fiscal_document_attribute': 4146968358, 'fiscal_receipt_number': 1,
+                           'receipt_datetime': '26.07.2017 10:32:00', 'total': 12}}
+    assert get_fiscal_data(content)['receipt_datetime'] == datetime(2017, 7, 26, 10, 32)
+
+    with override_settings(USE_TZ=True, TIME_ZONE='Europe/Moscow'):
+        receipt_dt = get_fiscal_data(content)['receipt_datetime']
+        assert receipt_dt.tzinfo is not None
+        assert timezone.localtime(receipt_dt).replace(tzinfo=None) == datetime(2017, 7, 26, 10, 32)
@@ -0,0 +1,80 @@
+from datetime import datetime
+from uuid import uuid4
+
+import mock
+import pytest
+import responses
+
+from atol.core import AtolAPI
+from atol.exceptions import AtolPrepRequestException, AtolValidationError
+from atol.validation import validate_registration_data
+
+
+@pytest.fixture
+def sell_params():
+    return dict(timestamp=datetime(2017, 11, 22, 10, 47, 32), transaction_uuid=str(uuid4()),
+                purchase_name=u'Стандартная подписка на 1 месяц', purchase_price='199.99',
+                user_email='user@example.com')
+
+
+def test_valid_registration_data(sell_params):
+    validate_registration_data(AtolAPI().get_registration_data(sell_params))
+
+    sell_params.update(user_email=None, user_phone='+79991234567', purchase_price=500)
+    validate_registration_data(AtolAPI().get_registration_data(sell_params))
+
+    # nameless purchases are named by default
+    sell_params.update(purchase_name=None)
+    request_data = AtolAPI().get_registration_data(sell_params)
+    validate_registration_data(request_data)
+    assert request_data['receipt']['items'][0]['name'] == u'Оплата подписки'
+
+
+@pytest.mark.parametrize('params,path', [
+    ({'user_email': None, 'user_phone': '+7 (999) 123-45-67'}, 'receipt.client.phone'),
+    ({'user_email': None, 'user_phone': '12345'}, 'receipt.client.phone'),
+    ({'user_email': 'not-an-email'}, 'receipt.client.email'),
+    ({'purchase_name': 'x' * 129}, 'receipt.items[0].name'),
+    ({'purchase_price': 0}, 'receipt.items[0].price'),
+    ({'purchase_price': '-10.00'}, 'receipt.items[0].price'),
+    ({'transaction_uuid': ''}, 'external_id'),
+])
+def test_invalid_registration_data(sell_params, params, path):
+    sell_params.update(params)
+    request_data = AtolAPI().get_registration_data(sell_params)
+
+    with pytest.raises(AtolValidationError) as exc_info:
+        validate_registration_data(request_data)
+    assert exc_info.value.path == path
+    assert str(exc_info.value).startswith(path + ': ')
+
+
+@pytest.mark.parametrize('change,path', [
+    (lambda receipt: receipt.update(total=100), 'receipt.total'),
+    (lambda receipt: receipt['payments'][0].update(sum=100), 'receipt.total'),
+    (lambda receipt: receipt['items'][0].update(sum=100), 'receipt.items[0].sum'),
+    (lambda receipt: receipt['items'][0].update(name=''), 'receipt.items[0].name'),
+    (lambda receipt: receipt['items'][0].update(quantity=True), 'receipt.items[0].quantity'),
+    (lambda receipt: receipt['payments'][0].update(type='1'), 'receipt.payments[0].type'),
+    (lambda receipt: receipt.update(items=[]), 'receipt.items'),
+    (lambda receipt: receipt.pop('client'), 'receipt.client'),
+    (lambda receipt: receipt.update(client={}), 'receipt.client'),
+])
+def test_invalid_receipt_totals_and_structure(sell_params, change, path):
+    request_data = AtolAPI().get_registration_data(sell_params)
+    change(request_data['receipt'])
+
+    with pytest.raises(AtolValidationError) as exc_info:
+        validate_registration_data(request_data)
+    assert exc_info.value.path == path
+
+
+@pytest.mark.parametrize('method_name', ['sell', 'sell_refund'])
+@responses.activate
+def test_invalid_receipt_is_not_sent_to_atol(sell_params, method_name):
+    sell_params['purchase_price'] = 0
+
+    with mock.patch.object(AtolAPI, 'request') as request_mock:
+        with pytest.raises(AtolPrepRequestException):
+            getattr(AtolAPI(), method_name)(**sell_params)
+        assert len(request_mock.mock_calls) == 0
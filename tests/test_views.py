@@ -1,5 +1,12 @@
+from uuid import uuid4
+
+import mock
 import pytest
+import shortuuid
+from django.core.cache import cache
+from django.db import transaction
 from django.test import override_settings
+from atol.links import link_cache
 from atol.models import Receipt, ReceiptStatus
 
 try:
@@ -10,6 +17,16 @@ except ImportError:
 pytestmark = pytest.mark.django_db(transaction=True)
 
 
+def clear_link_cache():
+    link_cache.local.clear()
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def empty_link_cache():
+    clear_link_cache()
+
+
 @pytest.fixture
 def receipt_data():
     return {
@@ -49,6 +66,22 @@ def test_receipt_302_normal_redirect(client, receipt_data):
         assert '20170726T103200' in resp['Location']
 
 
+def test_receipt_redirect_reads_fiscal_columns(client, receipt_data, django_assert_num_queries):
+    legacy_receipt = Receipt.objects.create(content=receipt_data, status=ReceiptStatus.received)
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt.receive(content=receipt_data)
+
+    template = u'fake?t={t}&s={s}&fn={fn}&i={fd}&fp={fp}&n={n}'
+    with override_settings(RECEIPTS_OFD_URL_TEMPLATE=template):
+        with django_assert_num_queries(1) as ctx:
+            resp = client.get(receipt.ofd_link)
+        assert '"content"' not in ctx.captured_queries[0]['sql']
+        assert resp.status_code == 302
+        assert resp['Location'] == 'fake?t=20170726T103200&s=12&fn=8710000100942521&i=40&fp=4146968358&n=1'
+        # the very same link as for receipts which fiscal columns are yet to be backfilled
+        assert client.get(legacy_receipt.ofd_link)['Location'] == resp['Location']
+
+
 def test_receipt_with_legacy_shortuuid(client, receipt_data):
     receipt = Receipt.objects.create(internal_uuid='556f32cc-d0b5-415f-9341-ffe8b874c197',
                                      content=receipt_data,
@@ -69,3 +102,112 @@ def test_receipt_404(content, client):
     receipt = Receipt.objects.create(content=content)
     response = client.get(receipt.ofd_link, expect_errors=True)
     assert response.status_code == 404
+
+
+def test_received_receipt_link_is_served_from_cache(client, receipt_data, django_assert_num_queries):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt.receive(content=receipt_data)
+
+    with django_assert_num_queries(0):
+        resp = client.get(receipt.ofd_link)
+    assert resp.status_code == 302
+    assert receipt_data['payload']['fn_number'] in resp['Location']
+
+
+def test_link_is_cached_once_receipt_is_received(client, receipt_data, django_assert_num_queries):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            receipt.receive(content=receipt_data)
+            raise RuntimeError()
+    assert link_cache.get(shortuuid.encode(receipt.internal_uuid)) is None
+
+    with transaction.atomic():
+        Receipt.objects.filter(id=receipt.id).bulk_receive({receipt.id: receipt_data})
+        assert link_cache.get(shortuuid.encode(receipt.internal_uuid)) is None
+    with django_assert_num_queries(0):
+        assert client.get(receipt.ofd_link).status_code == 302
+
+
+def test_missing_receipt_link_is_cached_shortly(client, receipt_data, django_assert_num_queries):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    unknown_link = reverse('receipt', kwargs={'short_uuid': shortuuid.encode(uuid4())})
+
+    for link in [receipt.ofd_link, unknown_link]:
+        with django_assert_num_queries(1):
+            assert client.get(link).status_code == 404
+        with django_assert_num_queries(0):
+            assert client.get(link).status_code == 404
+
+    # received receipt replaces the missing one right away
+    receipt.receive(content=receipt_data)
+    with django_assert_num_queries(0):
+        assert client.get(receipt.ofd_link).status_code == 302
+
+
+def test_signed_receipt_link(client, receipt_data, django_assert_num_queries):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    assert receipt.signed_ofd_link == receipt.ofd_link
+
+    receipt.receive(content=receipt_data)
+    assert receipt.signed_ofd_link != receipt.ofd_link
+
+    template = u'fake?t={t}&s={s}&fn={fn}&i={fd}&fp={fp}&n={n}'
+    with override_settings(RECEIPTS_OFD_URL_TEMPLATE=template):
+        with django_assert_num_queries(0):
+            resp = client.get(receipt.signed_ofd_link)
+        assert resp.status_code == 302
+        assert resp['Location'] == 'fake?t=20170726T103200&s=12&fn=8710000100942521&i=40&fp=4146968358&n=1'
+
+        # uuid links are still there
+        assert client.get(receipt.ofd_link)['Location'] == resp['Location']
+
+
+def test_signed_receipt_link_is_verified(client, receipt_data):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt.receive(content=receipt_data)
+    link = receipt.signed_ofd_link
+    token = link.strip('/').split('/')[-1]
+
+    tampered = token[:-1] + ('a' if token[-1] != 'a' else 'b')
+    assert client.get(reverse('receipt', kwargs={'short_uuid': tampered})).status_code == 404
+    assert client.get(reverse('receipt', kwargs={'short_uuid': 'z' * 60})).status_code == 404
+
+    with override_settings(RECEIPTS_SIGNED_LINK_SECRET='another-secret'):
+        assert client.get(link).status_code == 404
+
+
+def test_legacy_link_is_resolved_with_single_query(client, receipt_data, django_assert_num_queries):
+    receipt = Receipt.objects.create(internal_uuid='556f32cc-d0b5-415f-9341-ffe8b874c197',
+                                     status=ReceiptStatus.initiated)
+    receipt.receive(content=receipt_data)
+    assert receipt.short_code == 'HDSgoRwD7D4qmgAoyk4QQw'
+    clear_link_cache()
+
+    with override_settings(RECEIPTS_ATOL_SHORT_CODES_BACKFILLED=True):
+        with mock.patch('atol.links.shortuuid.decode') as decode_mock:
+            with django_assert_num_queries(1):
+                resp = client.get(reverse('receipt', kwargs={'short_uuid': 'wQQ4kyoAgmq4D7DwRogSDH'}))
+            assert len(decode_mock.mock_calls) == 0
+    assert resp.status_code == 302
+
+
+def test_link_of_receipt_without_short_code(client, receipt_data, django_assert_num_queries):
+    receipt = Receipt.objects.create(status=ReceiptStatus.initiated)
+    receipt.receive(content=receipt_data)
+    Receipt.objects.filter(id=receipt.id).update(short_code=None)
+    clear_link_cache()
+
+    with django_assert_num_queries(1):
+        assert client.get(receipt.ofd_link).status_code == 302
+
+
+def test_archived_receipt_link(client, receipt_data):
+    receipt = Receipt.objects.create(content=receipt_data, status=ReceiptStatus.received)
+    malformed = Receipt.objects.create(content={'payload': {'total': 1}}, status=ReceiptStatus.received)
+    Receipt.objects.filter(id__in=[receipt.id, malformed.id]).bulk_archive()
+
+    resp = client.get(receipt.ofd_link)
+    assert resp.status_code == 302
+    assert receipt_data['payload']['fn_number'] in resp['Location']
+    assert client.get(malformed.ofd_link).status_code == 404